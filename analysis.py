@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from rules import calculate_pins_and_checks, generate_legal_moves, has_legal_move
+
+## Position analysis cache
+# Move handling, notation and end-of-game detection all ask the same questions about the position after a move.
+# Each position is analysed once and the result kept in a bounded least recently used cache keyed by its Zobrist hash
+
+# Check and end-of-game status of the side to move, found with an early exit legal move search.
+# The full legal move list is only generated when a move is selected or probed
+class PositionAnalysis:
+    __slots__ = ('board', 'is_color', 'enpassant_square', 'castling_rights', 'pin_info', 'in_check', 'has_legal_move',
+                 'checkmate', '_legal_moves')
+
+    def __init__(self, board, is_color, enpassant_square, castling_rights):
+        # The board is copied as the game keeps playing on its own board
+        self.board = [row[:] for row in board]
+        self.is_color = is_color
+        self.enpassant_square = enpassant_square
+        self.castling_rights = castling_rights
+        self.pin_info = calculate_pins_and_checks(self.board, is_color)
+        self.in_check = len(self.pin_info[1]) != 0
+        self.has_legal_move = has_legal_move(self.board, is_color, enpassant_square, self.pin_info)
+        self.checkmate = self.in_check and not self.has_legal_move
+        self._legal_moves = None
+
+    @property
+    def legal_moves(self):
+        if self._legal_moves is None:
+            self._legal_moves = generate_legal_moves(self.board, self.is_color, self.enpassant_square,
+                                                     self.castling_rights, self.pin_info)
+        return self._legal_moves
+
+    # Full count for analysis, this generates every legal move
+    @property
+    def legal_move_count(self):
+        return len(self.legal_moves)
+
+    # Same result as is_checkmate_or_stalemate with count_moves=False, the count is 1 when any legal move exists
+    def end_state(self):
+        return self.checkmate, int(self.has_legal_move)
+
+    def is_legal(self, selected_piece, new_row, new_col):
+        for move in self.legal_moves:
+            if move[0] == selected_piece and move[1] == new_row and move[2] == new_col:
+                return True
+        return False
+
+    # Moves of one piece split the way calculate_legal_moves returns them
+    def piece_moves(self, board, row, col):
+        moves, captures, specials = [], [], []
+        for selected_piece, new_row, new_col, special, _ in self.legal_moves:
+            if selected_piece != (row, col):
+                continue
+            if special:
+                specials.append((new_row, new_col))
+            elif (new_row, new_col) not in moves:
+                # Promotions list the same square once per piece
+                moves.append((new_row, new_col))
+                if board[new_row][new_col] != ' ':
+                    captures.append((new_row, new_col))
+        return moves, captures, specials
+
+class PositionCache:
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # is_color defaults to the side to move, it is part of the key as debug games do not alternate turns
+    def analyse(self, game, is_color=None):
+        if is_color is None:
+            is_color = game.current_turn
+        key = (game.zobrist_hash, is_color)
+        analysis = self.entries.get(key)
+        if analysis is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return analysis
+        self.misses += 1
+        analysis = PositionAnalysis(game.board, is_color, game.enpassant_square, game.castling_rights)
+        self.entries[key] = analysis
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return analysis
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries),
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+POSITION_CACHE = PositionCache()
+
+# Helper function to analyse a game position through the shared cache
+def analyse_position(game, is_color=None):
+    return POSITION_CACHE.analyse(game, is_color)
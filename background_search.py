@@ -0,0 +1,207 @@
+import asyncio
+import sys
+import threading
+import time
+from game import Game
+from engine import Engine
+from rules import generate_legal_moves
+
+## Background search
+# Runs an engine search off the asyncio event loop driving the pygame window, so the board keeps rendering and
+# taking input while the engine thinks. The search runs in an executor thread and every completed depth is
+# handed back to the loop thread. Browser builds have no threads, there the search runs on the loop itself
+# in slices of SLICE_TIME and hands control back after each one
+
+THREADS_AVAILABLE = sys.platform != 'emscripten'
+# Seconds the search may hold the loop in a browser build, under a frame at 60 frames per second
+SLICE_TIME = 0.01
+
+# Helper function to copy the parts of a game the engine reads, so moves played on the loop thread
+# cannot change the position under a running search
+def snapshot_game(game):
+    position = Game([row[:] for row in game.board], game._starting_player, game.current_turn,
+                    game.castling_rights, game.enpassant_square)
+    position.board_states = dict(game.board_states)
+    return position
+
+# Awaitable handle of a running search. Awaiting it gives the final SearchResult, or None once cancelled.
+# info holds the SearchResult of the last completed depth and "async for info in handle" streams each one.
+# A frame loop can instead poll done() and result() every frame. Must be created on the event loop thread
+class SearchHandle:
+
+    # A handle still searching with the same engine is passed as after, this search starts once it has finished
+    def __init__(self, game, engine=None, max_depth=64, max_nodes=None, max_time=None, executor=None, after=None):
+        self.engine = Engine() if engine is None else engine
+        self.info = None
+        self.cancelled = False
+        self.started = time.perf_counter()
+        self._stop_event = threading.Event()
+        self._finished = False
+        self._updates = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+        position = snapshot_game(game)
+        self._future = self._loop.create_task(self._start(position, max_depth, max_nodes, max_time, executor, after))
+
+    async def _start(self, position, max_depth, max_nodes, max_time, executor, after):
+        if after is not None and not after.done():
+            await asyncio.wait([after._future])
+        if THREADS_AVAILABLE:
+            return await self._loop.run_in_executor(executor, self._run, position, max_depth, max_nodes, max_time)
+        return await self._run_cooperatively(position, max_depth, max_nodes, max_time)
+
+    # Runs in the executor thread, depths are published through the loop so info is only written on its thread
+    def _run(self, position, max_depth, max_nodes, max_time):
+        try:
+            return self.engine.search(position, max_depth, max_nodes, max_time,
+                                      lambda info: self._loop.call_soon_threadsafe(self._publish, info),
+                                      self._stop_event)
+        finally:
+            self._loop.call_soon_threadsafe(self._updates.put_nowait, None)
+
+    async def _run_cooperatively(self, position, max_depth, max_nodes, max_time):
+        result = None
+        try:
+            # None marks the end of a slice inside a depth
+            for info in self.engine.iterate_search(position, max_depth, max_nodes, max_time, self._stop_event,
+                                                   SLICE_TIME):
+                if info is not None:
+                    result = info
+                    if result.move is not None:
+                        self._publish(result)
+                await asyncio.sleep(0)
+        finally:
+            self._updates.put_nowait(None)
+        return result
+
+    def _publish(self, info):
+        if not self.cancelled:
+            self.info = info
+            self._updates.put_nowait(info)
+
+    # Stops the search as soon as its first depth is complete, awaiting the handle still gives its best move
+    def stop(self):
+        self._stop_event.set()
+
+    # Stops the search once seconds have passed since it started, e.g. a search started without a time budget
+    def limit_time(self, seconds):
+        self._loop.call_later(max(0.0, self.started + seconds - time.perf_counter()), self.stop)
+
+    # Stops the search and throws its result away
+    def cancel(self):
+        self.cancelled = True
+        self.info = None
+        self._stop_event.set()
+
+    def done(self):
+        return self._future.done()
+
+    # The final SearchResult once done, None while running or once cancelled
+    def result(self):
+        if self.cancelled or not self._future.done():
+            return None
+        return self._future.result()
+
+    def __await__(self):
+        return self._wait().__await__()
+
+    async def _wait(self):
+        result = await self._future
+        return None if self.cancelled else result
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        info = None if self._finished else await self._updates.get()
+        if info is None or self.cancelled:
+            self._finished = True
+            raise StopAsyncIteration
+        return info
+
+
+# Searches on the opponent's time. While the opponent is to move the engine plays their expected reply on a copy
+# of the game and searches the position after it, keeping its transposition table and principal variation.
+# Once the real move is synchronized a ponder hit hands the running search over, a miss cancels it.
+# The table is kept either way, so later searches of nearby positions still start warm
+class Ponderer:
+
+    # Depth of the quick search that predicts the reply when the table holds no move for the position
+    def __init__(self, engine=None, expected_depth=3):
+        self.engine = Engine(1 << 18) if engine is None else engine
+        self.expected_depth = expected_depth
+        self.handle = None
+        # Hash of the position handle searches, the position pondering started from and the expected reply
+        self.position = None
+        self.base = None
+        self.expected_move = None
+        self.predicting = False
+        # Every handle started with the engine, a new one waits for it so two searches never share the engine
+        self.last = None
+        self.hits = 0
+        self.misses = 0
+
+    # Called every frame, ponders on the opponent's turn and settles the ponder search once the real move is in
+    def update(self, game):
+        player = game._starting_player
+        if game.end_position:
+            self.stop()
+        elif game.current_turn != player:
+            if self.handle is not None and self.base != game.zobrist_hash:
+                # The position changed under the opponent's turn, e.g. through an undo
+                self.stop()
+            if self.handle is None:
+                self.start(game)
+            elif self.predicting and self.handle.done():
+                result = self.handle.result()
+                self.handle, self.predicting = None, False
+                if result is not None and result.move is not None:
+                    selected_piece, (new_row, new_col), special = result.move
+                    self.ponder(game, (selected_piece, new_row, new_col, special, result.promotion))
+        elif self.handle is not None:
+            if not self.predicting and self.position == game.zobrist_hash:
+                if self.expected_move is not None:
+                    self.hits += 1
+                    self.expected_move = None
+            else:
+                if not self.predicting and self.expected_move is not None:
+                    self.misses += 1
+                self.stop()
+
+    # Ponders the reply stored in the table when there is one, otherwise first predicts it with a quick search
+    def start(self, game):
+        self.base = game.zobrist_hash
+        entry = self.engine.tt.probe(game.zobrist_hash)
+        moves = generate_legal_moves(game.board, game.current_turn, game.enpassant_square, game.castling_rights)
+        if not moves:
+            return
+        if entry is not None and entry[4] in moves:
+            self.ponder(game, entry[4])
+        else:
+            self.predicting = True
+            self.position = game.zobrist_hash
+            self.handle = self.last = SearchHandle(game, self.engine, self.expected_depth, after=self.last)
+
+    def ponder(self, game, move):
+        position = snapshot_game(game)
+        position.make_move(*move)
+        self.expected_move = move
+        self.position = position.zobrist_hash
+        self.handle = self.last = SearchHandle(position, self.engine, after=self.last)
+
+    # Search of the game's position for max_time seconds. A ponder hit hands over the running search,
+    # which already holds the depths searched on the opponent's time
+    def search(self, game, max_time=None, max_depth=64):
+        if self.handle is not None and not self.predicting and self.position == game.zobrist_hash \
+                and game.current_turn == game._starting_player:
+            handle, self.handle = self.handle, None
+            if max_time is not None:
+                handle.limit_time(max_time)
+            return handle
+        self.stop()
+        self.last = SearchHandle(game, self.engine, max_depth, max_time=max_time, after=self.last)
+        return self.last
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+        self.handle, self.position, self.expected_move, self.predicting = None, None, None, False
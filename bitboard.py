@@ -0,0 +1,304 @@
+import time
+
+## Bitboard move generation backend
+# Squares are indexed as row * 8 + col, so bit 0 is board[0][0] (a8) and bit 63 is board[7][7] (h1).
+# Moving "up" the board towards row 0 is a right shift by 8, moving right along a row is a left shift by 1.
+FULL = (1 << 64) - 1
+FILE_A = sum(1 << (row * 8) for row in range(8))
+FILE_B = FILE_A << 1
+FILE_G = FILE_A << 6
+FILE_H = FILE_A << 7
+NOT_FILE_A = FULL ^ FILE_A
+NOT_FILE_H = FULL ^ FILE_H
+NOT_FILE_AB = FULL ^ (FILE_A | FILE_B)
+NOT_FILE_GH = FULL ^ (FILE_G | FILE_H)
+
+WHITE_PIECES = 'PNBRQK'
+BLACK_PIECES = 'pnbrqk'
+
+# Helper function to convert a (row, col) square into its bit index
+def square_index(row, col):
+    return row * 8 + col
+
+# Helper function to iterate over the (row, col) squares of every set bit, lowest index first
+def bit_squares(bitboard):
+    squares = []
+    while bitboard:
+        lowest = bitboard & -bitboard
+        index = lowest.bit_length() - 1
+        squares.append((index >> 3, index & 7))
+        bitboard ^= lowest
+    return squares
+
+## Shift and mask generators, these work on every set bit of the input at once
+# Helper function for the squares attacked by knights on a bitboard
+def knight_attacks_from(bitboard):
+    attacks = (bitboard >> 17) & NOT_FILE_H  # Up two, left one
+    attacks |= (bitboard >> 15) & NOT_FILE_A  # Up two, right one
+    attacks |= (bitboard >> 10) & NOT_FILE_GH # Up one, left two
+    attacks |= (bitboard >> 6) & NOT_FILE_AB  # Up one, right two
+    attacks |= (bitboard << 6) & NOT_FILE_GH  # Down one, left two
+    attacks |= (bitboard << 10) & NOT_FILE_AB # Down one, right two
+    attacks |= (bitboard << 15) & NOT_FILE_H  # Down two, left one
+    attacks |= (bitboard << 17) & NOT_FILE_A  # Down two, right one
+    return attacks & FULL
+
+# Helper function for the squares attacked by kings on a bitboard
+def king_attacks_from(bitboard):
+    sideways = ((bitboard >> 1) & NOT_FILE_H) | ((bitboard << 1) & NOT_FILE_A)
+    row = bitboard | sideways
+    return (sideways | (row >> 8) | (row << 8)) & FULL
+
+# Helper function for the squares attacked by pawns on a bitboard, white pawns attack towards row 0
+def pawn_attacks_from(bitboard, is_white):
+    if is_white:
+        return ((bitboard >> 9) & NOT_FILE_H) | ((bitboard >> 7) & NOT_FILE_A)
+    return (((bitboard << 7) & NOT_FILE_H) | ((bitboard << 9) & NOT_FILE_A)) & FULL
+
+# Ray directions as (shift, wrap mask); positive shifts move towards higher bit indices
+# so the first blocker on those rays is the lowest set bit, and the highest set bit otherwise
+RAY_DIRECTIONS = {
+    'E': (1, NOT_FILE_A),
+    'W': (-1, NOT_FILE_H),
+    'S': (8, FULL),
+    'N': (-8, FULL),
+    'SE': (9, NOT_FILE_A),
+    'SW': (7, NOT_FILE_H),
+    'NE': (-7, NOT_FILE_A),
+    'NW': (-9, NOT_FILE_H),
+}
+POSITIVE_RAYS = ('E', 'S', 'SE', 'SW')
+
+# Helper function to fill a single bit along a direction until it leaves the board
+def build_ray(index, shift, mask):
+    ray = 0
+    bit = 1 << index
+    while True:
+        bit = ((bit << shift) if shift > 0 else (bit >> -shift)) & mask & FULL
+        if not bit:
+            return ray
+        ray |= bit
+
+# Attack tables built once at import, indexed by bit index
+KNIGHT_ATTACKS = [knight_attacks_from(1 << index) for index in range(64)]
+KING_ATTACKS = [king_attacks_from(1 << index) for index in range(64)]
+# PAWN_ATTACKS[is_white][index]
+PAWN_ATTACKS = {
+    True: [pawn_attacks_from(1 << index, True) for index in range(64)],
+    False: [pawn_attacks_from(1 << index, False) for index in range(64)],
+}
+RAYS = {name: [build_ray(index, shift, mask) for index in range(64)] for name, (shift, mask) in RAY_DIRECTIONS.items()}
+
+# Helper function for the squares a slider on index sees along one ray, including the first blocker
+def ray_attacks(index, occupied, name):
+    ray = RAYS[name][index]
+    blockers = ray & occupied
+    if blockers:
+        if name in POSITIVE_RAYS:
+            first = (blockers & -blockers).bit_length() - 1
+        else:
+            first = blockers.bit_length() - 1
+        ray ^= RAYS[name][first]
+    return ray
+
+def rook_attacks(index, occupied):
+    return ray_attacks(index, occupied, 'E') | ray_attacks(index, occupied, 'W') | \
+        ray_attacks(index, occupied, 'S') | ray_attacks(index, occupied, 'N')
+
+def bishop_attacks(index, occupied):
+    return ray_attacks(index, occupied, 'NW') | ray_attacks(index, occupied, 'NE') | \
+        ray_attacks(index, occupied, 'SW') | ray_attacks(index, occupied, 'SE')
+
+# Bitboard representation of a list board, one occupancy integer per piece type and colour
+class BitboardPosition:
+    __slots__ = ('pieces', 'white', 'black')
+
+    def __init__(self, board):
+        pieces = dict.fromkeys(WHITE_PIECES + BLACK_PIECES, 0)
+        bit = 1
+        for rank in board:
+            for piece in rank:
+                if piece != ' ':
+                    pieces[piece] |= bit
+                bit <<= 1
+        self.pieces = pieces
+        self.white = pieces['P'] | pieces['N'] | pieces['B'] | pieces['R'] | pieces['Q'] | pieces['K']
+        self.black = pieces['p'] | pieces['n'] | pieces['b'] | pieces['r'] | pieces['q'] | pieces['k']
+
+    def occupied(self):
+        return self.white | self.black
+
+    # Standard moves of the piece on index as a bitboard, captures are the subset landing on enemy pieces
+    def piece_targets(self, index, piece):
+        is_white = piece.isupper()
+        own, enemy = (self.white, self.black) if is_white else (self.black, self.white)
+        occupied = own | enemy
+        kind = piece.lower()
+        if kind == 'p':
+            bit = 1 << index
+            if is_white:
+                single = (bit >> 8) & ~occupied
+                double = (single >> 8) & ~occupied if index >> 3 == 6 else 0
+            else:
+                single = (bit << 8) & ~occupied & FULL
+                double = (single << 8) & ~occupied & FULL if index >> 3 == 1 else 0
+            return single | double | (PAWN_ATTACKS[is_white][index] & enemy), enemy
+        elif kind == 'n':
+            targets = KNIGHT_ATTACKS[index]
+        elif kind == 'b':
+            targets = bishop_attacks(index, occupied)
+        elif kind == 'r':
+            targets = rook_attacks(index, occupied)
+        elif kind == 'q':
+            targets = bishop_attacks(index, occupied) | rook_attacks(index, occupied)
+        else:
+            targets = KING_ATTACKS[index]
+        return targets & ~own, enemy
+
+    # Helper method to check if a square is attacked by a colour, optionally with some squares treated as empty
+    # and some of the attacker's pieces removed to test a move without building a new position
+    def is_attacked(self, index, by_white, occupied=None, removed=0):
+        pieces = self.pieces
+        if occupied is None:
+            occupied = self.white | self.black
+        if by_white:
+            pawns, knights, bishops, rooks, queens, king = \
+                pieces['P'], pieces['N'], pieces['B'], pieces['R'], pieces['Q'], pieces['K']
+        else:
+            pawns, knights, bishops, rooks, queens, king = \
+                pieces['p'], pieces['n'], pieces['b'], pieces['r'], pieces['q'], pieces['k']
+        keep = ~removed
+        # A square is attacked by a white pawn if a black pawn standing on it would attack that pawn
+        if PAWN_ATTACKS[not by_white][index] & pawns & keep:
+            return True
+        if KNIGHT_ATTACKS[index] & knights & keep:
+            return True
+        if KING_ATTACKS[index] & king & keep:
+            return True
+        diagonal = (bishops | queens) & keep
+        if diagonal and bishop_attacks(index, occupied) & diagonal:
+            return True
+        straight = (rooks | queens) & keep
+        if straight and rook_attacks(index, occupied) & straight:
+            return True
+        return False
+
+    # Helper method to check if the king of a colour would be attacked after moving a piece from one index to another
+    def king_attacked_after(self, is_white, start, end, piece, captured_index=None):
+        start_bit, end_bit = 1 << start, 1 << end
+        captured_bit = 1 << (end if captured_index is None else captured_index)
+        occupied = ((self.white | self.black) & ~start_bit & ~captured_bit) | end_bit
+        king = end_bit if piece.lower() == 'k' else self.pieces['K' if is_white else 'k']
+        if not king:
+            return False
+        king_index = king.bit_length() - 1
+        # An enemy piece on the capture square no longer attacks anything
+        return self.is_attacked(king_index, not is_white, occupied, captured_bit)
+
+# Helper function for the en passant capture available to a pawn given the en passant target square
+def enpassant_targets(row, col, is_white, enpassant_square):
+    if enpassant_square is None or abs(col - enpassant_square[1]) != 1:
+        return []
+    if (is_white and row == 3 and enpassant_square[0] == 2) or (not is_white and row == 4 and enpassant_square[0] == 5):
+        return [enpassant_square]
+    return []
+
+## Backend entry points mirroring the list-board helpers
+# Standard moves and captures of a single piece as (row, col) lists
+def bitboard_moves(board, row, col, position=None):
+    if position is None:
+        position = BitboardPosition(board)
+    targets, enemy = position.piece_targets(square_index(row, col), board[row][col])
+    return bit_squares(targets), bit_squares(targets & enemy)
+
+# Bitboard version of is_square_attacked
+def bitboard_is_square_attacked(board, row, col, by_white, position=None):
+    if position is None:
+        position = BitboardPosition(board)
+    return position.is_attacked(square_index(row, col), by_white)
+
+# Bitboard version of is_check, returns False when the king is missing as happens in debug mode
+def bitboard_is_check(board, is_color, position=None):
+    if position is None:
+        position = BitboardPosition(board)
+    king = position.pieces['K' if is_color else 'k']
+    if not king:
+        return False
+    return position.is_attacked(king.bit_length() - 1, not is_color)
+
+# Bitboard version of is_checkmate_or_stalemate, every candidate move is tested on the integers without copying the board.
+# With count_moves=False it stops at the first legal move and the count is then only 0 or 1
+def bitboard_is_checkmate_or_stalemate(board, is_color, enpassant_square=None, count_moves=True):
+    position = BitboardPosition(board)
+    possible_moves = 0
+    checkmate = bitboard_is_check(board, is_color, position)
+
+    own = position.white if is_color else position.black
+    remaining = own
+    while remaining:
+        lowest = remaining & -remaining
+        start = lowest.bit_length() - 1
+        remaining ^= lowest
+        row, col = start >> 3, start & 7
+        piece = board[row][col]
+        targets, _ = position.piece_targets(start, piece)
+        while targets:
+            target_bit = targets & -targets
+            targets ^= target_bit
+            if not position.king_attacked_after(is_color, start, target_bit.bit_length() - 1, piece):
+                if not count_moves:
+                    return False, 1
+                possible_moves += 1
+                checkmate = False
+        if piece.lower() == 'p':
+            for end_row, end_col in enpassant_targets(row, col, is_color, enpassant_square):
+                if not position.king_attacked_after(is_color, start, square_index(end_row, end_col), piece, square_index(row, end_col)):
+                    if not count_moves:
+                        return False, 1
+                    possible_moves += 1
+                    checkmate = False
+
+    return checkmate, possible_moves
+
+## Benchmark
+# Realistic middlegame boards used to compare the list and bitboard backends
+BENCHMARK_POSITIONS = {
+    'Italian Game': 'r1bq1rk1/pppp1ppp/2n2n2/2b1p3/2B1P3/2PP1N2/PP3PPP/RNBQ1RK1',
+    'Queens Gambit Declined': 'r1bq1rk1/pp1nbppp/2p1pn2/3p2B1/2PP4/2NBPN2/PP3PPP/R2QK2R',
+    'Sicilian Najdorf': 'r1b1kb1r/1pqn1ppp/p2ppn2/6B1/3NPP2/2N2Q2/PPP3PP/2KR1B1R',
+    'Kiwipete': 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R',
+    'Rook Endgame': '8/5pk1/6p1/R6p/7P/6P1/r4PK1/8',
+}
+
+# Helper function to build a list board from the piece placement field of a FEN string
+def board_from_placement(placement):
+    board = []
+    for rank in placement.split('/'):
+        row = []
+        for char in rank:
+            if char.isdigit():
+                row.extend([' '] * int(char))
+            else:
+                row.append(char)
+        board.append(row)
+    return board
+
+# Times both backends on every benchmark position for each side to move and prints the speedup
+def benchmark(repeats=200):
+    import rules
+
+    print(f"{'Position':<26}{'Query':<28}{'list (us)':>12}{'bitboard (us)':>15}{'speedup':>10}")
+    for name, placement in BENCHMARK_POSITIONS.items():
+        board = board_from_placement(placement)
+        for label, function in [('is_check', rules.is_check), ('is_checkmate_or_stalemate', rules.is_checkmate_or_stalemate)]:
+            timings = []
+            for backend in ['list', 'bitboard']:
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    for is_white in [True, False]:
+                        function(board, is_white, [], backend=backend)
+                timings.append((time.perf_counter() - start) / (repeats * 2) * 1e6)
+            print(f"{name:<26}{label:<28}{timings[0]:>12.1f}{timings[1]:>15.1f}{timings[0] / timings[1]:>9.1f}x")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,217 @@
+import argparse
+import mmap
+import os
+import re
+import struct
+import time
+from game import game_from_fen
+from rules import generate_legal_moves, move_string
+from shared_table import pack_move, unpack_move
+
+## Opening book
+# A sorted array of fixed-width (Zobrist hash, move, weight) records in a binary file. Lookups binary search the
+# file through mmap, so opening a book reads nothing up front and a lookup touches a few pages however many
+# records the book holds. Books are compiled from PGN files by build_book
+
+BOOK_MAGIC = b'JDCBOOK1'
+HEADER = struct.Struct('<8sQ')
+# Hash, move packed like in the shared transposition table and weight
+RECORD = struct.Struct('<QHH')
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+class OpeningBook:
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size = HEADER.unpack_from(self.map, 0)
+        if magic != BOOK_MAGIC or HEADER.size + self.size * RECORD.size > len(self.map):
+            self.close()
+            raise ValueError(f"{path} is not an opening book")
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def record(self, index):
+        return RECORD.unpack_from(self.map, HEADER.size + index * RECORD.size)
+
+    # Every (move, weight) stored for a hash, moves in the (selected_piece, new_row, new_col, special, promotion)
+    # form Game.make_move takes
+    def entries(self, key):
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        entries = []
+        while low < self.size:
+            stored_key, packed, weight = self.record(low)
+            if stored_key != key:
+                break
+            entries.append((unpack_move(packed), weight))
+            low += 1
+        return entries
+
+    # Book moves of the game's position that are legal in it, a guard against hash collisions
+    def moves(self, game):
+        legal_moves = generate_legal_moves(game.board, game.current_turn, game.enpassant_square, game.castling_rights)
+        return [(move, weight) for move, weight in self.entries(game.zobrist_hash) if move in legal_moves and weight > 0]
+
+    # The heaviest book move, or a weighted random one when rng is given. None once out of book
+    def choose(self, game, rng=None):
+        moves = self.moves(game)
+        if not moves:
+            return None
+        if rng is None:
+            return max(moves, key=lambda entry: entry[1])[0]
+        return rng.choices([move for move, _ in moves], [weight for _, weight in moves])[0]
+
+## PGN
+# Just enough PGN reading to replay the main line of each game: tags, comments, variations, move numbers,
+# annotations and results are skipped
+
+PGN_TOKEN = re.compile(r'\[[^\]]*\]|\{[^}]*\}|;[^\n]*|\(|\)|\$\d+|\d+\.+|[^\s()]+')
+MOVE_NUMBER = re.compile(r'\d+\.+')
+PGN_TAG = re.compile(r'\[(\w+)\s+"([^"]*)"\]')
+SAN_MOVE = re.compile(r'([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?')
+
+# Yields (tags, san_moves) for every game of a PGN text
+def read_pgn(text):
+    tags, moves, depth = {}, [], 0
+    for token in PGN_TOKEN.findall(text):
+        if token[0] == '[':
+            if moves:
+                yield tags, moves
+                tags, moves = {}, []
+            match = PGN_TAG.match(token)
+            if match:
+                tags[match.group(1)] = match.group(2)
+        elif token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif token in ('1-0', '0-1', '1/2-1/2', '*'):
+            if moves or tags:
+                tags.setdefault('Result', token)
+                yield tags, moves
+            tags, moves = {}, []
+        elif depth == 0 and token[0] not in '{;$' and not MOVE_NUMBER.fullmatch(token):
+            moves.append(token)
+    if moves:
+        yield tags, moves
+
+# Helper function to find the legal move a SAN string names, castling in either the O-O or 0-0 form
+def san_to_move(board, legal_moves, san):
+    san = san.rstrip('+#!?')
+    if san in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+        target_col = 6 if len(san) == 3 else 2
+        for move in legal_moves:
+            if move[3] and move[2] == target_col and board[move[0][0]][move[0][1]] in ('K', 'k'):
+                return move
+        return None
+    match = SAN_MOVE.fullmatch(san)
+    if match is None:
+        return None
+    piece, from_file, from_rank, target, promotion = match.groups()
+    piece = piece or 'P'
+    new_row, new_col = 8 - int(target[1]), ord(target[0]) - ord('a')
+    found = None
+    for move in legal_moves:
+        (row, col), move_row, move_col, special, move_promotion = move
+        if (move_row, move_col) != (new_row, new_col) or board[row][col].upper() != piece:
+            continue
+        if from_file is not None and col != ord(from_file) - ord('a'):
+            continue
+        if from_rank is not None and row != 8 - int(from_rank):
+            continue
+        if (move_promotion.upper() if move_promotion else None) != promotion:
+            continue
+        # Castling is only written as O-O
+        if special and piece == 'K':
+            continue
+        if found is not None:
+            return None
+        found = move
+    return found
+
+## Building
+# Each position of the first max_ply plies of every game adds to the weight of the move played from it:
+# 2 for a win of the side playing it, 1 for a draw and nothing for a loss, like Polyglot books
+
+RESULT_WEIGHTS = {'1-0': (2, 0), '0-1': (0, 2), '1/2-1/2': (1, 1)}
+
+# Returns the (hash, packed move) -> weight counts of the games of a PGN text and the number of games read
+def count_pgn_moves(text, max_ply=20, counts=None):
+    counts = {} if counts is None else counts
+    games = 0
+    for tags, san_moves in read_pgn(text):
+        white_weight, black_weight = RESULT_WEIGHTS.get(tags.get('Result'), (1, 1))
+        game = game_from_fen(tags.get('FEN', START_FEN))
+        for san in san_moves[:max_ply]:
+            legal_moves = generate_legal_moves(game.board, game.current_turn, game.enpassant_square, game.castling_rights)
+            move = san_to_move(game.board, legal_moves, san)
+            if move is None:
+                # An unreadable or illegal move ends the game's contribution
+                break
+            key = (game.zobrist_hash, pack_move(move))
+            counts[key] = counts.get(key, 0) + (white_weight if game.current_turn else black_weight)
+            game.make_move(*move)
+        games += 1
+    return counts, games
+
+# Writes the records sorted by hash, weights above the 16 bit range are clamped
+def write_book(counts, path):
+    records = sorted((key, packed, min(weight, 0xFFFF)) for (key, packed), weight in counts.items() if weight > 0)
+    with open(path, 'wb') as file:
+        file.write(HEADER.pack(BOOK_MAGIC, len(records)))
+        for record in records:
+            file.write(RECORD.pack(*record))
+    return len(records)
+
+# Compiles PGN files into a book file, returning the number of games and records
+def build_book(pgn_paths, path, max_ply=20):
+    counts, games = {}, 0
+    for pgn_path in pgn_paths:
+        with open(pgn_path, encoding='utf-8', errors='replace') as file:
+            _, file_games = count_pgn_moves(file.read(), max_ply, counts)
+        games += file_games
+    return games, write_book(counts, path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build or query an opening book')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='compile PGN files into a book')
+    build.add_argument('pgn', nargs='+')
+    build.add_argument('--out', default='book.bin')
+    build.add_argument('--max-ply', type=int, default=20)
+    probe = commands.add_parser('probe', help='list the book moves of a position')
+    probe.add_argument('book')
+    probe.add_argument('--fen', default=START_FEN)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        start = time.perf_counter()
+        games, records = build_book(args.pgn, args.out, args.max_ply)
+        print(f"{games} games, {records} records, {os.path.getsize(args.out)} bytes in {time.perf_counter() - start:.2f}s")
+    else:
+        with OpeningBook(args.book) as book:
+            game = game_from_fen(args.fen)
+            start = time.perf_counter()
+            moves = book.moves(game)
+            elapsed = time.perf_counter() - start
+            for move, weight in sorted(moves, key=lambda entry: entry[1], reverse=True):
+                print(f"{move_string(move[0], move[1], move[2], move[4])}: {weight}")
+            print(f"{len(book)} records, lookup {elapsed * 1e6:.0f} us")
@@ -0,0 +1,191 @@
+import functools
+import pickle
+import struct
+import time
+from protocol import MOVE, UNDO, RESIGN, DRAW, SUBSCRIBE
+from shared_table import PROMOTIONS, pack_move, unpack_move
+
+## Wire format
+# Every message is framed by a 4-byte big-endian length. A binary message then starts with a version byte and a
+# type byte, followed by a fixed layout for the type:
+#   PLAYER    B is_white
+#   REQUEST   I sequence, H count, then per command B kind and for a move H packed move
+#   REPLY     B paired, H count, then per event B kind with the sender's colour in the high bit, H move for moves
+#   SNAPSHOT  32 bytes holding a nibble per square from a8 to h1, B side to move and castling rights,
+#             B en passant square or 255
+# Moves are packed into 16 bits like in the shared transposition table: start, end, special flag and promotion.
+# Pickle payloads start with 0x80, they are only still written for whole games, the legacy protocol, and a
+# server can refuse to read them from untrusted peers
+
+VERSION = 1
+PLAYER, REQUEST, REPLY, SNAPSHOT = 1, 2, 3, 4
+FRAME_HEADER = struct.Struct("!I")
+MESSAGE_HEADER = struct.Struct("!BB")
+PLAYER_MESSAGE = struct.Struct("!BBB")
+REQUEST_HEADER = struct.Struct("!BBIH")
+REPLY_HEADER = struct.Struct("!BBBH")
+SNAPSHOT_MESSAGE = struct.Struct("!BB32sBB")
+PACKED_MOVE = struct.Struct("!H")
+PICKLE_MARKER = 0x80
+WHITE_EVENT = 0x80
+
+# A square's nibble is a hex digit, so a board packs through one translate and bytes.fromhex
+PIECE_CODES = {' ': 0, 'P': 1, 'N': 2, 'B': 3, 'R': 4, 'Q': 5, 'K': 6,
+               'p': 9, 'n': 10, 'b': 11, 'r': 12, 'q': 13, 'k': 14}
+PIECE_DIGITS = str.maketrans({piece: '0123456789abcdef'[code] for piece, code in PIECE_CODES.items()})
+DIGIT_PIECES = str.maketrans({'0123456789abcdef'[code]: piece for piece, code in PIECE_CODES.items()})
+PIECES = frozenset(PIECE_CODES)
+
+# Commands are encoded and decoded through caches, a game only uses a few hundred distinct moves. Decoded ones are
+# keyed by bytes from the peer, the caches are bounded so a peer sending every possible move cannot grow them
+COMMAND_CACHE_SIZE = 4096
+
+# Helper functions to write the commands of a request or reply, kind is or'ed with the colour bit for events
+@functools.lru_cache(maxsize=COMMAND_CACHE_SIZE)
+def encode_command(colour, command):
+    if command[0] == MOVE:
+        _, row, col, new_row, new_col, special, promotion = command
+        return bytes((MOVE | colour,)) + PACKED_MOVE.pack(pack_move(((row, col), new_row, new_col, special, promotion)))
+    if command[0] in (UNDO, RESIGN, DRAW, SUBSCRIBE):
+        return bytes((command[0] | colour,))
+    raise ValueError(f"Unknown command {command[0]}")
+
+# Returns the (is_white, command) of an encoded command. A packed move must be one pack_move writes: it leaves its
+# square and only promotes on the first or last row
+@functools.lru_cache(maxsize=COMMAND_CACHE_SIZE)
+def decode_command(encoded):
+    kind = encoded[0] & ~WHITE_EVENT
+    if kind == MOVE:
+        if len(encoded) != 3:
+            raise ValueError("Truncated move")
+        packed = PACKED_MOVE.unpack_from(encoded, 1)[0]
+        start, end, promotion_index = packed >> 10, packed >> 4 & 63, packed & 7
+        if start == end or promotion_index >= len(PROMOTIONS) or (promotion_index and end >> 3 not in (0, 7)):
+            raise ValueError(f"Invalid move {packed:#06x}")
+        (row, col), new_row, new_col, special, promotion = unpack_move(packed)
+        command = (MOVE, row, col, new_row, new_col, special, promotion)
+    elif kind in (UNDO, RESIGN, DRAW, SUBSCRIBE):
+        command = (kind,)
+    else:
+        raise ValueError(f"Unknown command {kind}")
+    return encoded[0] & WHITE_EVENT != 0, command
+
+# Returns the (is_white, command) events of a payload from offset on
+def decode_commands(payload, offset, count):
+    events = []
+    for _ in range(count):
+        if offset >= len(payload):
+            raise ValueError("Truncated commands")
+        size = 3 if payload[offset] & ~WHITE_EVENT == MOVE else 1
+        events.append(decode_command(payload[offset:offset + size]))
+        offset += size
+    if offset != len(payload):
+        raise ValueError("Trailing bytes after the commands")
+    return events
+
+# Helper functions to pack a board into a nibble per square and back
+def encode_board(board):
+    return bytes.fromhex(''.join([''.join(rank) for rank in board]).translate(PIECE_DIGITS))
+
+def decode_board(data):
+    squares = data.hex().translate(DIGIT_PIECES)
+    # The digits 7, 8 and f are no piece and are left as they are
+    if len(squares) != 64 or not PIECES.issuperset(squares):
+        raise ValueError("Invalid board")
+    return [list(squares[row:row + 8]) for row in range(0, 64, 8)]
+
+# Encodes the messages of the game protocols by their shape:
+#   is_white                                                 the starting player sent on connection
+#   (sequence, commands)                                     a delta protocol request
+#   (paired, events)                                         a delta protocol reply, paired being a bool
+#   (board, is_white_turn, castling_rights, enpassant_square) a position snapshot, like parse_fen returns
+# anything else, a Game or the list of games of the legacy protocol, is pickled
+def encode(data):
+    if isinstance(data, bool):
+        return PLAYER_MESSAGE.pack(VERSION, PLAYER, data)
+    if isinstance(data, tuple) and len(data) == 2 and isinstance(data[0], bool):
+        paired, events = data
+        header = REPLY_HEADER.pack(VERSION, REPLY, paired, len(events))
+        if not events:
+            return header
+        return header + b''.join([encode_command(WHITE_EVENT if is_white else 0, command) for is_white, command in events])
+    if isinstance(data, tuple) and len(data) == 2 and isinstance(data[0], int):
+        sequence, commands = data
+        header = REQUEST_HEADER.pack(VERSION, REQUEST, sequence, len(commands))
+        if not commands:
+            return header
+        return header + b''.join([encode_command(0, command) for command in commands])
+    if isinstance(data, tuple) and len(data) == 4 and isinstance(data[0], list):
+        board, is_white_turn, castling_rights, enpassant_square = data
+        enpassant = 255 if enpassant_square is None else enpassant_square[0] * 8 + enpassant_square[1]
+        return SNAPSHOT_MESSAGE.pack(VERSION, SNAPSHOT, encode_board(board), is_white_turn | castling_rights << 1,
+                                     enpassant)
+    return pickle.dumps(data)
+
+# Decodes a payload back into the objects encode takes, pickle is only read when allowed
+def decode(payload, allow_pickle=True):
+    if not payload:
+        raise ValueError("Empty message")
+    if payload[0] == PICKLE_MARKER:
+        if not allow_pickle:
+            raise ValueError("Pickled messages are not accepted")
+        return pickle.loads(payload)
+    if len(payload) < MESSAGE_HEADER.size:
+        raise ValueError("Truncated message")
+    version, message_type = payload[0], payload[1]
+    if version != VERSION:
+        raise ValueError(f"Unsupported wire format version {version}")
+    try:
+        if message_type == PLAYER:
+            return bool(PLAYER_MESSAGE.unpack(payload)[2])
+        if message_type == REQUEST:
+            _, _, sequence, count = REQUEST_HEADER.unpack_from(payload, 0)
+            return sequence, tuple(command for _, command in decode_commands(payload, REQUEST_HEADER.size, count))
+        if message_type == REPLY:
+            _, _, paired, count = REPLY_HEADER.unpack_from(payload, 0)
+            return bool(paired), decode_commands(payload, REPLY_HEADER.size, count)
+        if message_type == SNAPSHOT:
+            _, _, board, flags, enpassant = SNAPSHOT_MESSAGE.unpack(payload)
+            return decode_board(board), bool(flags & 1), flags >> 1, None if enpassant == 255 else divmod(enpassant, 8)
+    except struct.error as err:
+        # The fixed layouts are shorter or longer than the payload
+        raise ValueError(f"Malformed message: {err}") from err
+    raise ValueError(f"Unknown message type {message_type}")
+
+# Helper function to prefix an encoded message with its length
+def encode_frame(data):
+    payload = encode(data)
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+if __name__ == "__main__":
+    from server import new_board
+
+    # The replay holds the 60 moves of a game of 30 moves a side
+    board = [row[:] for row in new_board]
+    moves = [((6, 4), 4, 4), ((1, 4), 3, 4), ((7, 6), 5, 5), ((0, 1), 2, 2), ((7, 5), 4, 2), ((0, 6), 2, 5)] * 10
+    events = [(index % 2 == 0, (MOVE, selected_piece[0], selected_piece[1], new_row, new_col, False, None))
+              for index, (selected_piece, new_row, new_col) in enumerate(moves)]
+    messages = {
+        'player': True,
+        'poll request': (60, ()),
+        'move request': (60, ((MOVE, 6, 4, 4, 4, False, None),)),
+        'promotion request': (60, ((MOVE, 1, 1, 0, 0, False, 'Q'),)),
+        'empty reply': (True, []),
+        'move reply': (True, [(True, (MOVE, 6, 4, 4, 4, False, None))]),
+        'replay of 60 moves': (True, events),
+        'board snapshot': (board, True, 15, None),
+    }
+    print(f"{'message':<20} {'binary':>7} {'pickle':>7} {'encode':>9} {'decode':>9} {'pickle encode':>14} "
+          f"{'pickle decode':>14}")
+    for name, message in messages.items():
+        payload, pickled = encode(message), pickle.dumps(message)
+        assert decode(payload) == message and payload[0] != PICKLE_MARKER
+        timings = []
+        for function, argument in ((encode, message), (decode, payload), (pickle.dumps, message), (pickle.loads, pickled)):
+            repeats = 20000
+            start = time.perf_counter()
+            for _ in range(repeats):
+                function(argument)
+            timings.append((time.perf_counter() - start) / repeats * 1e6)
+        print(f"{name:<20} {len(payload):>6}B {len(pickled):>6}B {timings[0]:>7.2f}us {timings[1]:>7.2f}us "
+              f"{timings[2]:>12.2f}us {timings[3]:>12.2f}us")
@@ -0,0 +1,401 @@
+import argparse
+import time
+from game import Game, game_from_fen
+from rules import calculate_pins_and_checks, generate_legal_moves, move_string
+from book import OpeningBook
+from evaluation import PIECE_VALUES, score_evaluation
+from tablebase import Tablebases
+
+## Search engine
+# Negamax alpha-beta over Game.make_move/unmake_move with iterative deepening, a quiescence search over captures
+# and a fixed-size transposition table keyed by the Zobrist hash. Moves are ordered by the table move, MVV-LVA
+# for captures, then killer moves and the history heuristic for quiet moves. Runs without pygame
+
+MATE_SCORE = 100000
+# Scores beyond this are mates, their distance from the root is stored relative to the node in the table
+MATE_BOUND = MATE_SCORE - 1000
+INFINITY = MATE_SCORE + 1
+EXACT, LOWER_BOUND, UPPER_BOUND = 0, 1, 2
+
+# Fixed-size table of searched positions, a slot is picked by the low bits of the Zobrist hash and the full hash
+# is kept to tell positions sharing a slot apart. Entries are (hash, depth, score, flag, move) tuples
+class TranspositionTable:
+
+    def __init__(self, size=1 << 20):
+        # Rounded down to a power of two so the slot is a bit mask of the hash
+        self.size = 1 << (size.bit_length() - 1)
+        self.mask = self.size - 1
+        self.entries = [None] * self.size
+
+    def probe(self, key):
+        entry = self.entries[key & self.mask]
+        if entry is not None and entry[0] == key:
+            return entry
+        return None
+
+    # Deeper results for the same position are kept, any other position in the slot is replaced
+    def store(self, key, depth, score, flag, move):
+        index = key & self.mask
+        entry = self.entries[index]
+        if entry is None or entry[0] != key or depth >= entry[1]:
+            self.entries[index] = (key, depth, score, flag, move)
+
+    def clear(self):
+        self.entries = [None] * self.size
+
+class SearchTimeout(Exception):
+    pass
+
+# Helper function to run the steps of a search to the end and return its result
+def run_steps(steps):
+    try:
+        while True:
+            next(steps)
+    except StopIteration as stop:
+        return stop.value
+
+# Outcome of a search, move is in the (selected_piece, (row, col), special) form Game.update_state takes
+# and promotion holds the piece for Game.promote_to_piece when the move promotes
+class SearchResult:
+    __slots__ = ('move', 'promotion', 'score', 'depth', 'nodes', 'elapsed', 'pv')
+
+    def __init__(self, move, promotion, score, depth, nodes, elapsed, pv):
+        self.move = move
+        self.promotion = promotion
+        self.score = score
+        self.depth = depth
+        self.nodes = nodes
+        self.elapsed = elapsed
+        self.pv = pv
+
+    @property
+    def nodes_per_second(self):
+        return self.nodes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __repr__(self):
+        return f"SearchResult(depth={self.depth}, score={self.score}, nodes={self.nodes}, " \
+               f"nps={self.nodes_per_second:.0f}, pv={' '.join(self.pv)})"
+
+class Engine:
+
+    # tt can be any table with the TranspositionTable interface, such as a shared_table.SharedTranspositionTable.
+    # With a book.OpeningBook or tablebase.Tablebases, positions they hold are answered without searching
+    def __init__(self, tt_size=1 << 20, max_ply=128, tt=None, book=None, tablebases=None):
+        self.tt = TranspositionTable(tt_size) if tt is None else tt
+        self.book = book
+        self.tablebases = tablebases
+        self.max_ply = max_ply
+        self.killers = [[None, None] for _ in range(max_ply)]
+        self.history = {}
+        self.nodes = 0
+        self.max_nodes = None
+        self.deadline = None
+        self.can_stop = False
+        self.stop_event = None
+        # Nodes between budget checks minus one, and the end of the running slice of a sliced search
+        self.check_mask = 1023
+        self.slice_deadline = None
+        self.path = []
+        self.previous_positions = set()
+
+    # Forget everything learnt from earlier searches, e.g. between games
+    def new_game(self):
+        self.tt.clear()
+        self.history = {}
+
+    # Iterative deepening to max_depth, stopping early once max_nodes or max_time seconds are used up.
+    # The first iteration always completes so a legal move is returned whenever one exists.
+    # callback receives the SearchResult of every completed depth. Setting stop_event, a threading.Event,
+    # from another thread ends the search after its first depth with the result of the last completed depth
+    def search(self, game, max_depth=64, max_nodes=None, max_time=None, callback=None, stop_event=None):
+        start = time.perf_counter()
+        result = SearchResult(None, None, 0, 0, 0, 0.0, [])
+        for result in self.iterate_search(game, max_depth, max_nodes, max_time, stop_event):
+            if callback is not None and result.move is not None:
+                callback(result)
+        result.nodes = self.nodes
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    # Same search as a generator yielding the SearchResult of every completed depth. Ends with a result without a
+    # move when the game is already over. A book or tablebase move is a single result of depth 0, a tablebase win
+    # scores as the mate it leads to.
+    # With slice_time a caller without threads can also hand control back inside a depth, None is then yielded
+    # whenever the search has run for slice_time seconds and it carries on where it was once resumed
+    def iterate_search(self, game, max_depth=64, max_nodes=None, max_time=None, stop_event=None, slice_time=None):
+        known_move, score = None, 0
+        if self.book is not None:
+            known_move = self.book.choose(game)
+        if known_move is None and self.tablebases is not None and self.tablebases.probe_game(game) is not None:
+            found = self.tablebases.best_move(game.board, game.current_turn)
+            if found is not None:
+                known_move, (wdl, plies) = found
+                score = wdl * (MATE_SCORE - plies)
+        if known_move is not None:
+            self.nodes = 0
+            selected_piece, new_row, new_col, special, promotion = known_move
+            yield SearchResult((selected_piece, (new_row, new_col), special), promotion, score, 0, 0, 0.0,
+                               [move_string(selected_piece, new_row, new_col, promotion)])
+            return
+        # Searching on a copy leaves the game untouched even if the search is stopped part way
+        position = Game([row[:] for row in game.board], game._starting_player, game.current_turn,
+                        game.castling_rights, game.enpassant_square)
+        self.start_search(game.board_states, max_nodes, max_time, stop_event)
+        # Budget checks are made often enough for a slice to end within a few milliseconds of its time
+        self.check_mask = 1023 if slice_time is None else 63
+        start = time.perf_counter()
+        for depth in range(1, max_depth + 1):
+            self.can_stop = depth > 1
+            steps = self.search_root_steps(position, depth)
+            try:
+                while True:
+                    if slice_time is not None:
+                        self.slice_deadline = time.perf_counter() + slice_time
+                    next(steps)
+                    yield None
+            except StopIteration as stop:
+                score, best_move = stop.value
+            except SearchTimeout:
+                return
+            finally:
+                self.slice_deadline = None
+            elapsed = time.perf_counter() - start
+            if best_move is None:
+                # No legal moves, the game is already over
+                yield SearchResult(None, None, score, depth, self.nodes, elapsed, [])
+                return
+            selected_piece, new_row, new_col, special, promotion = best_move
+            yield SearchResult((selected_piece, (new_row, new_col), special), promotion, score, depth, self.nodes,
+                               elapsed, self.principal_variation(position, depth))
+            # A forced mate within the searched depth will not change with more depth
+            if abs(score) > MATE_BOUND:
+                return
+
+    # Resets the per-search state, positions since the last irreversible move of the game count as repetitions
+    def start_search(self, previous_positions, max_nodes=None, max_time=None, stop_event=None):
+        self.previous_positions = set(previous_positions)
+        self.path = []
+        self.killers = [[None, None] for _ in range(self.max_ply)]
+        self.nodes = 0
+        self.max_nodes = max_nodes
+        self.deadline = None if max_time is None else time.perf_counter() + max_time
+        self.stop_event = stop_event
+
+    def search_root(self, game, depth):
+        return run_steps(self.search_root_steps(game, depth))
+
+    def negamax(self, game, depth, alpha, beta, ply):
+        return run_steps(self.negamax_steps(game, depth, alpha, beta, ply))
+
+    # The search itself is written as generators that yield once a slice of a sliced search is used up, the
+    # wrappers above run them through for callers that do not slice
+    def search_root_steps(self, game, depth):
+        moves = generate_legal_moves(game.board, game.current_turn, game.enpassant_square, game.castling_rights)
+        if not moves:
+            in_check = len(calculate_pins_and_checks(game.board, game.current_turn)[1]) != 0
+            return (-MATE_SCORE if in_check else 0), None
+        entry = self.tt.probe(game.zobrist_hash)
+        moves = self.order_moves(game.board, moves, entry[4] if entry else None, 0)
+
+        alpha, beta = -INFINITY, INFINITY
+        best_move = moves[0]
+        self.path.append(game.zobrist_hash)
+        for move in moves:
+            undo = game.make_move(*move)
+            score = -(yield from self.negamax_steps(game, depth - 1, -beta, -alpha, 1))
+            game.unmake_move(undo)
+            if score > alpha:
+                alpha, best_move = score, move
+        self.path.pop()
+        self.tt.store(game.zobrist_hash, depth, alpha, EXACT, best_move)
+        return alpha, best_move
+
+    def negamax_steps(self, game, depth, alpha, beta, ply):
+        self.nodes += 1
+        if self.nodes & self.check_mask == 0:
+            self.check_budget()
+            if self.slice_deadline is not None and time.perf_counter() >= self.slice_deadline:
+                yield
+        key = game.zobrist_hash
+        if key in self.path or key in self.previous_positions:
+            return 0
+        if depth <= 0 or ply >= self.max_ply - 1:
+            return (yield from self.quiescence_steps(game, alpha, beta, ply))
+
+        entry = self.tt.probe(key)
+        tt_move = None
+        if entry is not None:
+            tt_move = entry[4]
+            if entry[1] >= depth:
+                score = score_from_table(entry[2], ply)
+                if entry[3] == EXACT:
+                    return score
+                if entry[3] == LOWER_BOUND and score >= beta:
+                    return score
+                if entry[3] == UPPER_BOUND and score <= alpha:
+                    return score
+
+        board = game.board
+        pin_info = calculate_pins_and_checks(board, game.current_turn)
+        in_check = len(pin_info[1]) != 0
+        moves = generate_legal_moves(board, game.current_turn, game.enpassant_square, game.castling_rights, pin_info)
+        if not moves:
+            return -MATE_SCORE + ply if in_check else 0
+        # Checks are searched one ply deeper so short mating sequences are not cut off at the horizon
+        if in_check:
+            depth += 1
+
+        original_alpha = alpha
+        best_score, best_move = -INFINITY, None
+        self.path.append(key)
+        for move in self.order_moves(board, moves, tt_move, ply):
+            capture = board[move[1]][move[2]] != ' ' or move[4] is not None
+            undo = game.make_move(*move)
+            score = -(yield from self.negamax_steps(game, depth - 1, -beta, -alpha, ply + 1))
+            game.unmake_move(undo)
+            if score > best_score:
+                best_score, best_move = score, move
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        if not capture and not move[3]:
+                            self.record_cutoff(board, move, depth, ply)
+                        break
+        self.path.pop()
+
+        if best_score <= original_alpha:
+            flag = UPPER_BOUND
+        elif best_score >= beta:
+            flag = LOWER_BOUND
+        else:
+            flag = EXACT
+        self.tt.store(key, depth, score_to_table(best_score, ply), flag, best_move)
+        return best_score
+
+    # Only captures and promotions are searched past the horizon, the side to move may also stand pat
+    def quiescence_steps(self, game, alpha, beta, ply):
+        self.nodes += 1
+        if self.nodes & self.check_mask == 0:
+            self.check_budget()
+            if self.slice_deadline is not None and time.perf_counter() >= self.slice_deadline:
+                yield
+        board = game.board
+        # The evaluation is kept up to date by every make_move, so standing pat costs no board scan
+        stand_pat = score_evaluation(game.evaluation) if game.current_turn else -score_evaluation(game.evaluation)
+        if stand_pat >= beta:
+            return stand_pat
+        if stand_pat > alpha:
+            alpha = stand_pat
+
+        moves = generate_legal_moves(board, game.current_turn, game.enpassant_square, game.castling_rights)
+        captures = [move for move in moves if board[move[1]][move[2]] != ' ' or move[4] in ('Q', 'q')
+                    or (move[3] and board[move[0][0]][move[0][1]] in ('P', 'p'))]
+        for move in self.order_moves(board, captures, None, ply):
+            undo = game.make_move(*move)
+            score = -(yield from self.quiescence_steps(game, -beta, -alpha, ply + 1))
+            game.unmake_move(undo)
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    def order_moves(self, board, moves, tt_move, ply):
+        killers = self.killers[ply] if ply < self.max_ply else [None, None]
+        history = self.history
+        scored = []
+        for move in moves:
+            selected_piece, new_row, new_col, special, promotion = move
+            piece = board[selected_piece[0]][selected_piece[1]]
+            victim = board[new_row][new_col]
+            if move == tt_move:
+                score = 1000000
+            elif victim != ' ':
+                # Most valuable victim first, cheapest attacker breaking ties
+                score = 100000 + PIECE_VALUES[victim.upper()] * 10 - PIECE_VALUES[piece.upper()] // 100
+            elif promotion is not None:
+                score = 100000 + PIECE_VALUES[promotion.upper()]
+            elif special and piece in ('P', 'p'):
+                score = 100000 + PIECE_VALUES['P'] * 10
+            elif move == killers[0] or move == killers[1]:
+                score = 90000
+            else:
+                score = history.get((piece, new_row, new_col), 0)
+            scored.append((score, move))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [move for _, move in scored]
+
+    # Quiet moves causing a beta cutoff are remembered per ply and rewarded in the history table
+    def record_cutoff(self, board, move, depth, ply):
+        killers = self.killers[ply]
+        if killers[0] != move:
+            killers[1] = killers[0]
+            killers[0] = move
+        piece = board[move[0][0]][move[0][1]]
+        key = (piece, move[1], move[2])
+        self.history[key] = self.history.get(key, 0) + depth * depth
+
+    def check_budget(self):
+        if not self.can_stop:
+            return
+        if self.stop_event is not None and self.stop_event.is_set():
+            raise SearchTimeout()
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            raise SearchTimeout()
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            raise SearchTimeout()
+
+    # Follows the table moves from the root, each one checked for legality as table slots can be overwritten
+    def principal_variation(self, game, depth):
+        pv, undos, seen = [], [], set()
+        while len(pv) < depth and game.zobrist_hash not in seen:
+            seen.add(game.zobrist_hash)
+            entry = self.tt.probe(game.zobrist_hash)
+            if entry is None or entry[4] is None:
+                break
+            move = entry[4]
+            if move not in generate_legal_moves(game.board, game.current_turn, game.enpassant_square, game.castling_rights):
+                break
+            pv.append(move_string(move[0], move[1], move[2], move[4]))
+            undos.append(game.make_move(*move))
+        for undo in reversed(undos):
+            game.unmake_move(undo)
+        return pv
+
+# Helper functions to store mate scores relative to the node and read them back relative to the root
+def score_to_table(score, ply):
+    if score > MATE_BOUND:
+        return score + ply
+    if score < -MATE_BOUND:
+        return score - ply
+    return score
+
+def score_from_table(score, ply):
+    if score > MATE_BOUND:
+        return score - ply
+    if score < -MATE_BOUND:
+        return score + ply
+    return score
+
+# Helper function to pick a move for a game with a fresh engine
+def find_best_move(game, max_depth=64, max_nodes=None, max_time=None):
+    return Engine().search(game, max_depth, max_nodes, max_time)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Search a position and print each completed depth')
+    parser.add_argument('--fen', default='rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1')
+    parser.add_argument('--depth', type=int, default=64)
+    parser.add_argument('--nodes', type=int, help='node budget')
+    parser.add_argument('--time', type=float, default=5.0, help='time budget in seconds')
+    parser.add_argument('--book', help='opening book file built by book.py')
+    parser.add_argument('--tablebases', help='directory of tablebases generated by tablebase.py')
+    args = parser.parse_args()
+
+    def report(result):
+        print(f"depth {result.depth:>2}  score {result.score:>7}  nodes {result.nodes:>9}  "
+              f"nps {result.nodes_per_second:>7.0f}  time {result.elapsed:>6.2f}  pv {' '.join(result.pv)}")
+
+    book = None if args.book is None else OpeningBook(args.book)
+    tablebases = None if args.tablebases is None else Tablebases(args.tablebases)
+    result = Engine(book=book, tablebases=tablebases).search(game_from_fen(args.fen), args.depth, args.nodes, args.time, report)
+    print(f"bestmove {move_string(result.move[0], *result.move[1], result.promotion) if result.move else '(none)'}")
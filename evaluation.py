@@ -0,0 +1,142 @@
+from rules import CASTLE_ROOK_MOVES
+
+## Evaluation
+# Material and piece-square scores for the middlegame and the endgame, blended by the game phase. A position's
+# three terms are packed into one integer and every piece on every square has a packed value, so a move changes
+# the evaluation by adding and subtracting the values of the squares it touches instead of rescanning the board.
+# Game keeps the packed evaluation next to its Zobrist hash and updates it the same way
+
+PIECE_VALUES = {'P': 100, 'N': 320, 'B': 330, 'R': 500, 'Q': 900, 'K': 0}
+
+# Middlegame piece-square tables from white's side, row 0 is the eighth rank like the board
+PIECE_SQUARE_TABLES = {
+    'P': [[0, 0, 0, 0, 0, 0, 0, 0],
+          [50, 50, 50, 50, 50, 50, 50, 50],
+          [10, 10, 20, 30, 30, 20, 10, 10],
+          [5, 5, 10, 25, 25, 10, 5, 5],
+          [0, 0, 0, 20, 20, 0, 0, 0],
+          [5, -5, -10, 0, 0, -10, -5, 5],
+          [5, 10, 10, -20, -20, 10, 10, 5],
+          [0, 0, 0, 0, 0, 0, 0, 0]],
+    'N': [[-50, -40, -30, -30, -30, -30, -40, -50],
+          [-40, -20, 0, 0, 0, 0, -20, -40],
+          [-30, 0, 10, 15, 15, 10, 0, -30],
+          [-30, 5, 15, 20, 20, 15, 5, -30],
+          [-30, 0, 15, 20, 20, 15, 0, -30],
+          [-30, 5, 10, 15, 15, 10, 5, -30],
+          [-40, -20, 0, 5, 5, 0, -20, -40],
+          [-50, -40, -30, -30, -30, -30, -40, -50]],
+    'B': [[-20, -10, -10, -10, -10, -10, -10, -20],
+          [-10, 0, 0, 0, 0, 0, 0, -10],
+          [-10, 0, 5, 10, 10, 5, 0, -10],
+          [-10, 5, 5, 10, 10, 5, 5, -10],
+          [-10, 0, 10, 10, 10, 10, 0, -10],
+          [-10, 10, 10, 10, 10, 10, 10, -10],
+          [-10, 5, 0, 0, 0, 0, 5, -10],
+          [-20, -10, -10, -10, -10, -10, -10, -20]],
+    'R': [[0, 0, 0, 0, 0, 0, 0, 0],
+          [5, 10, 10, 10, 10, 10, 10, 5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [0, 0, 0, 5, 5, 0, 0, 0]],
+    'Q': [[-20, -10, -10, -5, -5, -10, -10, -20],
+          [-10, 0, 0, 0, 0, 0, 0, -10],
+          [-10, 0, 5, 5, 5, 5, 0, -10],
+          [-5, 0, 5, 5, 5, 5, 0, -5],
+          [0, 0, 5, 5, 5, 5, 0, -5],
+          [-10, 5, 5, 5, 5, 5, 0, -10],
+          [-10, 0, 5, 0, 0, 0, 0, -10],
+          [-20, -10, -10, -5, -5, -10, -10, -20]],
+    'K': [[-30, -40, -40, -50, -50, -40, -40, -30],
+          [-30, -40, -40, -50, -50, -40, -40, -30],
+          [-30, -40, -40, -50, -50, -40, -40, -30],
+          [-30, -40, -40, -50, -50, -40, -40, -30],
+          [-20, -30, -30, -40, -40, -30, -30, -20],
+          [-10, -20, -20, -20, -20, -20, -20, -10],
+          [20, 20, 0, 0, 0, 0, 20, 20],
+          [20, 30, 10, 0, 0, 10, 30, 20]],
+}
+
+# Endgame tables where they differ: passed pawns grow in value as they advance and the king moves to the centre
+ENDGAME_SQUARE_TABLES = dict(PIECE_SQUARE_TABLES)
+ENDGAME_SQUARE_TABLES['P'] = [[0] * 8, [80] * 8, [50] * 8, [30] * 8, [20] * 8, [10] * 8, [10] * 8, [0] * 8]
+ENDGAME_SQUARE_TABLES['K'] = [[-50, -40, -30, -20, -20, -30, -40, -50],
+                              [-30, -20, -10, 0, 0, -10, -20, -30],
+                              [-30, -10, 20, 30, 30, 20, -10, -30],
+                              [-30, -10, 30, 40, 40, 30, -10, -30],
+                              [-30, -10, 30, 40, 40, 30, -10, -30],
+                              [-30, -10, 20, 30, 30, 20, -10, -30],
+                              [-30, -30, 0, 0, 0, 0, -30, -30],
+                              [-50, -30, -30, -30, -30, -30, -30, -50]]
+
+# The phase counts the minor and major pieces left, from 24 with all of them down to 0 in a pawn ending
+PHASE_WEIGHTS = {'P': 0, 'N': 1, 'B': 1, 'R': 2, 'Q': 4, 'K': 0}
+MAX_PHASE = 24
+
+# Helper functions to pack the middlegame score, endgame score and phase into one integer and back,
+# the scores may be negative so each 32-bit field is read back as signed
+def pack_evaluation(middlegame, endgame, phase=0):
+    return middlegame + (endgame << 32) + (phase << 64)
+
+def unpack_evaluation(evaluation):
+    middlegame = ((evaluation + (1 << 31)) & 0xFFFFFFFF) - (1 << 31)
+    evaluation = (evaluation - middlegame) >> 32
+    endgame = ((evaluation + (1 << 31)) & 0xFFFFFFFF) - (1 << 31)
+    return middlegame, endgame, (evaluation - endgame) >> 32
+
+# Packed value of every piece on every square indexed by row * 8 + col, positive for white and negative for
+# black. An empty square is worth nothing so captures of ' ' need no check
+SQUARE_SCORES = {' ': [0] * 64}
+for _piece in PIECE_VALUES:
+    _phase = PHASE_WEIGHTS[_piece]
+    SQUARE_SCORES[_piece] = [pack_evaluation(PIECE_VALUES[_piece] + PIECE_SQUARE_TABLES[_piece][row][col],
+                                             PIECE_VALUES[_piece] + ENDGAME_SQUARE_TABLES[_piece][row][col], _phase)
+                             for row in range(8) for col in range(8)]
+    SQUARE_SCORES[_piece.lower()] = [pack_evaluation(-PIECE_VALUES[_piece] - PIECE_SQUARE_TABLES[_piece][7 - row][col],
+                                                     -PIECE_VALUES[_piece] - ENDGAME_SQUARE_TABLES[_piece][7 - row][col],
+                                                     _phase)
+                                     for row in range(8) for col in range(8)]
+
+# Helper function to evaluate a board from scratch, the reference the incremental updates are checked against
+def board_evaluation(board):
+    evaluation = 0
+    for row in range(8):
+        rank = board[row]
+        for col in range(8):
+            evaluation += SQUARE_SCORES[rank[col]][row * 8 + col]
+    return evaluation
+
+# Helper function to compute the change in evaluation of a move already played by make_board_move
+def evaluation_delta(board, undo):
+    selected_piece, new_row, new_col, piece, captured, special_string = undo
+    start_row, start_col = selected_piece
+    end = new_row * 8 + new_col
+    # The placed piece differs from the moved piece on promotions
+    delta = SQUARE_SCORES[board[new_row][new_col]][end] - SQUARE_SCORES[piece][start_row * 8 + start_col]
+    if special_string == 'enpassant':
+        delta -= SQUARE_SCORES[captured][start_row * 8 + new_col]
+    else:
+        delta -= SQUARE_SCORES[captured][end]
+        if special_string == 'castle':
+            rook_start, rook_end = CASTLE_ROOK_MOVES[(new_row, new_col)]
+            rook = SQUARE_SCORES['R' if piece == 'K' else 'r']
+            delta += rook[rook_end[0] * 8 + rook_end[1]] - rook[rook_start[0] * 8 + rook_start[1]]
+    return delta
+
+# Score in centipawns from white's side of a packed evaluation, tapered between the middlegame and endgame
+def score_evaluation(evaluation):
+    middlegame, endgame, phase = unpack_evaluation(evaluation)
+    if phase > MAX_PHASE:
+        phase = MAX_PHASE
+    return (middlegame * phase + endgame * (MAX_PHASE - phase)) // MAX_PHASE
+
+# Helper function to score a board in centipawns from white's side without the incremental state
+def evaluate(board):
+    return score_evaluation(board_evaluation(board))
+
+# Helper function for debugging, True when a game's incrementally kept evaluation matches its board
+def evaluation_matches(game):
+    return game.evaluation == board_evaluation(game.board)
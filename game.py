@@ -1,8 +1,11 @@
-from helpers import *
+from rules import *
+from zobrist import *
+from evaluation import *
+from analysis import analyse_position
 
 class Game:
 
-    def __init__(self, board, starting_player, current_turn=True):
+    def __init__(self, board, starting_player, current_turn=True, castling_rights=ALL_CASTLING_RIGHTS, enpassant_square=None):
         # current_turn = True for white, False for black, the final version will always default to True for new games, but for now we keep it like this
         self.current_turn = current_turn
         self.board = board
@@ -16,16 +19,28 @@ class Game:
             'left_black_rook_moved' : False,
             'right_black_rook_moved' : False
         }
+        # Positions set up mid-game (FEN, analysis) may start without some castling rights
+        for key, right in [('right_white_rook_moved', WHITE_KING_SIDE), ('left_white_rook_moved', WHITE_QUEEN_SIDE),
+                           ('right_black_rook_moved', BLACK_KING_SIDE), ('left_black_rook_moved', BLACK_QUEEN_SIDE)]:
+            self.castle_attributes[key] = not castling_rights & right
+        # En passant target square and packed castling rights of the current position, the previous values and
+        # castle attributes are stacked on every move so undo_move can restore them without rescanning the move history
+        self.enpassant_square = enpassant_square
+        self.castling_rights = castling_rights
+        self._position_states = []
         self.current_position = None
         self.previous_position = None
-        # Appending an empty set of special states and initialised castling states to rows of board row tuples
-        _current_board_state = tuple(tuple(row) for row in board)
-        _current_board_state = _current_board_state + ((),) # Empty set of specials
-        _current_board_state = _current_board_state + (tuple(self.castle_attributes.values()),)
-        self.board_states = { _current_board_state: 1}
-        # Apparently highest move count for a legal game so far is like 269 moves, not sure if only for one player or not
-        # hence 500 is reasonable
-        self.max_states = 500 
+        # Board states are keyed by the Zobrist hash of the position, which covers the pieces, side to move,
+        # castling rights and a usable en passant file, and is updated per move instead of rescanning the board
+        self.zobrist_hash = hash_position(board, current_turn, self.castling_rights, self.enpassant_square)
+        # Only positions since the last irreversible move (pawn move, capture or loss of castling rights) can repeat,
+        # so board_states holds just those and the earlier dictionaries are stacked for undo_move to bring back.
+        # max_repetitions is the highest count in board_states, kept per move so threefold_check is constant time
+        self.board_states = {self.zobrist_hash: 1}
+        self._previous_board_states = []
+        # Packed material, piece-square and phase evaluation of the board, updated per move like the hash
+        self.evaluation = board_evaluation(board)
+        self.max_repetitions = 1
         self.end_position = False
         self.forced_end = ""
         self._debug = False # Dev private attribute for removing turns, need to remove network with this option initialised somewhere else in the main loop
@@ -39,9 +54,16 @@ class Game:
         self.moves = new_game.moves
         self.alg_moves = new_game.alg_moves
         self.castle_attributes = new_game.castle_attributes
+        self.enpassant_square = new_game.enpassant_square
+        self.castling_rights = new_game.castling_rights
+        self._position_states = new_game._position_states
+        self.zobrist_hash = new_game.zobrist_hash
+        self.evaluation = new_game.evaluation
         self.current_position = new_game.current_position
         self.previous_position = new_game.previous_position
         self.board_states = new_game.board_states
+        self._previous_board_states = new_game._previous_board_states
+        self.max_repetitions = new_game.max_repetitions
         self.end_position = new_game.end_position
         self.forced_end = new_game.forced_end
         self._move_undone = False
@@ -54,8 +76,7 @@ class Game:
         # Special moves
         enpassant, castle, special_string = False, False, ''
         if special and (new_row, new_col) not in [(7, 2), (7, 6), (0, 2), (0, 6)]:
-            capture_row = 3 if new_row == 2 else 4
-            potential_capture = self.board[capture_row][new_col]
+            potential_capture = self.board[selected_piece[0]][new_col]
             enpassant = True
             special_string = 'enpassant'
         elif special:
@@ -65,30 +86,31 @@ class Game:
         # Need to calculate alg_moves before we update board to settle disambiguities
         algebraic_move = self.translate_into_notation(new_row, new_col, piece, selected_piece, potential_capture, castle, enpassant)
 
-        self.board[new_row][new_col] = piece
-        self.board[selected_piece[0]][selected_piece[1]] = ' '
+        self._position_states.append((self.enpassant_square, self.castling_rights, tuple(self.castle_attributes.values()), self.zobrist_hash, self.evaluation, self.max_repetitions))
+        previous_rights = self.castling_rights
+        previous_enpassant_key = enpassant_key(self.board, self.enpassant_square)
+        board_undo = make_board_move(self.board, selected_piece, new_row, new_col, special_string)
+        self.advance_position_state(board_undo, previous_enpassant_key)
         self.current_position = (new_row, new_col)
         self.previous_position = (selected_piece[0], selected_piece[1])
-        
-        if enpassant:
-            self.board[capture_row][new_col] = ' '
-        elif castle:
-            if (new_row, new_col) == (7, 2):
-                self.board[7][3] = 'R'
-                self.board[7][0] = ' '
-            elif (new_row, new_col) == (7, 6):
-                self.board[7][5] = 'R'
-                self.board[7][7] = ' '
-            elif (new_row, new_col) == (0, 2):
-                self.board[0][3] = 'r'
-                self.board[0][0] = ' '
-            elif (new_row, new_col) == (0, 6):
-                self.board[0][5] = 'r'
-                self.board[0][7] = ' '
 
         self.moves.append(output_move(piece, selected_piece, new_row, new_col, potential_capture, special_string))
         self.alg_moves.append(algebraic_move)
 
+        self.update_castle_attributes(piece, selected_piece)
+
+        if not self._debug:
+            # Change turns once a standard move is played, not during a pawn promotion
+            if piece.lower() != 'p' or (piece.lower() == 'p' and (new_row != 7 and new_row != 0)):
+                self.current_turn = not self.current_turn
+                self._move_undone = False
+                self._sync = True
+                
+                # Update dictionary of board states
+                irreversible = piece.lower() == 'p' or potential_capture != ' ' or self.castling_rights != previous_rights
+                self.record_position(irreversible)
+
+    def update_castle_attributes(self, piece, selected_piece):
         if piece == 'K' and selected_piece == (7, 4) and not self.castle_attributes['white_king_moved']:
             self.castle_attributes['white_king_moved'] = True
         elif piece == 'k' and selected_piece == (0, 4) and not self.castle_attributes['black_king_moved']:
@@ -102,47 +124,68 @@ class Game:
         elif piece == 'r' and selected_piece == (0, 7) and not self.castle_attributes['right_black_rook_moved']:
             self.castle_attributes['right_black_rook_moved'] = True
 
-        if not self._debug:
-            # Change turns once a standard move is played, not during a pawn promotion
-            if piece.lower() != 'p' or (piece.lower() == 'p' and (new_row != 7 and new_row != 0)):
-                self.current_turn = not self.current_turn
-                self._move_undone = False
-                self._sync = True
-                
-                # Update dictionary of board states
-                current_special_moves = []
-                for row in range(8):
-                    for col in range(8):
-                        other_piece = self.board[row][col]
-                        if other_piece.islower() != piece.islower() and other_piece != ' ':
-                            _, _, specials = calculate_moves(self.board, row, col, self.moves, self.castle_attributes, True) 
-                            current_special_moves.extend(specials)
-                _current_board_state = tuple(tuple(r) for r in self.board)
-                _current_board_state = _current_board_state + (tuple(current_special_moves),)
-                _current_board_state = _current_board_state + (tuple(self.castle_attributes.values()),)
-                
-                if _current_board_state in self.board_states:
-                    self.board_states[_current_board_state] += 1
-                else:
-                    self.board_states[_current_board_state] = 1
-                    if len(self.board_states) > self.max_states:
-                        # Find and remove the least accessed board state, this also happens to be the oldest 
-                        # least accessed state based on Python 3.7+ storing dictionary items by insertion order
-                        least_accessed = min(self.board_states, key=self.board_states.get)
-                        del self.board_states[least_accessed]
+    # Updates the en passant square, castling rights, position hash and evaluation after make_board_move, only the
+    # keys and values of the squares and state the move touched are applied so this is constant time
+    def advance_position_state(self, board_undo, previous_enpassant_key):
+        selected_piece, new_row, new_col, piece = board_undo[:4]
+        previous_rights = self.castling_rights
+        self.enpassant_square, self.castling_rights = \
+            next_position_state(piece, selected_piece, new_row, new_col, previous_rights)
+        self.zobrist_hash ^= hash_board_move(self.board, board_undo) ^ SIDE_KEY \
+            ^ previous_enpassant_key ^ enpassant_key(self.board, self.enpassant_square) \
+            ^ CASTLING_KEYS[previous_rights] ^ CASTLING_KEYS[self.castling_rights]
+        self.evaluation += evaluation_delta(self.board, board_undo)
+
+    # Reversible move primitive for legality probes and search. The move is played in place without notation,
+    # board states or promotion prompts, and unmake_move restores everything from the returned undo record
+    def make_move(self, selected_piece, new_row, new_col, special=False, promotion=None):
+        piece = self.board[selected_piece[0]][selected_piece[1]]
+        special_string = ''
+        if special:
+            special_string = 'enpassant' if (new_row, new_col) not in [(7, 2), (7, 6), (0, 2), (0, 6)] else 'castle'
+
+        state_undo = (self.enpassant_square, self.castling_rights, self.zobrist_hash, self.evaluation)
+        previous_enpassant_key = enpassant_key(self.board, self.enpassant_square)
+        board_undo = make_board_move(self.board, selected_piece, new_row, new_col, special_string, promotion)
+        move = output_move(piece, selected_piece, new_row, new_col, board_undo[4], special_string)
+        if promotion is not None:
+            move[1] = promotion + move[1][1:]
+        self.moves.append(move)
+
+        castle_undo = tuple(self.castle_attributes.values())
+        self.update_castle_attributes(piece, selected_piece)
+        self.advance_position_state(board_undo, previous_enpassant_key)
+        self.current_turn = not self.current_turn
+        return board_undo, castle_undo, state_undo
+
+    def unmake_move(self, undo):
+        board_undo, castle_undo, state_undo = undo
+        unmake_board_move(self.board, board_undo)
+        self.enpassant_square, self.castling_rights, self.zobrist_hash, self.evaluation = state_undo
+        for key, value in zip(list(self.castle_attributes), castle_undo):
+            self.castle_attributes[key] = value
+        self.moves.pop()
+        self.current_turn = not self.current_turn
 
     def translate_into_notation(self, new_row, new_col, piece, selected_piece, potential_capture, castle, enpassant):
         file_conversion = {0: 'a', 1: 'b', 2: 'c', 3: 'd', 4: 'e', 5: 'f', 6: 'g', 7: 'h'}
         rank_conversion = {i: str(8 - i) for i in range(8)}
         alg_move = ''
         is_white = piece.isupper()
+
+        # We haven't moved yet so the move is played in place for the state check and undone straight after,
+        # the analysis stays cached for the end-of-game check once the move is made
+        undo = self.make_move(selected_piece, new_row, new_col, special=castle or enpassant)
+        analysis = analyse_position(self, not is_white)
+        check_suffix = '#' if analysis.checkmate else '+' if analysis.in_check else ''
+        self.unmake_move(undo)
         
         # Castling
         if castle:
             if (new_row, new_col) == (7, 2) or (new_row, new_col) == (0, 2):
-                return '0-0-0'
+                return '0-0-0' + check_suffix
             elif (new_row, new_col) == (7, 6) or (new_row, new_col) == (0, 6):
-                return '0-0'
+                return '0-0' + check_suffix
 
         # Don't add pawns to the move
         if piece.upper() != 'P':
@@ -154,7 +197,7 @@ class Game:
             for col in range(8):
                 other_piece = self.board[row][col]
                 if other_piece == piece and (row, col) != selected_piece:
-                    other_moves, _, _ = calculate_moves(self.board, row, col, self.moves)
+                    other_moves, _, _ = calculate_moves(self.board, row, col)
                     if (new_row, new_col) in other_moves:
                         similar_pieces.append((row,col))
         
@@ -186,22 +229,7 @@ class Game:
         # Destination
         alg_move += str(file_conversion[new_col]) + str(rank_conversion[new_row])
 
-        # We haven't moved yet so temp board for state check
-        temp_board = [rank[:] for rank in self.board]  
-        temp_moves = self.moves.copy()
-        temp_moves.append(output_move(piece, selected_piece, new_row, new_col, potential_capture))
-        temp_board[new_row][new_col] = temp_board[selected_piece[0]][selected_piece[1]]
-        temp_board[selected_piece[0]][selected_piece[1]] = ' '
-        
-        if enpassant:
-            capture_row = 4 if new_row == 3 else 5
-            temp_board[capture_row][new_col] = ' '
-        if is_checkmate_or_stalemate(temp_board, not is_white, self.moves)[0]:
-            alg_move += '#'
-        elif is_check(temp_board, not is_white, temp_moves):
-            alg_move += '+'
-
-        return alg_move
+        return alg_move + check_suffix
 
     def add_end_game_notation(self, checkmate):
         if not self._debug:
@@ -214,8 +242,12 @@ class Game:
                 print('ALG_MOVES: ', self.alg_moves)
 
     def promote_to_piece(self, current_row, current_col, piece):
-        # Update board
+        # Update board and swap the pawn for the promoted piece in the hash and evaluation
+        pawn = self.board[current_row][current_col]
         self.board[current_row][current_col] = piece
+        self.zobrist_hash ^= piece_key(pawn, current_row, current_col) ^ piece_key(piece, current_row, current_col)
+        square = current_row * 8 + current_col
+        self.evaluation += SQUARE_SCORES[piece][square] - SQUARE_SCORES[pawn][square]
         
         is_white = piece.isupper()
         
@@ -226,9 +258,10 @@ class Game:
  
         self.alg_moves[-1] += piece.upper()
         
-        if is_checkmate_or_stalemate(self.board, not is_white, self.moves)[0]:
+        analysis = analyse_position(self, not is_white)
+        if analysis.checkmate:
             self.alg_moves[-1] += 'X'
-        elif is_check(self.board, not is_white, self.moves):
+        elif analysis.in_check:
             self.alg_moves[-1] += 'x'
         
         # Change turns after pawn promotion
@@ -236,57 +269,38 @@ class Game:
             self.current_turn = not self.current_turn
             self._move_undone = False
             self._sync = True
-            # Update dictionary of board states
-            current_special_moves = []
-            for row in range(8):
-                for col in range(8):
-                    other_piece = self.board[row][col]
-                    if other_piece.islower() != piece.islower() and other_piece != ' ':
-                        _, _, specials = calculate_moves(self.board, row, col, self.moves, self.castle_attributes, True) 
-                        current_special_moves.extend(specials)
-            _current_board_state = tuple(tuple(r) for r in self.board)
-            _current_board_state = _current_board_state + (tuple(current_special_moves),)
-            _current_board_state = _current_board_state + (tuple(self.castle_attributes.values()),)
-            
-            if _current_board_state in self.board_states:
-                self.board_states[_current_board_state] += 1
-            else:
-                self.board_states[_current_board_state] = 1
-                if len(self.board_states) > self.max_states:
-                    # Find and remove the least accessed board state, this also happens to be the oldest 
-                    # least accessed state based on Python 3.7+ storing dictionary items by insertion order
-                    least_accessed = min(self.board_states, key=self.board_states.get)
-                    del self.board_states[least_accessed]
+            # Update dictionary of board states, a promotion is a pawn move so nothing before it can repeat
+            self.record_position(True)
             
         print("ALG_MOVES:", self.alg_moves)
 
+    # Counts the current position, an irreversible move starts a fresh set of repetition candidates
+    def record_position(self, irreversible):
+        if irreversible:
+            self._previous_board_states.append(self.board_states)
+            self.board_states = {}
+            self.max_repetitions = 0
+        count = self.board_states.get(self.zobrist_hash, 0) + 1
+        self.board_states[self.zobrist_hash] = count
+        if count > self.max_repetitions:
+            self.max_repetitions = count
+
     def threefold_check(self):
-        for count in self.board_states.values():
-            if count >= 3:
-                return True
-        return False
+        return self.max_repetitions >= 3
 
     def undo_move(self):
         # In an advanced system with an analysis/exploration board we would have multiple saved move lists or games somehow
         if len(self.moves) != 0:
             # If we are not undoing a move during pawn promotion the current state of the board is saved, else skip
             if 'p' not in self.board[7] and 'P' not in self.board[0]:
-                # Deincrement or remove current state from dictionary of board states
-                current_special_moves = []
-                for row in range(8):
-                    for col in range(8):
-                        current_piece = self.board[row][col]
-                        if current_piece.islower() != self.current_turn and current_piece != ' ':
-                            _, _, specials = calculate_moves(self.board, row, col, self.moves, self.castle_attributes, True) 
-                            current_special_moves.extend(specials)
-                _current_board_state = tuple(tuple(r) for r in self.board)
-                _current_board_state = _current_board_state + (tuple(current_special_moves),)
-                _current_board_state = _current_board_state + (tuple(self.castle_attributes.values()),)
-                
-                if self.board_states[_current_board_state] == 1:
-                    del self.board_states[_current_board_state]
+                # Deincrement or remove current state from dictionary of board states, undoing an irreversible
+                # move empties them and the positions before it become repetition candidates again
+                if self.board_states[self.zobrist_hash] == 1:
+                    del self.board_states[self.zobrist_hash]
+                    if len(self.board_states) == 0:
+                        self.board_states = self._previous_board_states.pop()
                 else:
-                    self.board_states[_current_board_state] -= 1
+                    self.board_states[self.zobrist_hash] -= 1
             
             move = self.moves[-1]
 
@@ -329,6 +343,10 @@ class Game:
             
             del self.moves[-1]
             del self.alg_moves[-1]
+            if len(self._position_states) != 0:
+                self.enpassant_square, self.castling_rights, castle_values, self.zobrist_hash, self.evaluation, self.max_repetitions = self._position_states.pop()
+                for key, value in zip(list(self.castle_attributes), castle_values):
+                    self.castle_attributes[key] = value
             self._move_undone = True
             self._sync = False
 
@@ -352,3 +370,8 @@ class Game:
             else:
                 self.current_position = None
                 self.previous_position = None
+
+# Helper function to set up a game from a FEN string, the side to move also views the board from its side
+def game_from_fen(fen):
+    board, is_white_turn, castling_rights, enpassant_square = parse_fen(fen)
+    return Game(board, is_white_turn, is_white_turn, castling_rights, enpassant_square)
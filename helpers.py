@@ -1,6 +1,8 @@
 import pygame
 import sys
+import asyncio
 from constants import *
+from rules import *
 
 ## General Helpers
 # Helper function to dynamically generate keys between board conventions and image naming to avoid a hardcoded mapping
@@ -26,440 +28,6 @@ def load_piece_image(piece, GRID_SIZE):
 
     return img, transparent_surface
 
-# Helper function for generating bespoke Game moves
-def output_move(piece, selected_piece, new_row, new_col, potential_capture, special_string= ''):
-    return [piece+str(selected_piece[0])+str(selected_piece[1]), piece+str(new_row)+str(new_col), potential_capture, special_string]
-
-## Move logic
-# Helper function to calculate moves for a pawn
-def pawn_moves(board, row, col, is_white):
-    moves = []
-    captures = []
-
-    # Pawn moves one square forward
-    if is_white:
-        if row > 0 and board[row - 1][col] == ' ':
-            moves.append((row - 1, col))
-    else:
-        if row < 7 and board[row + 1][col] == ' ':
-            moves.append((row + 1, col))
-
-    # Pawn's initial double move
-    if is_white:
-        if row == 6 and board[row - 1][col] == ' ' \
-                    and board[row - 2][col] == ' ':
-            moves.append((row - 2, col))
-    else:
-        if row == 1 and board[row + 1][col] == ' ' \
-                    and board[row + 2][col] == ' ':
-            moves.append((row + 2, col))
-
-    # No captures possible when pawns reach the end, otherwise list index out of range
-    if is_white and row == 0 or not is_white and row == 7:
-        return moves, captures
-
-    # Pawn captures diagonally
-    forwards = -1 if is_white else 1 # The forward direction for white is counting down rows
-    if row > 0 and col > 0 and board[row + forwards][col - 1] != ' ' and \
-        board[row + forwards][col - 1].islower() == is_white:
-        moves.append((row + forwards, col - 1))
-        captures.append((row + forwards, col - 1))
-    if row > 0 and col < 7 and board[row + forwards][col + 1] != ' ' \
-        and board[row + forwards][col + 1].islower() == is_white:
-        moves.append((row + forwards, col + 1))
-        captures.append((row + forwards, col + 1))
-    
-    # Edge case diagonal captures
-    if row > 0 and col == 7 and board[row + forwards][col - 1] != ' ' \
-        and board[row + forwards][col - 1].islower() == is_white:
-        moves.append((row + forwards, col - 1))
-        captures.append((row + forwards, col - 1))
-    if row > 0 and col == 0 and board[row + forwards][col + 1] != ' ' \
-        and board[row + forwards][col + 1].islower() == is_white:
-        moves.append((row + forwards, col + 1))
-        captures.append((row + forwards, col + 1))
-
-    return moves, captures
-
-# Helper function to calculate moves for a rook
-def rook_moves(board, row, col, is_white):
-    moves = []
-    captures = []
-
-    # Rook moves horizontally
-    for i in range(col + 1, 8):
-        if board[row][i] == ' ':
-            moves.append((row, i))
-        else:
-            if board[row][i].islower() == is_white:
-                moves.append((row, i))
-                captures.append((row, i))
-            break
-
-    for i in range(col - 1, -1, -1):
-        if board[row][i] == ' ':
-            moves.append((row, i))
-        else:
-            if board[row][i].islower() == is_white:
-                moves.append((row, i))
-                captures.append((row, i))
-            break
-
-    # Rook moves vertically
-    for i in range(row + 1, 8):
-        if board[i][col] == ' ':
-            moves.append((i, col))
-        else:
-            if board[i][col].islower() == is_white:
-                moves.append((i, col))
-                captures.append((i, col))
-            break
-
-    for i in range(row - 1, -1, -1):
-        if board[i][col] == ' ':
-            moves.append((i, col))
-        else:
-            if board[i][col].islower() == is_white:
-                moves.append((i, col))
-                captures.append((i, col))
-            break
-
-    return moves, captures
-
-# Helper function to calculate moves for a knight
-def knight_moves(board, row, col, is_white):
-    moves = []
-    captures = []
-
-    knight_moves = [(row - 2, col - 1), (row - 2, col + 1), (row - 1, col - 2), (row - 1, col + 2),
-                    (row + 1, col - 2), (row + 1, col + 2), (row + 2, col - 1), (row + 2, col + 1)]
-
-    # Remove moves that are out of bounds
-    valid_knight_moves = [(move[0], move[1]) for move in knight_moves if 0 <= move[0] < 8 and 0 <= move[1] < 8]
-
-    # Remove moves that would capture the player's own pieces
-    valid_knight_moves = [move for move in valid_knight_moves if board[move[0]][move[1]] == " " or board[move[0]][move[1]].islower() == is_white]
-
-    # Valid captures
-    captures = [move for move in valid_knight_moves if board[move[0]][move[1]] != " " and board[move[0]][move[1]].islower() == is_white]
-
-    moves.extend(valid_knight_moves)
-
-    return moves, captures
-
-# Helper function to calculate moves for a bishop
-def bishop_moves(board, row, col, is_white):
-    moves = []
-    captures = []
-
-    # Bishop moves diagonally
-    for i in range(1, 8):
-        # Top-left diagonal
-        if row - i >= 0 and col - i >= 0:
-            if board[row - i][col - i] == ' ': # Vacant spaces
-                moves.append((row - i, col - i))
-            elif board[row - i][col - i].islower() == is_white: # Opposite pieces
-                moves.append((row - i, col - i))
-                captures.append((row - i, col - i))
-                break
-            else: # Allied pieces encountered
-                break
-
-    for i in range(1, 8):
-        # Top-right diagonal
-        if row - i >= 0 and col + i < 8:
-            if board[row - i][col + i] == ' ':
-                moves.append((row - i, col + i))
-            elif board[row - i][col + i].islower() == is_white:
-                moves.append((row - i, col + i))
-                captures.append((row - i, col + i))
-                break
-            else:
-                break
-
-    for i in range(1, 8):
-        # Bottom-left diagonal
-        if row + i < 8 and col - i >= 0:
-            if board[row + i][col - i] == ' ':
-                moves.append((row + i, col - i))
-            elif board[row + i][col - i].islower() == is_white:
-                moves.append((row + i, col - i))
-                captures.append((row + i, col - i))
-                break
-            else:
-                break
-
-    for i in range(1, 8):
-        # Bottom-right diagonal
-        if row + i < 8 and col + i < 8:
-            if board[row + i][col + i] == ' ':
-                moves.append((row + i, col + i))
-            elif board[row + i][col + i].islower() == is_white:
-                moves.append((row + i, col + i))
-                captures.append((row + i, col + i))
-                break
-            else:
-                break
-
-    return moves, captures
-
-# Helper function to calculate moves for a queen
-def queen_moves(board, row, col, is_white):
-    moves = []
-    captures = []
-
-    # Bishop-like moves
-    b_moves, b_captures = bishop_moves(board, row, col, is_white)
-    moves.extend(b_moves)
-    captures.extend(b_captures)
-
-    # Rook-like moves
-    r_moves, r_captures = rook_moves(board, row, col, is_white)
-    moves.extend(r_moves)
-    captures.extend(r_captures)
-
-    return moves, captures
-
-# Helper function to calculate moves for a king
-def king_moves(board, row, col, is_white):
-    moves = []
-    captures = []
-
-    # King can move to all eight adjacent squares
-    king_moves = [(row - 1, col - 1), (row - 1, col), (row - 1, col + 1),
-                  (row, col - 1),                     (row, col + 1),
-                  (row + 1, col - 1), (row + 1, col), (row + 1, col + 1)]
-
-    # Remove moves that are out of bounds
-    valid_king_moves = [move for move in king_moves if 0 <= move[0] < 8 and 0 <= move[1] < 8]
-
-    # Remove moves that would capture the player's own pieces
-    valid_king_moves = [move for move in valid_king_moves if board[move[0]][move[1]] == " " or board[move[0]][move[1]].islower() == is_white]
-
-    # Valid captures
-    captures = [move for move in valid_king_moves if board[move[0]][move[1]] != " " and board[move[0]][move[1]].islower() == is_white]
-
-    moves.extend(valid_king_moves)
-
-    return moves, captures
-
-# Helper function to return moves for the selected piece
-def calculate_moves(board, row, col, game_history, castle_attributes=None, only_specials=False):
-    # only_specials input for only calculating special moves, this is used when updating the dictionary of board states
-    # of the game class. Special available moves are one attribute of a unique state
-    piece = board[row][col]
-    moves = []
-    captures = []
-    special_moves = []
-
-    is_white = piece.isupper()
-
-    if piece.lower() == 'p':  # Pawn
-        if not only_specials:
-            p_moves, p_captures = pawn_moves(board, row, col, is_white)
-            moves.extend(p_moves)
-            captures.extend(p_captures)
-        
-        if game_history is not None and len(game_history) != 0:
-            previous_turn = game_history[-1]
-            
-            add_enpassant = False
-            if is_white and row == 3:
-                previous_pawn, previous_start_row, previous_end_row, destination_row = 'p', '1', '3', 2
-                add_enpassant = True
-            elif not is_white and row == 4:
-                previous_pawn, previous_start_row, previous_end_row, destination_row = 'P', '6', '4', 5
-                add_enpassant = True
-            if add_enpassant:
-                start, end = list(previous_turn[0]), list(previous_turn[1])
-                # En-passant condition: A pawn moves twice onto a square with an adjacent pawn in the same rank
-                if start[0] == previous_pawn and end[0] == previous_pawn and start[1] == previous_start_row and end[1] == previous_end_row \
-                    and abs(col - int(end[2])) == 1:
-                    special_moves.append((destination_row, int(end[2])))
-
-    elif piece.lower() == 'r':  # Rook
-        if not only_specials:
-            r_moves, r_captures = rook_moves(board, row, col, is_white)
-            moves.extend(r_moves)
-            captures.extend(r_captures)
-
-    elif piece.lower() == 'n':  # Knight (L-shaped moves)
-        if not only_specials:
-            n_moves, n_captures = knight_moves(board, row, col, is_white)
-            moves.extend(n_moves)
-            captures.extend(n_captures)
-
-    elif piece.lower() == 'b':  # Bishop
-        if not only_specials:
-            b_moves, b_captures = bishop_moves(board, row, col, is_white)
-            moves.extend(b_moves)
-            captures.extend(b_captures)
-
-    elif piece.lower() == 'q':  # Queen (Bishop-like + Rook-like moves)
-        if not only_specials:
-            q_moves, q_captures = queen_moves(board, row, col, is_white)
-            moves.extend(q_moves)
-            captures.extend(q_captures)
-
-    elif piece.lower() == 'k':  # King
-        if not only_specials:
-            k_moves, k_captures = king_moves(board, row, col, is_white)
-            moves.extend(k_moves)
-            captures.extend(k_captures)
-        
-        # Using these attributes instead of a game copy eliminates the need to deepcopy the game below
-        # and instead use a temp board
-        if castle_attributes is not None:
-            # Castling
-            queen_castle = True
-            king_castle = True
-            if is_white:
-                moved_king = castle_attributes['white_king_moved']
-                left_rook_moved = castle_attributes['left_white_rook_moved']
-                right_rook_moved = castle_attributes['right_white_rook_moved']
-                king_row = 7
-                king_piece = 'K'
-            else:
-                moved_king = castle_attributes['black_king_moved']
-                left_rook_moved = castle_attributes['left_black_rook_moved']
-                right_rook_moved = castle_attributes['right_black_rook_moved']
-                king_row = 0
-                king_piece = 'k'
-
-            if not moved_king:
-                if not left_rook_moved:
-                    # Empty squares between king and rook
-                    if not all(element == ' ' for element in board[king_row][2:4]):
-                        queen_castle = False
-                    else:
-                        # Not moving through/into check and not currently under check
-                        temp_boards_and_moves = []
-                        for placement_col in [4, 3, 2]:
-                            temp_board = [rank[:] for rank in board]
-                            temp_moves = game_history.copy()
-                            temp_moves.append(output_move(piece, (king_row, 4), king_row, placement_col, ' '))
-                            temp_board[king_row][4] = ' '
-                            temp_board[king_row][placement_col] = king_piece
-                            temp_boards_and_moves.append([temp_board, temp_moves])
-                        clear_checks = all(not is_check(temp[0], is_white, temp[1]) for temp in temp_boards_and_moves)
-                        if not clear_checks:
-                            queen_castle = False
-                else:
-                    queen_castle = False
-                if not right_rook_moved:
-                    # Empty squares between king and rook
-                    if not all(element == ' ' for element in board[king_row][5:7]):
-                        king_castle = False
-                    else:
-                        # Not moving through/into check and not currently under check
-                        temp_boards_and_moves = []
-                        for placement_col in [4, 5, 6]:
-                            temp_board = [rank[:] for rank in board]
-                            temp_moves = game_history.copy()
-                            temp_moves.append(output_move(piece, (king_row, 4), king_row, placement_col, ' '))
-                            temp_board[king_row][4] = ' '
-                            temp_board[king_row][placement_col] = king_piece
-                            temp_boards_and_moves.append([temp_board, temp_moves])
-                        clear_checks = all(not is_check(temp[0], is_white, temp[1]) for temp in temp_boards_and_moves)
-                        if not clear_checks:
-                            king_castle = False
-                else:
-                    king_castle = False
-            else:
-                queen_castle = False
-                king_castle = False
-
-            if queen_castle:
-                king_pos = (7, 2) if is_white else (0, 2) 
-                special_moves.append(king_pos)
-            if king_castle:
-                king_pos = (7, 6) if is_white else (0, 6) 
-                special_moves.append(king_pos)
-    elif piece == ' ':
-        return [], [], []
-    else:
-        return ValueError
-    
-    return moves, captures, special_moves
-
-## Board State Check Logic
-# Helper function to calculate if a board does not have a king
-def is_invalid_capture(board, is_color):
-    # Find the king's position
-    king = 'K' if is_color else 'k'
-    king_position = None
-    for row in range(8):
-        for col in range(8):
-            if board[row][col] == king:
-                king_position = (row, col)
-                break
-    if king_position is None:
-        return True # Illegal move that is not allowed, likely in debug mode
-    else:
-        return False
-
-# Helper function to search for checks
-def is_check(board, is_color, moves):
-    # Find the king's position
-    king = 'K' if is_color else 'k'
-    for row in range(8):
-        for col in range(8):
-            if board[row][col] == king:
-                king_position = (row, col)
-                break
-    # Check if any opponent's pieces can attack the king
-    for row in range(8):
-        for col in range(8):
-            piece = board[row][col]
-            if piece.islower() == is_color and piece != ' ':
-                _, captures, _ = calculate_moves(board, row, col, moves)
-                if king_position in captures:
-                    return True
-    return False
-
-# Helper function to search for end-game state
-def is_checkmate_or_stalemate(board, is_color, moves):
-    possible_moves = 0
-    # Consider this as a potential checkmate if under check
-    checkmate = is_check(board, is_color, moves)
-    
-    # Iterate through all the player's pieces
-    for row in range(8):
-        for col in range(8):
-            piece = board[row][col]
-            if piece.isupper() == is_color and piece != ' ':
-                other_moves, _, other_specials = calculate_moves(board, row, col, moves)
-                for move in other_moves:
-                    # Try each move and see if it removes the check
-                    # Before making the move, create a copy of the board where the piece has moved
-                    temp_board = [rank[:] for rank in board]  
-                    temp_moves = moves.copy()
-                    temp_moves.append(output_move(piece, (row, col), move[0], move[1], temp_board[move[0]][move[1]]))
-                    temp_board[move[0]][move[1]] = temp_board[row][col]
-                    temp_board[row][col] = ' '
-                    if not is_check(temp_board, is_color, temp_moves):
-                        possible_moves += 1
-                        checkmate = False
-                
-                # Could implement an if checkmate == True check here for efficiency to skip the next portion 
-                # but it's probably best to accurately update possible_moves
-                # En-passants can remove checks
-                for move in other_specials:
-                    # We never have to try castling moves because you can never castle under check
-                    if move not in [(7, 2), (7, 6), (0, 2), (0, 6)]:
-                        temp_board = [rank[:] for rank in board]  
-                        temp_moves = moves.copy()
-                        temp_moves.append(output_move(piece, (row, col), move[0], move[1], temp_board[move[0]][move[1]], 'enpassant'))
-                        temp_board[move[0]][move[1]] = temp_board[row][col]
-                        temp_board[row][col] = ' '
-                        capture_row = 4 if move[0] == 3 else 5
-                        temp_board[capture_row][move[1]] = ' '
-                        if not is_check(temp_board, is_color, temp_moves):
-                            possible_moves += 1
-                            checkmate = False
-
-    return checkmate, possible_moves
-
 ## Drawing Logic
 # Helper Function to get the chessboard coordinates from mouse click coordinates
 def get_board_coordinates(x, y, GRID_SIZE):
@@ -834,7 +402,7 @@ class Pawn_Button:
                 self.check_hover(event.pos)
 
 # Helper function for displaying and running until a pawn is promoted 
-def display_promotion_options(draw_board_params, window, row, col, pieces, promotion_required, game):
+async def display_promotion_options(draw_board_params, window, row, col, pieces, promotion_required, game):
     # Instantiate default outputs
     promoted, end_state = False, None
     # Simplify variable names
@@ -932,5 +500,7 @@ def display_promotion_options(draw_board_params, window, row, col, pieces, promo
             window.blit(img, (img_x, img_y))
 
         pygame.display.flip()
+        # Hand control back to the event loop every frame like the main loop so background tasks keep running
+        await asyncio.sleep(0)
     
     return promoted, end_state
\ No newline at end of file
@@ -1,15 +1,33 @@
 import pygame
 import sys
+import os
 import json
 import asyncio
 from game import *
 from constants import *
 from helpers import *
-from network import Network
+from analysis import analyse_position
+from engine import Engine
+from book import OpeningBook
+from tablebase import Tablebases
+from background_search import Ponderer
+from network import Network, AsyncNetwork
+from protocol import GameSync
 
 # Initialize Pygame
 pygame.init()
 
+# Seconds the engine may think for a hint
+HINT_TIME = 5.0
+# Opening book built with book.py, hints in the book are answered from it without searching
+BOOK_PATH = 'book.bin'
+# Endgame tablebases generated with tablebase.py, hints in the endings they hold play the quickest mate
+TABLEBASE_PATH = 'tablebases'
+# 'push' sends the server only the moves, undos, resignations and draws of the player and lets it push the
+# opponent's, 'delta' sends the same commands but polls for the opponent's every frame, 'game' pickles the whole
+# Game every frame like the original server expects
+PROTOCOL = 'push'
+
 current_theme = Theme()
 
 with open('themes.json', 'r') as file:
@@ -34,44 +52,19 @@ def handle_new_piece_selection(game, row, col, is_white, hovered_square):
         first_intent = True
         selected_piece = (row, col)
         selected_piece_image = transparent_pieces[piece]
-        valid_moves, valid_captures, valid_specials = calculate_moves(game.board, row, col, game.moves, game.castle_attributes)
+        # Legal moves of the position are analysed once and cached for the move that follows
+        valid_moves, valid_captures, valid_specials = analyse_position(game, is_white).piece_moves(game.board, row, col)
     else:
         first_intent = False
         selected_piece = None
         selected_piece_image = None
         valid_moves, valid_captures, valid_specials = [], [], []
 
-    # Remove invalid moves that place the king under check
-    for move in valid_moves.copy():
-        # Before making the move, create a copy of the board where the piece has moved
-        temp_board = [rank[:] for rank in game.board]  
-        temp_moves = game.moves.copy()
-        temp_moves.append(output_move(piece, selected_piece, move[0], move[1], temp_board[move[0]][move[1]]))
-        temp_board[move[0]][move[1]] = temp_board[selected_piece[0]][selected_piece[1]]
-        temp_board[selected_piece[0]][selected_piece[1]] = ' '
-        
-        # Temporary invalid move check, Useful for my variant later
-        if is_invalid_capture(temp_board, not is_white):
-            valid_moves.remove(move)
-            if move in valid_captures:
-                valid_captures.remove(move)
-        elif is_check(temp_board, is_white, temp_moves):
-            valid_moves.remove(move)
-            if move in valid_captures:
-                valid_captures.remove(move)
-    
-    for move in valid_specials.copy():
-        # Castling moves are already validated in calculate moves, this is only for enpassant
-        if (move[0], move[1]) not in [(7, 2), (7, 6), (0, 2), (0, 6)]:
-            temp_board = [rank[:] for rank in game.board]  
-            temp_moves = game.moves.copy()
-            temp_moves.append(output_move(piece, selected_piece, move[0], move[1], temp_board[move[0]][move[1]], 'enpassant'))
-            temp_board[move[0]][move[1]] = temp_board[selected_piece[0]][selected_piece[1]]
-            temp_board[selected_piece[0]][selected_piece[1]] = ' '
-            capture_row = 4 if move[0] == 3 else 5
-            temp_board[capture_row][move[1]] = ' '
-            if is_check(temp_board, is_white, temp_moves):
-                valid_specials.remove(move)
+    # Temporary invalid move check, Useful for my variant later
+    # Capturing the opposing king is never allowed, this only happens on debug boards
+    opposing_king = 'k' if is_white else 'K'
+    valid_moves = [move for move in valid_moves if game.board[move[0]][move[1]] != opposing_king]
+    valid_captures = [move for move in valid_captures if game.board[move[0]][move[1]] != opposing_king]
     
     if (row, col) != hovered_square:
         hovered_square = (row, col)
@@ -87,14 +80,11 @@ def handle_piece_move(game, selected_piece, row, col, valid_captures):
     piece = game.board[selected_piece[0]][selected_piece[1]]
     is_white = piece.isupper()
 
-    temp_board = [rank[:] for rank in game.board]  
-    temp_moves = game.moves.copy()
-    temp_moves.append(output_move(piece, selected_piece, row, col, temp_board[row][col]))
-    temp_board[row][col] = temp_board[selected_piece[0]][selected_piece[1]]
-    temp_board[selected_piece[0]][selected_piece[1]] = ' '
+    # The analysis of the current position is usually cached from the piece selection
+    king_safe = analyse_position(game, is_white).is_legal(selected_piece, row, col)
 
     # Move the piece if the king does not enter check
-    if not is_check(temp_board, is_white, temp_moves):
+    if king_safe:
         game.update_state(row, col, selected_piece)
         if piece.lower() != 'p' or (piece.lower() == 'p' and (row != 7 and row != 0)):
             print("ALG_MOVES:", game.alg_moves)
@@ -106,7 +96,7 @@ def handle_piece_move(game, selected_piece, row, col, valid_captures):
         
         selected_piece = None
 
-        checkmate, remaining_moves = is_checkmate_or_stalemate(game.board, not is_white, game.moves)
+        checkmate, remaining_moves = analyse_position(game, not is_white).end_state()
         if checkmate:
             print("CHECKMATE")
             game.end_position = True
@@ -144,7 +134,7 @@ def handle_piece_special_move(game, selected_piece, row, col):
     else:
         capture_sound.play()
 
-    checkmate, remaining_moves = is_checkmate_or_stalemate(game.board, not is_white, game.moves)
+    checkmate, remaining_moves = analyse_position(game, not is_white).end_state()
     if checkmate:
         print("CHECKMATE")
         game.end_position = True
@@ -165,7 +155,13 @@ def handle_piece_special_move(game, selected_piece, row, col):
 
 # Main loop
 async def main():
-    n = Network()
+    # The delta protocol's exchanges wait for their reply, the other protocols run on the asyncio transport and
+    # never hold up a frame
+    if PROTOCOL == 'delta':
+        n = Network()
+    else:
+        n = AsyncNetwork()
+        await n.connect()
     starting_player = n.get_player()
     current_theme.INVERSE_PLAYER_VIEW = not starting_player
     if starting_player:
@@ -173,6 +169,9 @@ async def main():
     else:
         pygame.display.set_caption("Chess - Black")
     game = Game(new_board.copy(), starting_player)
+    sync = GameSync()
+    if PROTOCOL == 'push' and starting_player is not None:
+        sync.subscribe(n)
     running = True
     waiting = True
 
@@ -191,6 +190,14 @@ async def main():
     valid_moves = []
     valid_captures = []
     valid_specials = []
+    # Engine hint searched in the background, with the position it was asked for and the last depth reported.
+    # The ponderer owns the engine and, in ponder mode, keeps it searching on the opponent's time
+    ponderer = Ponderer(Engine(1 << 18, book=OpeningBook(BOOK_PATH) if os.path.exists(BOOK_PATH) else None,
+                               tablebases=Tablebases(TABLEBASE_PATH) if os.path.isdir(TABLEBASE_PATH) else None))
+    pondering = False
+    hint_search = None
+    hint_position = None
+    hint_depth = 0
 
     left_mouse_button_down = False
     right_mouse_button_down = False
@@ -203,7 +210,14 @@ async def main():
     print("Waiting to connect to second game...")
     while waiting:
         try:
-            games = n.send(game)
+            if PROTOCOL == 'push':
+                sync.update(n, game)
+                games = [game, game] if sync.paired else [game]
+            elif PROTOCOL == 'delta':
+                sync.exchange(n, game)
+                games = [game, game] if sync.paired else [game]
+            else:
+                games = n.send(game)
             if games is None or len(games) == 1:
                 if games is not None:
                     game = games[0]
@@ -258,8 +272,30 @@ async def main():
     # Main game loop
     while running:
         try:
-            games = n.send(game)
-            if starting_player:
+            if PROTOCOL in ('push', 'delta'):
+                # The opponent's commands are played on the game as they arrive
+                changed = sync.update(n, game) if PROTOCOL == 'push' else sync.exchange(n, game)
+                if changed and game.alg_moves != []:
+                    if not any(symbol in game.alg_moves[-1] for symbol in ['0-1', '1-0', '½–½']):
+                        if "x" not in game.alg_moves[-1]:
+                            move_sound.play()
+                        else:
+                            capture_sound.play()
+                    if game.end_position:
+                        running = False
+                        checkmate, remaining_moves = analyse_position(game, starting_player).end_state()
+                        if checkmate:
+                            print("CHECKMATE")
+                        elif remaining_moves == 0:
+                            print("STALEMATE")
+                        elif game.threefold_check():
+                            print("DRAW BY THREEFOLD REPETITION")
+                        elif game.forced_end != "":
+                            print(game.forced_end)
+                        print("ALG_MOVES: ", game.alg_moves)
+                        break
+                    print("ALG_MOVES: ", game.alg_moves)
+            elif starting_player:
                 if game._sync:
                     # Previously had the redundant games[0].current_turn == game._starting_player and game.current_turn != game._starting_player and in the first condition
                     if (len(games[1].alg_moves) > len(game.alg_moves)) or (len(games[1].alg_moves) < len(game.alg_moves) and games[1]._move_undone) or \
@@ -274,7 +310,7 @@ async def main():
                             if game.end_position:
                                 running = False
                                 is_white = True
-                                checkmate, remaining_moves = is_checkmate_or_stalemate(game.board, is_white, game.moves)
+                                checkmate, remaining_moves = analyse_position(game, is_white).end_state()
                                 if checkmate:
                                     print("CHECKMATE")
                                 elif remaining_moves == 0:
@@ -306,7 +342,7 @@ async def main():
                             if game.end_position:
                                 running = False
                                 is_white = False
-                                checkmate, remaining_moves = is_checkmate_or_stalemate(game.board, is_white, game.moves)
+                                checkmate, remaining_moves = analyse_position(game, is_white).end_state()
                                 if checkmate:
                                     print("CHECKMATE")
                                 elif remaining_moves == 0:
@@ -501,6 +537,9 @@ async def main():
                 if event.key == pygame.K_u:
                     # Update current and previous position highlighting
                     game.undo_move()
+                    if hint_search is not None:
+                        hint_search.cancel()
+                        hint_search = None
                     hovered_square = None
                     selected_piece_image = None
                     selected_piece = None
@@ -543,6 +582,40 @@ async def main():
                     chessboard = generate_chessboard(current_theme)
                     coordinate_surface = generate_coordinate_surface(current_theme)
 
+                # Engine hint on your turn, pressing again while it thinks plays out its best move so far
+                elif event.key == pygame.K_h:
+                    if hint_search is not None:
+                        hint_search.stop()
+                    elif game.current_turn == game._starting_player:
+                        hint_search = ponderer.search(game, HINT_TIME)
+                        hint_position, hint_depth = game.zobrist_hash, 0
+
+                # Ponder mode, the engine thinks on the opponent's time so hints after the expected reply are instant
+                elif event.key == pygame.K_p:
+                    pondering = not pondering
+                    if not pondering:
+                        ponderer.stop()
+                    print("PONDERING ON" if pondering else "PONDERING OFF")
+
+        if pondering:
+            ponderer.update(game)
+
+        # Report the hint as the search deepens and draw its move once done, the search runs off the event loop
+        # so the board keeps rendering meanwhile. A hint for a position that has since changed is dropped
+        if hint_search is not None:
+            if game.zobrist_hash != hint_position:
+                hint_search.cancel()
+                hint_search = None
+            else:
+                if hint_search.info is not None and hint_search.info.depth > hint_depth:
+                    hint_depth = hint_search.info.depth
+                    print(f"HINT depth {hint_depth} score {hint_search.info.score} pv {' '.join(hint_search.info.pv)}")
+                if hint_search.done():
+                    hint = hint_search.result()
+                    if hint is not None and hint.move is not None and [hint.move[0], hint.move[1]] not in drawn_arrows:
+                        drawn_arrows.append([hint.move[0], hint.move[1]])
+                    hint_search = None
+
         # Clear the screen
         window.fill((0, 0, 0))
 
@@ -592,7 +665,7 @@ async def main():
                 'selected_piece_image': selected_piece_image
             }
 
-            promoted, end_state = display_promotion_options(draw_board_params, window, promotion_square[0], promotion_square[1], pieces, promotion_required, game)
+            promoted, end_state = await display_promotion_options(draw_board_params, window, promotion_square[0], promotion_square[1], pieces, promotion_required, game)
             promotion_required, promotion_square = False, None
 
             if promoted:
@@ -634,7 +707,7 @@ async def main():
             piece = game.board[row][col]
             is_white = piece.isupper()
 
-            checkmate, remaining_moves = is_checkmate_or_stalemate(game.board, not is_white, game.moves)
+            checkmate, remaining_moves = analyse_position(game, not is_white).end_state()
             if checkmate:
                 print("CHECKMATE")
                 running = False
@@ -653,7 +726,8 @@ async def main():
                 game.add_end_game_notation(checkmate)
         
         try:
-            if game.current_turn != game._starting_player or not game._sync:
+            # The push and delta protocols send the player's commands with the next frame's update
+            if PROTOCOL == 'game' and (game.current_turn != game._starting_player or not game._sync):
                 _ = n.send(game)
         except Exception as err:
             running = False
@@ -665,9 +739,18 @@ async def main():
         pygame.display.flip()
         await asyncio.sleep(0)
 
+    if hint_search is not None:
+        hint_search.cancel()
+    ponderer.stop()
+
     if game.end_position:
         try:
-            _ = n.send(game)
+            if PROTOCOL == 'push':
+                n.post((sync.sequence, sync.commands(game)))
+            elif PROTOCOL == 'delta':
+                sync.exchange(n, game)
+            else:
+                _ = n.send(game)
         except Exception as err:
             print("Could not send game... ", err)
 
@@ -0,0 +1,252 @@
+import argparse
+import time
+from engine import TranspositionTable
+from game import Game, game_from_fen
+from rules import generate_legal_moves, is_check, is_checkmate_or_stalemate, move_string
+
+## Mate solver
+# Proof-number search for forced mates within a number of moves. The side to move is the attacker: its nodes are
+# OR nodes, proven by any one move, and the defender's are AND nodes, proven only once every reply is. Each node
+# counts the plies left before the bound, so a line still going when they run out is disproven. The tree grows
+# at the most-proving node, the leaf whose proof would settle the most for the least work, so the effort goes
+# into forcing lines instead of the quiet ones a full width alpha-beta search would also cover.
+# New nodes start from the mobility of their side, few defender replies make a mate likelier. Solved subtrees
+# are dropped except for the line to report, and the node budget bounds both the work and the memory
+
+INFINITE = 1 << 30
+MATE, NO_MATE, UNKNOWN = 'mate', 'no mate', 'unknown'
+# Table flags, a proven entry stores the plies to mate and a disproven one the plies searched without finding it
+PROVEN, DISPROVEN = 1, 2
+
+class MateNode:
+    __slots__ = ('move', 'parent', 'children', 'plies', 'proof', 'disproof', 'distance')
+
+    def __init__(self, move, parent, plies, proof=1, disproof=1):
+        self.move = move
+        self.parent = parent
+        # None until expanded
+        self.children = None
+        self.plies = plies
+        self.proof = proof
+        self.disproof = disproof
+        # Plies to mate once proven
+        self.distance = 0
+
+# Outcome of a solve. status is MATE, NO_MATE once mate within the bound is refuted, or UNKNOWN when the node or
+# time budget ran out first. line holds the mating moves in the (selected_piece, new_row, new_col, special,
+# promotion) form Game.make_move takes, with the defender's longest resistance
+class MateResult:
+    __slots__ = ('status', 'mate_in', 'line', 'pv', 'nodes', 'elapsed')
+
+    def __init__(self, status, mate_in, line, nodes, elapsed):
+        self.status = status
+        self.mate_in = mate_in
+        self.line = line
+        self.pv = [move_string(selected_piece, new_row, new_col, promotion)
+                   for selected_piece, new_row, new_col, _, promotion in line]
+        self.nodes = nodes
+        self.elapsed = elapsed
+
+    @property
+    def nodes_per_second(self):
+        return self.nodes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __repr__(self):
+        return f"MateResult(status={self.status}, mate_in={self.mate_in}, nodes={self.nodes}, " \
+               f"nps={self.nodes_per_second:.0f}, pv={' '.join(self.pv)})"
+
+class MateSolver:
+
+    # max_nodes bounds the positions generated over a solve, and with them the size of the tree
+    def __init__(self, max_nodes=1000000, max_time=None):
+        self.max_nodes = max_nodes
+        self.max_time = max_time
+        self.nodes = 0
+        self.deadline = None
+        self.table = TranspositionTable(1 << 20)
+
+    # Looks for the shortest forced mate of the side to move in up to max_moves moves, trying each bound in turn
+    def solve(self, game, max_moves=5):
+        start = time.perf_counter()
+        self.nodes = 0
+        self.deadline = None if self.max_time is None else start + self.max_time
+        # Entries do not record the attacker, a proof from an earlier position could be the other side's mate
+        self.table.clear()
+        # Solving on a copy leaves the game untouched
+        position = Game([row[:] for row in game.board], game._starting_player, game.current_turn,
+                        game.castling_rights, game.enpassant_square)
+        for moves in range(1, max_moves + 1):
+            root = MateNode(None, None, 2 * moves - 1)
+            self.prove(position, root)
+            if root.proof == 0:
+                line = self.mating_line(position, root)
+                return MateResult(MATE, moves, line, self.nodes, time.perf_counter() - start)
+            if root.disproof != 0:
+                return MateResult(UNKNOWN, None, [], self.nodes, time.perf_counter() - start)
+        return MateResult(NO_MATE, None, [], self.nodes, time.perf_counter() - start)
+
+    # Follows the line kept in a proven tree. A node proven from the table has no children, the line is continued
+    # by proving it again, which the table answers a ply at a time
+    def mating_line(self, game, root):
+        line, undo_records, node = [], [], root
+        while True:
+            while node.children:
+                node = node.children[0]
+                line.append(node.move)
+                undo_records.append(game.make_move(*node.move))
+            if node.distance == 0:
+                break
+            node = MateNode(None, None, node.distance)
+            self.prove(game, node)
+            if node.proof != 0:
+                # Out of budget before the table gave the rest of the line back
+                break
+        for undo in reversed(undo_records):
+            game.unmake_move(undo)
+        return line
+
+    def prove(self, game, root):
+        while root.proof and root.disproof:
+            if self.nodes >= self.max_nodes or (self.deadline is not None and time.perf_counter() > self.deadline):
+                return
+            # Walk down to the most-proving node playing the moves on the way
+            node, undo_records = root, []
+            while node.children is not None:
+                if node.plies % 2:
+                    node = min(node.children, key=lambda child: child.proof)
+                else:
+                    node = min(node.children, key=lambda child: child.disproof)
+                undo_records.append(game.make_move(*node.move))
+            self.expand(node, game)
+            # And back up to the root updating the numbers of the path
+            while True:
+                self.update(node)
+                if node.proof == 0:
+                    self.table.store(game.zobrist_hash, node.distance, 0, PROVEN, None)
+                elif node.disproof == 0:
+                    self.table.store(game.zobrist_hash, node.plies, 0, DISPROVEN, None)
+                if node is root:
+                    break
+                game.unmake_move(undo_records.pop())
+                node = node.parent
+
+    def expand(self, node, game):
+        attacking = node.plies % 2 == 1
+        children = []
+        for move in generate_legal_moves(game.board, game.current_turn, game.enpassant_square, game.castling_rights):
+            undo = game.make_move(*move)
+            self.nodes += 1
+            if attacking and node.plies == 1 and not is_check(game.board, game.current_turn):
+                # The last move of the bound can only mate with a check
+                game.unmake_move(undo)
+                continue
+            entry = self.table.probe(game.zobrist_hash)
+            if entry is not None and entry[3] == DISPROVEN and entry[1] >= node.plies - 1:
+                game.unmake_move(undo)
+                if attacking:
+                    continue
+                children = [MateNode(move, node, node.plies - 1, INFINITE, 0)]
+                break
+            if entry is not None and entry[3] == PROVEN and entry[1] <= node.plies - 1:
+                game.unmake_move(undo)
+                child = MateNode(move, node, node.plies - 1, 0, INFINITE)
+                child.distance = entry[1]
+                if attacking:
+                    children = [child]
+                    break
+                children.append(child)
+                continue
+            checkmate, replies = is_checkmate_or_stalemate(game.board, game.current_turn,
+                                                           enpassant_square=game.enpassant_square)
+            game.unmake_move(undo)
+            if attacking:
+                if checkmate:
+                    child = MateNode(move, node, node.plies - 1, 0, INFINITE)
+                    children = [child]
+                    break
+                # Stalemates and lines out of plies cannot lead to mate and are left out of the tree
+                if replies and node.plies > 1:
+                    children.append(MateNode(move, node, node.plies - 1, replies, 1))
+            elif replies == 0:
+                # Stalemating or mating the attacker refutes the defender's node at once
+                children = [MateNode(move, node, node.plies - 1, INFINITE, 0)]
+                break
+            else:
+                children.append(MateNode(move, node, node.plies - 1, 1, replies))
+        node.children = children
+
+    def update(self, node):
+        children = node.children
+        if node.plies % 2:
+            node.proof = min((child.proof for child in children), default=INFINITE)
+            node.disproof = min(sum(child.disproof for child in children), INFINITE)
+        else:
+            node.proof = min(sum(child.proof for child in children), INFINITE)
+            node.disproof = min((child.disproof for child in children), default=INFINITE)
+        # A solved node keeps only the child its line goes through: the quickest mate for the attacker and
+        # the longest resistance for the defender
+        if node.proof == 0:
+            if node.plies % 2:
+                best = min((child for child in children if child.proof == 0), key=lambda child: child.distance)
+            else:
+                best = max(children, key=lambda child: child.distance)
+            node.distance = best.distance + 1
+            node.children = [best]
+        elif node.disproof == 0:
+            node.children = []
+
+## Puzzle sets
+# Positions read from EPD lines, where the dm opcode gives the length of the mate the puzzle expects
+
+# Yields (fen, mate_in) for every position of an EPD text, mate_in is None without a dm opcode
+def read_epd(text):
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split(maxsplit=4)
+        fen = ' '.join(fields[:4])
+        mate_in = None
+        for operation in (fields[4] if len(fields) > 4 else '').split(';'):
+            opcode, _, operand = operation.strip().partition(' ')
+            if opcode == 'dm':
+                mate_in = int(operand)
+        yield fen, mate_in
+
+# Puzzles with known mates, checked against the engine and the KRK tablebase
+MATE_PUZZLES = '''
+6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - dm 1; id "back rank";
+4kb1r/p2n1ppp/4q3/4p1B1/4P3/1Q6/PPP2PPP/2KR4 w k - dm 2; id "opera game";
+r1b3kr/ppp1Bp1p/1b6/n2P4/2p3q1/2Q2N2/P4PPP/RN2R1K1 w - - dm 3; id "queen sacrifice";
+1r2k1r1/pbppnp1p/1b3P2/8/Q7/B1PB1q2/P4PPP/3RR1K1 w - - dm 4; id "evergreen game";
+r6k/6pp/8/6N1/2Q5/8/8/6K1 w - - dm 4; id "smothered mate";
+R7/8/8/8/3K4/8/8/6k1 w - - dm 5; id "rook ending";
+'''
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Prove or refute forced mates with proof-number search')
+    parser.add_argument('--fen', help='position to solve, the built-in puzzles by default')
+    parser.add_argument('--epd', help='EPD file of puzzles, dm gives the expected mate length')
+    parser.add_argument('--moves', type=int, default=5, help='longest mate looked for')
+    parser.add_argument('--nodes', type=int, default=1000000, help='node budget per position')
+    parser.add_argument('--time', type=float, help='time budget per position in seconds')
+    args = parser.parse_args()
+
+    if args.fen:
+        puzzles = [(args.fen, None)]
+    elif args.epd:
+        with open(args.epd) as file:
+            puzzles = list(read_epd(file.read()))
+    else:
+        puzzles = list(read_epd(MATE_PUZZLES))
+    solver = MateSolver(args.nodes, args.time)
+    failures = 0
+    for fen, expected in puzzles:
+        result = solver.solve(game_from_fen(fen), max(args.moves, expected or 0))
+        found = f"mate in {result.mate_in}" if result.status == MATE else result.status
+        verdict = '' if expected is None else ' ok' if result.mate_in == expected else f' expected mate in {expected}'
+        failures += verdict not in ('', ' ok')
+        print(f"{found:<12} nodes {result.nodes:>8}  nps {result.nodes_per_second:>6.0f}  "
+              f"time {result.elapsed:>6.2f}  pv {' '.join(result.pv)}{verdict}  {fen}")
+    if failures:
+        print(f"{failures} of {len(puzzles)} positions failed")
@@ -1,40 +1,48 @@
+import asyncio
+import collections
+import select
 import socket
-import pickle
-import struct
+from codec import FRAME_HEADER, decode, encode_frame
 
 def send_data(conn, data):
     """
-    Send data over the connection by first sending its length as a 4-byte integer,
-    followed by the actual data.
+    Send data over the connection in the binary format of codec.py, prefixed by its length as a 4-byte integer.
     """
-    data_pickle = pickle.dumps(data)
-    data_length = len(data_pickle)
-    conn.send(struct.pack("!I", data_length))  # Send message length
-    conn.send(data_pickle)  # Send the actual data
+    conn.sendall(encode_frame(data))
 
-def receive_data(conn):
+def receive_exactly(conn, size):
     """
-    Receive data from the connection by first reading the message length,
-    then reading the actual data.
+    Receive exactly size bytes, None once the connection is closed.
     """
-    data_length_bytes = conn.recv(4)  # Read 4 bytes for message length
-    if not data_length_bytes:
-        return None
-    data_length = struct.unpack("!I", data_length_bytes)[0]  # Unpack message length
     data = b""
-    while len(data) < data_length:
-        packet = conn.recv(data_length - len(data))
+    while len(data) < size:
+        packet = conn.recv(size - len(data))
         if not packet:
             return None
         data += packet
-    return pickle.loads(data)
+    return data
+
+def receive_data(conn):
+    """
+    Receive data from the connection by first reading the message length,
+    then reading and decoding the actual data.
+    """
+    data_length_bytes = receive_exactly(conn, FRAME_HEADER.size)
+    if data_length_bytes is None:
+        return None
+    data = receive_exactly(conn, FRAME_HEADER.unpack(data_length_bytes)[0])
+    if data is None:
+        return None
+    return decode(data)
 
 class Network:
-    def __init__(self):
+    def __init__(self, server="", port=5555):
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server = ""
-        self.port = 5555
+        self.server = server
+        self.port = port
         self.addr = (self.server, self.port)
+        # Bytes received in the push mode not yet decoded into a whole message
+        self.inbox = b""
         self.player = self.connect() # To send a player specification to each client for them to know whether they're the starting player: white or black
 
     def get_player(self):
@@ -52,4 +60,137 @@ class Network:
             send_data(self.client, data)
             return receive_data(self.client)
         except socket.error as err:
-            print("Error sending data to server...", err)
\ No newline at end of file
+            print("Error sending data to server...", err)
+
+    ## Push mode
+    # Once subscribed the server sends replies whenever it has something new, they are collected in an inbox
+    # that receive empties without blocking. send must not be used anymore, its reply could be a pushed one
+
+    def subscribe(self, request):
+        send_data(self.client, request)
+
+    # Sends without waiting for the reply
+    def post(self, data):
+        send_data(self.client, data)
+
+    # Returns the messages received so far, raises ConnectionError once the server closed the connection
+    def receive(self):
+        while select.select([self.client], [], [], 0)[0]:
+            packet = self.client.recv(1 << 16)
+            if not packet:
+                raise ConnectionError("Connection closed by the server")
+            self.inbox += packet
+        messages = []
+        start = 0
+        while len(self.inbox) - start >= FRAME_HEADER.size:
+            end = start + FRAME_HEADER.size + FRAME_HEADER.unpack_from(self.inbox, start)[0]
+            if len(self.inbox) < end:
+                break
+            messages.append(decode(self.inbox[start + FRAME_HEADER.size:end]))
+            start = end
+        self.inbox = self.inbox[start:]
+        return messages
+
+## Asyncio transport
+# The same client on the running event loop, so it also works under pygbag where the browser drives the loop and
+# nothing may block. A reader and a writer task do the I/O, the game loop only queues messages and picks up what
+# arrived, never awaiting the network. Under pygbag the connection goes through the WebSocket emulation of
+# emscripten's sockets, so the server has to be reachable through a WebSocket proxy like websockify
+
+class AsyncNetwork:
+    def __init__(self, server="", port=5555):
+        self.server = server
+        self.port = port
+        self.player = None
+        self.outbox = asyncio.Queue()
+        # Replies in order for receive, and the last one for send
+        self.inbox = collections.deque()
+        self.latest = None
+        # Whether a request made by send is still unanswered, and the newest data to send once it is
+        self.awaiting = False
+        self.next_request = None
+        self.closed = False
+        self.tasks = []
+        self.writer = None
+
+    def get_player(self):
+        return self.player
+
+    # Opens the connection and waits for the player specification, the only await a client makes
+    async def connect(self):
+        try:
+            reader, self.writer = await asyncio.open_connection(self.server or 'localhost', self.port)
+            self.player = await self.read(reader)
+        except (OSError, asyncio.IncompleteReadError) as err:
+            print("Could not connect to server...", err)
+            self.closed = True
+            return None
+        self.tasks = [asyncio.ensure_future(self.read_loop(reader)), asyncio.ensure_future(self.write_loop())]
+        return self.player
+
+    async def read(self, reader):
+        data_length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))[0]
+        return decode(await reader.readexactly(data_length))
+
+    async def read_loop(self, reader):
+        try:
+            while True:
+                message = await self.read(reader)
+                self.latest = message
+                if self.awaiting:
+                    self.awaiting = False
+                    if self.next_request is not None:
+                        data, self.next_request = self.next_request, None
+                        self.awaiting = True
+                        self.post(data)
+                else:
+                    self.inbox.append(message)
+        except (OSError, ValueError, asyncio.IncompleteReadError) as err:
+            if not self.closed:
+                print("Connection to server lost...", err)
+        self.closed = True
+
+    async def write_loop(self):
+        try:
+            while True:
+                self.writer.write(await self.outbox.get())
+                await self.writer.drain()
+        except OSError as err:
+            print("Error sending data to server...", err)
+        self.closed = True
+
+    def subscribe(self, request):
+        self.post(request)
+
+    # Queues data to send
+    def post(self, data):
+        if self.closed:
+            raise ConnectionError("Not connected to the server")
+        self.outbox.put_nowait(encode_frame(data))
+
+    # Returns the replies received since the last call, raises ConnectionError once the connection is gone
+    def receive(self):
+        if not self.inbox and self.closed:
+            raise ConnectionError("Connection closed by the server")
+        messages = list(self.inbox)
+        self.inbox.clear()
+        return messages
+
+    # Without blocking like Network.send: returns the latest reply received, None before the first, and sends
+    # data unless a request is still unanswered. Then only the newest data is sent once it is
+    def send(self, data):
+        if self.closed:
+            return None
+        if self.awaiting:
+            self.next_request = data
+        else:
+            self.awaiting = True
+            self.post(data)
+        return self.latest
+
+    def close(self):
+        self.closed = True
+        for task in self.tasks:
+            task.cancel()
+        if self.writer is not None:
+            self.writer.close()
@@ -0,0 +1,156 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from game import game_from_fen
+from rules import calculate_pins_and_checks, generate_legal_moves, position_to_fen, move_string
+from engine import Engine, SearchResult, SearchTimeout, INFINITY, MATE_BOUND, MATE_SCORE
+from perft import PERFT_POSITIONS
+from shared_table import SharedTranspositionTable
+
+## Parallel search
+# Root move splitting over a process pool. Every iteration of the iterative deepening hands each root move to a
+# worker process, which searches it with its own engine and keeps its transposition table between tasks.
+# Positions travel as a FEN string plus the hashes of the earlier positions that count as repetitions,
+# never as a pickled Game with its move lists and board states
+
+# Root moves are searched against the previous iteration's best score minus this margin, a move failing below it
+# cannot be the best and only the best move needs an exact score. If every move fails low they are searched again
+ASPIRATION_MARGIN = 50
+
+# Engine of the current worker process, created once per process by the pool initializer
+_worker_engine = None
+
+# Workers attach to the shared table by name when there is one, otherwise each keeps a private table
+def _start_worker(tt_size, shared_table_name):
+    global _worker_engine
+    tt = None if shared_table_name is None else SharedTranspositionTable.attach(shared_table_name)
+    _worker_engine = Engine(tt_size, tt=tt)
+
+# Searches one root move in a worker process, stop_at is a wall clock time shared by all processes
+# Returns the score from the root side, the nodes searched and the principal variation after the move
+def search_root_move(fen, previous_positions, move, depth, alpha, stop_at):
+    engine = _worker_engine
+    game = game_from_fen(fen)
+    engine.start_search(previous_positions, max_time=None if stop_at is None else stop_at - time.time())
+    engine.can_stop = stop_at is not None
+    engine.path.append(game.zobrist_hash)
+    game.make_move(*move)
+    try:
+        score = -engine.negamax(game, depth - 1, -INFINITY, -alpha, 1)
+    except SearchTimeout:
+        return None, engine.nodes, []
+    return score, engine.nodes, engine.principal_variation(game, depth - 1)
+
+class ParallelEngine:
+
+    # shared_tt_mb puts one transposition table of that size in shared memory for all workers,
+    # so a position resolved by one worker is not searched again by another
+    def __init__(self, workers=None, tt_size=1 << 18, shared_tt_mb=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.shared_tt = None if shared_tt_mb is None else SharedTranspositionTable(shared_tt_mb)
+        shared_table_name = None if self.shared_tt is None else self.shared_tt.name
+        self.pool = ProcessPoolExecutor(self.workers, initializer=_start_worker, initargs=(tt_size, shared_table_name))
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+        if self.shared_tt is not None:
+            self.shared_tt.close()
+            self.shared_tt = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Same budget and result as Engine.search apart from the node budget, the first iteration always completes
+    def search(self, game, max_depth=64, max_time=None, callback=None):
+        start = time.perf_counter()
+        stop_at = None if max_time is None else time.time() + max_time
+        fen = position_to_fen(game.board, game.current_turn, game.castling_rights, game.enpassant_square)
+        previous_positions = list(game.board_states)
+        moves = generate_legal_moves(game.board, game.current_turn, game.enpassant_square, game.castling_rights)
+        if not moves:
+            in_check = len(calculate_pins_and_checks(game.board, game.current_turn)[1]) != 0
+            return SearchResult(None, None, -MATE_SCORE if in_check else 0, 0, 0, 0.0, [])
+
+        result = SearchResult(None, None, 0, 0, 0, 0.0, [])
+        nodes = 0
+        for depth in range(1, max_depth + 1):
+            alpha = -INFINITY if depth == 1 else result.score - ASPIRATION_MARGIN
+            scores, depth_nodes, completed = self.search_depth(fen, previous_positions, moves, depth, alpha,
+                                                               None if depth == 1 else stop_at)
+            nodes += depth_nodes
+            if completed and max(score for score, _ in scores.values()) <= alpha:
+                scores, depth_nodes, completed = self.search_depth(fen, previous_positions, moves, depth, -INFINITY,
+                                                                   stop_at)
+                nodes += depth_nodes
+            if not completed:
+                break
+
+            # Best first so the next iteration hands the likely best moves out first
+            moves.sort(key=lambda move: scores[move][0], reverse=True)
+            best_move = moves[0]
+            score, pv = scores[best_move]
+            selected_piece, new_row, new_col, special, promotion = best_move
+            result = SearchResult((selected_piece, (new_row, new_col), special), promotion, score, depth, nodes,
+                                  time.perf_counter() - start,
+                                  [move_string(selected_piece, new_row, new_col, promotion)] + pv)
+            if callback is not None:
+                callback(result)
+            if abs(score) > MATE_BOUND or (stop_at is not None and time.time() >= stop_at):
+                break
+        result.nodes = nodes
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    # Searches every root move to a depth, returning their scores and principal variations, the nodes searched
+    # and whether every move finished before the deadline. The first move is searched on its own and its score
+    # raises alpha for the rest, which are then split between the workers
+    def search_depth(self, fen, previous_positions, moves, depth, alpha, stop_at):
+        score, nodes, pv = self.pool.submit(search_root_move, fen, previous_positions, moves[0], depth, alpha,
+                                            stop_at).result()
+        if score is None:
+            return {}, nodes, False
+        scores, completed = {moves[0]: (score, pv)}, True
+        alpha = max(alpha, score)
+        futures = [self.pool.submit(search_root_move, fen, previous_positions, move, depth, alpha, stop_at)
+                   for move in moves[1:]]
+        for move, future in zip(moves[1:], futures):
+            score, move_nodes, pv = future.result()
+            nodes += move_nodes
+            if score is None:
+                completed = False
+            else:
+                scores[move] = (score, pv)
+        return scores, nodes, completed
+
+# Searches the standard perft positions to a fixed depth with each worker count and prints the scaling,
+# the single process Engine is listed first as the baseline
+def benchmark(worker_counts=(1, 2, 4, 8), depth=4, shared_tt_mb=None):
+    print(f"{'Workers':<10}{'Seconds':>10}{'Nodes':>12}{'Nodes/s':>12}{'Speedup':>10}")
+    start = time.perf_counter()
+    nodes = 0
+    for fen, _ in PERFT_POSITIONS.values():
+        nodes += Engine(1 << 18).search(game_from_fen(fen), max_depth=depth).nodes
+    baseline = time.perf_counter() - start
+    print(f"{'serial':<10}{baseline:>10.2f}{nodes:>12}{nodes / baseline:>12.0f}{1.0:>9.2f}x")
+
+    for workers in worker_counts:
+        with ParallelEngine(workers, shared_tt_mb=shared_tt_mb) as engine:
+            start = time.perf_counter()
+            nodes = 0
+            for fen, _ in PERFT_POSITIONS.values():
+                nodes += engine.search(game_from_fen(fen), max_depth=depth).nodes
+            elapsed = time.perf_counter() - start
+        print(f"{workers:<10}{elapsed:>10.2f}{nodes:>12}{nodes / elapsed:>12.0f}{baseline / elapsed:>9.2f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure parallel search scaling on the standard perft positions')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--shared-tt-mb', type=int, help='share one transposition table of this size between workers')
+    args = parser.parse_args()
+    print(f"CPU cores: {os.cpu_count()}")
+    benchmark(args.workers, args.depth, args.shared_tt_mb)
@@ -0,0 +1,82 @@
+import argparse
+import time
+from game import game_from_fen
+from rules import generate_legal_moves, move_string
+
+## Perft
+# Walks the legal move tree with Game.make_move/unmake_move and counts the leaf nodes, the counts are compared
+# against published values to prove the move generator correct and the timings benchmark it. Runs without pygame
+
+# Standard perft positions with their published node counts for depths 1, 2, 3...
+# from https://www.chessprogramming.org/Perft_Results
+PERFT_POSITIONS = {
+    'Start': ('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1', [20, 400, 8902, 197281, 4865609]),
+    'Kiwipete': ('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1', [48, 2039, 97862, 4085603]),
+    'Position 3': ('8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1', [14, 191, 2812, 43238, 674624]),
+    'Position 4': ('r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1', [6, 264, 9467, 422333]),
+    'Position 5': ('rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8', [44, 1486, 62379, 2103487]),
+    'Position 6': ('r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10', [46, 2079, 89890, 3894594]),
+}
+
+# Counts the leaf nodes to the given depth, the moves of the last ply are counted without being played
+def perft(game, depth):
+    if depth == 0:
+        return 1
+    moves = generate_legal_moves(game.board, game.current_turn, game.enpassant_square, game.castling_rights)
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for selected_piece, new_row, new_col, special, promotion in moves:
+        undo = game.make_move(selected_piece, new_row, new_col, special, promotion)
+        nodes += perft(game, depth - 1)
+        game.unmake_move(undo)
+    return nodes
+
+# Perft split by root move for tracking down a wrong count against another engine's divide output
+def divide(game, depth):
+    counts = {}
+    for selected_piece, new_row, new_col, special, promotion in generate_legal_moves(game.board, game.current_turn, game.enpassant_square, game.castling_rights):
+        undo = game.make_move(selected_piece, new_row, new_col, special, promotion)
+        counts[move_string(selected_piece, new_row, new_col, promotion)] = perft(game, depth - 1)
+        game.unmake_move(undo)
+    return counts
+
+# Runs every standard position to the deepest depth whose published count stays within max_nodes,
+# printing nodes per second and whether the count matches. Returns True when every count matched
+def run_suite(max_depth=3, max_nodes=100000):
+    all_passed = True
+    print(f"{'Position':<14}{'Depth':>6}{'Nodes':>12}{'Expected':>12}{'Seconds':>10}{'Nodes/s':>12}  Result")
+    for name, (fen, expected_counts) in PERFT_POSITIONS.items():
+        for depth, expected in enumerate(expected_counts[:max_depth], start=1):
+            if expected > max_nodes:
+                break
+            game = game_from_fen(fen)
+            start = time.perf_counter()
+            nodes = perft(game, depth)
+            elapsed = time.perf_counter() - start
+            passed = nodes == expected
+            all_passed = all_passed and passed
+            print(f"{name:<14}{depth:>6}{nodes:>12}{expected:>12}{elapsed:>10.2f}{nodes / elapsed:>12.0f}  {'ok' if passed else 'FAIL'}")
+    return all_passed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Count legal move tree nodes to check and benchmark the move generator')
+    parser.add_argument('--fen', help='position to search, runs the standard suite when omitted')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--divide', action='store_true', help='print the node count under each root move')
+    parser.add_argument('--max-nodes', type=int, default=100000, help='skip suite depths with more nodes than this')
+    args = parser.parse_args()
+
+    if args.fen is None:
+        raise SystemExit(0 if run_suite(args.depth, args.max_nodes) else 1)
+    game = game_from_fen(args.fen)
+    start = time.perf_counter()
+    if args.divide:
+        counts = divide(game, args.depth)
+        for move, count in counts.items():
+            print(f"{move}: {count}")
+        nodes = sum(counts.values())
+    else:
+        nodes = perft(game, args.depth)
+    elapsed = time.perf_counter() - start
+    print(f"Nodes: {nodes}  Time: {elapsed:.2f}s  Nodes/s: {nodes / elapsed:.0f}")
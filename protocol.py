@@ -0,0 +1,152 @@
+import time
+from analysis import analyse_position
+
+## Delta protocol
+# Instead of both games being pickled both ways every frame, clients send only the commands their player made
+# since the last exchange and the server appends them to a log kept per session. Every request carries the
+# sequence number of the last logged command the client has applied and the reply holds the commands logged
+# since, so a poll with nothing new costs a few dozen bytes each way. A request is (sequence, commands) and a
+# reply (paired, events), an event being the (is_white, command) of the player who sent it. Commands are tuples:
+#   (MOVE, row, col, new_row, new_col, special, promotion)
+#   (UNDO,), (RESIGN,) and (DRAW,)
+#   (SUBSCRIBE,), not logged, asks the server to push replies instead of waiting for requests
+# A subscribed client only sends requests when its player did something, and a heartbeat when it has been idle
+# for HEARTBEAT_INTERVAL. The server answers every request and pushes a reply whenever the opponent's commands or
+# joining change the session, so an idle game costs one small round trip every few seconds instead of one a frame
+
+MOVE, UNDO, RESIGN, DRAW, SUBSCRIBE = 0, 1, 2, 3, 4
+HEARTBEAT_INTERVAL = 5.0
+# Without a reply to its heartbeats for this long the server is taken for gone
+SERVER_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+
+# Helper function to turn a Game.moves record into a move command, a promotion changes the piece of its end square
+def move_command(record):
+    start, end, _, special_string = record
+    promotion = end[0] if end[0] != start[0] else None
+    return (MOVE, int(start[1]), int(start[2]), int(end[1]), int(end[2]), special_string != '', promotion)
+
+# Helper function for the promotion dialog, a pawn on the last rank has moved but is not promoted yet
+def promotion_pending(game):
+    return 'p' in game.board[7] or 'P' in game.board[0]
+
+# Helper function to check that a command has the shape of one of the commands above
+def well_formed(command):
+    if not isinstance(command, tuple) or not command:
+        return False
+    if command[0] == MOVE:
+        return len(command) == 7 and all(type(value) is int and 0 <= value < 8 for value in command[1:5]) and \
+            type(command[5]) is bool and command[6] in (None, 'Q', 'R', 'B', 'N', 'q', 'r', 'b', 'n')
+    return command in ((UNDO,), (RESIGN,), (DRAW,), (SUBSCRIBE,))
+
+# Helper function to check a command of the opponent against the game before playing it: a move must be legal for
+# the side to move, which has to be the sender, with the promotion piece given exactly when a pawn promotes
+def valid_command(game, is_white, command):
+    if not well_formed(command) or command == (SUBSCRIBE,):
+        return False
+    if command[0] == MOVE:
+        if is_white != game.current_turn or game.end_position:
+            return False
+        _, row, col, new_row, new_col, special, promotion = command
+        move = ((row, col), new_row, new_col, special, promotion)
+        return move in analyse_position(game, game.current_turn).legal_moves
+    if command[0] == UNDO:
+        return len(game.moves) > 0
+    return True
+
+# Client side of the protocol. Commands are found by comparing the game's move records with those already
+# reported, so the game window keeps playing moves, undoing and ending games on its Game as before
+class GameSync:
+
+    def __init__(self):
+        self.sequence = 0
+        self.paired = False
+        # Copies of the Game.moves records the log accounts for
+        self.reported = []
+        self.reported_end = False
+        # Times of the last request and of the last reply in the push mode
+        self.sent_at = None
+        self.received_at = None
+
+    # Commands for everything the player did since the last exchange, a move awaiting its promotion piece waits
+    def commands(self, game):
+        moves = game.moves
+        if promotion_pending(game):
+            moves = moves[:-1]
+        reported = self.reported
+        if len(moves) == len(reported) and (not moves or moves[-1] == reported[-1]):
+            commands = []
+        else:
+            common = 0
+            while common < len(moves) and common < len(reported) and moves[common] == reported[common]:
+                common += 1
+            commands = [(UNDO,)] * (len(reported) - common) + [move_command(record) for record in moves[common:]]
+            self.reported = reported[:common] + [record[:] for record in moves[common:]]
+        if game.forced_end and not self.reported_end:
+            self.reported_end = True
+            commands.append((RESIGN,) if 'RESIGNATION' in game.forced_end else (DRAW,))
+        return tuple(commands)
+
+    # Plays the opponent's commands on the game, the player's own ones come back too and are skipped. Commands
+    # the game does not allow are dropped instead of breaking it. Returns True when the game changed
+    def apply(self, game, events):
+        self.sequence += len(events)
+        changed = False
+        for is_white, command in events:
+            if is_white == game._starting_player or not valid_command(game, is_white, command):
+                continue
+            changed = True
+            if command[0] == MOVE:
+                _, row, col, new_row, new_col, special, promotion = command
+                game.update_state(new_row, new_col, (row, col), special)
+                if promotion is not None:
+                    game.promote_to_piece(new_row, new_col, promotion)
+                # The opponent's client ends the game on its side, this side finds the same end itself
+                checkmate, remaining_moves = analyse_position(game, game.current_turn).end_state()
+                if checkmate or remaining_moves == 0 or game.threefold_check():
+                    game.end_position = True
+                    game.add_end_game_notation(checkmate)
+            elif command[0] == UNDO:
+                game.undo_move()
+            elif not game.end_position:
+                game.end_position = True
+                self.reported_end = True
+                if command[0] == RESIGN:
+                    game.forced_end = "BLACK RESIGNATION" if game._starting_player else "WHITE RESIGNATION"
+                    game.add_end_game_notation(True)
+                else:
+                    game.forced_end = "DRAW"
+                    game.add_end_game_notation(False)
+        if changed:
+            moves = game.moves[:-1] if promotion_pending(game) else game.moves
+            self.reported = [record[:] for record in moves]
+        return changed
+
+    # One round trip through a network.Network, returns True when the opponent changed the game
+    def exchange(self, network, game):
+        reply = network.send((self.sequence, self.commands(game)))
+        if reply is None:
+            raise ConnectionError("No reply from the server")
+        self.paired, events = reply
+        return self.apply(game, events)
+
+    # Switches a network.Network to the push mode, replies then come from its inbox through update
+    def subscribe(self, network):
+        network.subscribe((self.sequence, ((SUBSCRIBE,),)))
+        self.sent_at = self.received_at = time.monotonic()
+
+    # Called every frame in the push mode. Sends the player's commands, or a heartbeat once idle for long enough,
+    # and plays whatever the server pushed without waiting for it. Returns True when the opponent changed the game
+    def update(self, network, game):
+        now = time.monotonic()
+        commands = self.commands(game)
+        if commands or now - self.sent_at >= HEARTBEAT_INTERVAL:
+            network.post((self.sequence, commands))
+            self.sent_at = now
+        changed = False
+        for paired, events in network.receive():
+            self.received_at = now
+            self.paired = paired
+            changed = self.apply(game, events) or changed
+        if now - self.received_at > SERVER_TIMEOUT:
+            raise ConnectionError("No reply from the server")
+        return changed
@@ -0,0 +1,727 @@
+from bitboard import bitboard_moves, bitboard_is_square_attacked, bitboard_is_check, bitboard_is_checkmate_or_stalemate, board_from_placement
+
+# Chess rules shared by the client, the server and headless tools, kept free of pygame so they run without a display
+
+# Move generation backend used by calculate_moves, is_check and is_checkmate_or_stalemate when none is passed in;
+# 'list' walks the board lists directly and 'bitboard' converts the board into 64-bit integers per piece type
+MOVE_BACKENDS = ['list', 'bitboard']
+MOVE_BACKEND = 'list'
+
+## Move Records
+# Helper function for generating bespoke Game moves
+def output_move(piece, selected_piece, new_row, new_col, potential_capture, special_string= ''):
+    return [piece+str(selected_piece[0])+str(selected_piece[1]), piece+str(new_row)+str(new_col), potential_capture, special_string]
+
+# King destinations of castling moves mapped to the rook's start and end squares
+CASTLE_ROOK_MOVES = {
+    (7, 2): ((7, 0), (7, 3)),
+    (7, 6): ((7, 7), (7, 5)),
+    (0, 2): ((0, 0), (0, 3)),
+    (0, 6): ((0, 7), (0, 5))
+}
+
+# Helper function to play a move on the board in place, returning a small undo record instead of copying the board
+# special_string follows output_move: '' for standard moves, 'enpassant' or 'castle'
+def make_board_move(board, selected_piece, new_row, new_col, special_string='', promotion=None):
+    start_row, start_col = selected_piece
+    piece = board[start_row][start_col]
+    captured = board[new_row][new_col]
+    board[new_row][new_col] = piece if promotion is None else promotion
+    board[start_row][start_col] = ' '
+    if special_string == 'enpassant':
+        # The captured pawn sits beside the capturing pawn, on its starting row
+        captured = board[start_row][new_col]
+        board[start_row][new_col] = ' '
+    elif special_string == 'castle':
+        rook_start, rook_end = CASTLE_ROOK_MOVES[(new_row, new_col)]
+        board[rook_end[0]][rook_end[1]] = board[rook_start[0]][rook_start[1]]
+        board[rook_start[0]][rook_start[1]] = ' '
+    return (selected_piece, new_row, new_col, piece, captured, special_string)
+
+# Helper function to restore the board from an undo record of make_board_move
+def unmake_board_move(board, undo):
+    selected_piece, new_row, new_col, piece, captured, special_string = undo
+    start_row, start_col = selected_piece
+    board[start_row][start_col] = piece
+    if special_string == 'enpassant':
+        board[new_row][new_col] = ' '
+        board[start_row][new_col] = captured
+    else:
+        board[new_row][new_col] = captured
+        if special_string == 'castle':
+            rook_start, rook_end = CASTLE_ROOK_MOVES[(new_row, new_col)]
+            board[rook_start[0]][rook_start[1]] = board[rook_end[0]][rook_end[1]]
+            board[rook_end[0]][rook_end[1]] = ' '
+
+## Position state
+# Castling rights are packed into four bits so they can be copied, compared and hashed as a single integer
+WHITE_KING_SIDE, WHITE_QUEEN_SIDE, BLACK_KING_SIDE, BLACK_QUEEN_SIDE = 1, 2, 4, 8
+ALL_CASTLING_RIGHTS = WHITE_KING_SIDE | WHITE_QUEEN_SIDE | BLACK_KING_SIDE | BLACK_QUEEN_SIDE
+
+# Rights kept when a move starts or ends on a square, moving a king or rook or capturing a rook in its corner clears them
+CASTLING_RIGHTS_MASKS = [[ALL_CASTLING_RIGHTS] * 8 for _ in range(8)]
+CASTLING_RIGHTS_MASKS[7][4] = BLACK_KING_SIDE | BLACK_QUEEN_SIDE
+CASTLING_RIGHTS_MASKS[7][7] = ALL_CASTLING_RIGHTS ^ WHITE_KING_SIDE
+CASTLING_RIGHTS_MASKS[7][0] = ALL_CASTLING_RIGHTS ^ WHITE_QUEEN_SIDE
+CASTLING_RIGHTS_MASKS[0][4] = WHITE_KING_SIDE | WHITE_QUEEN_SIDE
+CASTLING_RIGHTS_MASKS[0][7] = ALL_CASTLING_RIGHTS ^ BLACK_KING_SIDE
+CASTLING_RIGHTS_MASKS[0][0] = ALL_CASTLING_RIGHTS ^ BLACK_QUEEN_SIDE
+
+# Helper function to pack the Game castle attributes into castling rights
+def castling_rights_from_attributes(castle_attributes):
+    rights = 0
+    if not castle_attributes['white_king_moved']:
+        if not castle_attributes['right_white_rook_moved']:
+            rights |= WHITE_KING_SIDE
+        if not castle_attributes['left_white_rook_moved']:
+            rights |= WHITE_QUEEN_SIDE
+    if not castle_attributes['black_king_moved']:
+        if not castle_attributes['right_black_rook_moved']:
+            rights |= BLACK_KING_SIDE
+        if not castle_attributes['left_black_rook_moved']:
+            rights |= BLACK_QUEEN_SIDE
+    return rights
+
+# Helper function to read the en passant target square left by the last move of a move history
+def enpassant_square_from_history(game_history):
+    if game_history is None or len(game_history) == 0:
+        return None
+    start, end = game_history[-1][0], game_history[-1][1]
+    # En-passant condition: A pawn moves twice, the target is the square it passed over
+    if start[0] in ['p', 'P'] and end[0] == start[0] and abs(int(start[1]) - int(end[1])) == 2:
+        return ((int(start[1]) + int(end[1])) // 2, int(end[2]))
+    return None
+
+# Helper function for the en passant square and castling rights after a move, both are updated in O(1)
+def next_position_state(piece, selected_piece, new_row, new_col, castling_rights):
+    enpassant_square = None
+    if piece in ['p', 'P'] and abs(new_row - selected_piece[0]) == 2:
+        enpassant_square = ((selected_piece[0] + new_row) // 2, new_col)
+    castling_rights &= CASTLING_RIGHTS_MASKS[selected_piece[0]][selected_piece[1]] & CASTLING_RIGHTS_MASKS[new_row][new_col]
+    return enpassant_square, castling_rights
+
+# Helper function to read a FEN string into a board, side to move, castling rights and en passant square
+def parse_fen(fen):
+    fields = fen.split()
+    board = board_from_placement(fields[0])
+    is_white_turn = len(fields) < 2 or fields[1] == 'w'
+    castling_rights = 0
+    if len(fields) > 2:
+        for char, right in zip('KQkq', [WHITE_KING_SIDE, WHITE_QUEEN_SIDE, BLACK_KING_SIDE, BLACK_QUEEN_SIDE]):
+            if char in fields[2]:
+                castling_rights |= right
+    enpassant_square = None
+    if len(fields) > 3 and fields[3] != '-':
+        enpassant_square = (8 - int(fields[3][1]), ord(fields[3][0]) - ord('a'))
+    return board, is_white_turn, castling_rights, enpassant_square
+
+# Helper function to write a position as the first four FEN fields, a compact form for sending positions elsewhere
+def position_to_fen(board, is_white_turn, castling_rights, enpassant_square):
+    ranks = []
+    for row in board:
+        rank, empty = '', 0
+        for piece in row:
+            if piece == ' ':
+                empty += 1
+                continue
+            if empty:
+                rank += str(empty)
+                empty = 0
+            rank += piece
+        ranks.append(rank + str(empty) if empty else rank)
+    castling = ''.join(char for char, right in zip('KQkq', [WHITE_KING_SIDE, WHITE_QUEEN_SIDE, BLACK_KING_SIDE, BLACK_QUEEN_SIDE])
+                       if castling_rights & right)
+    enpassant = '-' if enpassant_square is None else 'abcdefgh'[enpassant_square[1]] + str(8 - enpassant_square[0])
+    return f"{'/'.join(ranks)} {'w' if is_white_turn else 'b'} {castling or '-'} {enpassant}"
+
+## Precomputed move tables
+# Offsets are listed in the order the move generators have always returned them
+KNIGHT_OFFSETS = [(-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)]
+KING_OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+# Rook rays go right, left, down then up; bishop rays go top-left, top-right, bottom-left then bottom-right
+ROOK_DIRECTIONS = [(0, 1), (0, -1), (1, 0), (-1, 0)]
+BISHOP_DIRECTIONS = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+# Helper function to build a table of in-bound jump targets for every square
+def build_jump_table(offsets):
+    return [[[(row + dr, col + dc) for dr, dc in offsets if 0 <= row + dr < 8 and 0 <= col + dc < 8]
+             for col in range(8)] for row in range(8)]
+
+# Helper function to build a table of rays for every square, each ray lists squares from nearest to furthest
+def build_ray_table(directions):
+    table = []
+    for row in range(8):
+        table_row = []
+        for col in range(8):
+            rays = []
+            for dr, dc in directions:
+                ray = []
+                r, c = row + dr, col + dc
+                while 0 <= r < 8 and 0 <= c < 8:
+                    ray.append((r, c))
+                    r, c = r + dr, c + dc
+                rays.append(ray)
+            table_row.append(rays)
+        table.append(table_row)
+    return table
+
+# Tables are built once at import and indexed as TABLE[row][col]
+KNIGHT_TABLE = build_jump_table(KNIGHT_OFFSETS)
+KING_TABLE = build_jump_table(KING_OFFSETS)
+ROOK_RAYS = build_ray_table(ROOK_DIRECTIONS)
+BISHOP_RAYS = build_ray_table(BISHOP_DIRECTIONS)
+
+## Move logic
+# Helper function to switch the default move generation backend
+def set_move_backend(backend):
+    global MOVE_BACKEND
+    if backend not in MOVE_BACKENDS:
+        raise ValueError(f"Unknown move backend {backend}, expected one of {MOVE_BACKENDS}")
+    MOVE_BACKEND = backend
+
+# Helper function to calculate moves for a pawn
+def pawn_moves(board, row, col, is_white):
+    moves = []
+    captures = []
+
+    # Pawn moves one square forward
+    if is_white:
+        if row > 0 and board[row - 1][col] == ' ':
+            moves.append((row - 1, col))
+    else:
+        if row < 7 and board[row + 1][col] == ' ':
+            moves.append((row + 1, col))
+
+    # Pawn's initial double move
+    if is_white:
+        if row == 6 and board[row - 1][col] == ' ' \
+                    and board[row - 2][col] == ' ':
+            moves.append((row - 2, col))
+    else:
+        if row == 1 and board[row + 1][col] == ' ' \
+                    and board[row + 2][col] == ' ':
+            moves.append((row + 2, col))
+
+    # No captures possible when pawns reach the end, otherwise list index out of range
+    if is_white and row == 0 or not is_white and row == 7:
+        return moves, captures
+
+    # Pawn captures diagonally
+    forwards = -1 if is_white else 1 # The forward direction for white is counting down rows
+    if row > 0 and col > 0 and board[row + forwards][col - 1] != ' ' and \
+        board[row + forwards][col - 1].islower() == is_white:
+        moves.append((row + forwards, col - 1))
+        captures.append((row + forwards, col - 1))
+    if row > 0 and col < 7 and board[row + forwards][col + 1] != ' ' \
+        and board[row + forwards][col + 1].islower() == is_white:
+        moves.append((row + forwards, col + 1))
+        captures.append((row + forwards, col + 1))
+
+    return moves, captures
+
+# Helper function to calculate moves for a rook
+def rook_moves(board, row, col, is_white):
+    moves = []
+    captures = []
+
+    # Rook moves horizontally then vertically along its precomputed rays
+    for ray in ROOK_RAYS[row][col]:
+        for square in ray:
+            target = board[square[0]][square[1]]
+            if target == ' ':
+                moves.append(square)
+            else:
+                if target.islower() == is_white:
+                    moves.append(square)
+                    captures.append(square)
+                break
+
+    return moves, captures
+
+# Helper function to calculate moves for a knight
+def knight_moves(board, row, col, is_white):
+    moves = []
+    captures = []
+
+    # Out of bound squares are already removed from the table
+    for square in KNIGHT_TABLE[row][col]:
+        target = board[square[0]][square[1]]
+        if target == ' ':
+            moves.append(square)
+        # Remove moves that would capture the player's own pieces
+        elif target.islower() == is_white:
+            moves.append(square)
+            captures.append(square)
+
+    return moves, captures
+
+# Helper function to calculate moves for a bishop
+def bishop_moves(board, row, col, is_white):
+    moves = []
+    captures = []
+
+    # Bishop moves diagonally: top-left, top-right, bottom-left then bottom-right
+    for ray in BISHOP_RAYS[row][col]:
+        for square in ray:
+            target = board[square[0]][square[1]]
+            if target == ' ': # Vacant spaces
+                moves.append(square)
+            elif target.islower() == is_white: # Opposite pieces
+                moves.append(square)
+                captures.append(square)
+                break
+            else: # Allied pieces encountered
+                break
+
+    return moves, captures
+
+# Helper function to calculate moves for a queen
+def queen_moves(board, row, col, is_white):
+    moves = []
+    captures = []
+
+    # Bishop-like moves
+    b_moves, b_captures = bishop_moves(board, row, col, is_white)
+    moves.extend(b_moves)
+    captures.extend(b_captures)
+
+    # Rook-like moves
+    r_moves, r_captures = rook_moves(board, row, col, is_white)
+    moves.extend(r_moves)
+    captures.extend(r_captures)
+
+    return moves, captures
+
+# Helper function to calculate moves for a king
+def king_moves(board, row, col, is_white):
+    moves = []
+    captures = []
+
+    # King can move to all eight adjacent squares, out of bound squares are already removed from the table
+    for square in KING_TABLE[row][col]:
+        target = board[square[0]][square[1]]
+        if target == ' ':
+            moves.append(square)
+        # Remove moves that would capture the player's own pieces
+        elif target.islower() == is_white:
+            moves.append(square)
+            captures.append(square)
+
+    return moves, captures
+
+# Helper function to return moves for the selected piece
+def calculate_moves(board, row, col, game_history=None, castle_attributes=None, only_specials=False, backend=None,
+                    enpassant_square=None, castling_rights=None):
+    # only_specials input for only calculating special moves, this is used when updating the dictionary of board states
+    # of the game class. Special available moves are one attribute of a unique state
+    # The en passant square and castling rights are read directly when given, otherwise they are derived
+    # from the last move of the game history and the castle attributes
+    piece = board[row][col]
+    moves = []
+    captures = []
+    special_moves = []
+
+    is_white = piece.isupper()
+
+    backend = backend or MOVE_BACKEND
+    if backend == 'bitboard' and not only_specials and piece.lower() in ['p', 'r', 'n', 'b', 'q', 'k']:
+        # The bitboard backend produces the standard moves of every piece, leaving only specials to the branches below
+        moves, captures = bitboard_moves(board, row, col)
+        only_specials = True
+
+    if piece.lower() == 'p':  # Pawn
+        if not only_specials:
+            p_moves, p_captures = pawn_moves(board, row, col, is_white)
+            moves.extend(p_moves)
+            captures.extend(p_captures)
+        
+        if enpassant_square is None:
+            enpassant_square = enpassant_square_from_history(game_history)
+        # En-passant condition: The opposing pawn passed over a square diagonally in front of this pawn
+        if enpassant_square is not None and abs(col - enpassant_square[1]) == 1 and \
+            ((is_white and row == 3 and enpassant_square[0] == 2) or (not is_white and row == 4 and enpassant_square[0] == 5)):
+            special_moves.append(enpassant_square)
+
+    elif piece.lower() == 'r':  # Rook
+        if not only_specials:
+            r_moves, r_captures = rook_moves(board, row, col, is_white)
+            moves.extend(r_moves)
+            captures.extend(r_captures)
+
+    elif piece.lower() == 'n':  # Knight (L-shaped moves)
+        if not only_specials:
+            n_moves, n_captures = knight_moves(board, row, col, is_white)
+            moves.extend(n_moves)
+            captures.extend(n_captures)
+
+    elif piece.lower() == 'b':  # Bishop
+        if not only_specials:
+            b_moves, b_captures = bishop_moves(board, row, col, is_white)
+            moves.extend(b_moves)
+            captures.extend(b_captures)
+
+    elif piece.lower() == 'q':  # Queen (Bishop-like + Rook-like moves)
+        if not only_specials:
+            q_moves, q_captures = queen_moves(board, row, col, is_white)
+            moves.extend(q_moves)
+            captures.extend(q_captures)
+
+    elif piece.lower() == 'k':  # King
+        if not only_specials:
+            k_moves, k_captures = king_moves(board, row, col, is_white)
+            moves.extend(k_moves)
+            captures.extend(k_captures)
+        
+        # Using these rights instead of a game copy eliminates the need to deepcopy the game below
+        if castling_rights is None and castle_attributes is not None:
+            castling_rights = castling_rights_from_attributes(castle_attributes)
+        if castling_rights is not None:
+            # Castling
+            queen_castle = False
+            king_castle = False
+            if is_white:
+                king_side, queen_side = castling_rights & WHITE_KING_SIDE, castling_rights & WHITE_QUEEN_SIDE
+                king_row = 7
+                rook_piece = 'R'
+            else:
+                king_side, queen_side = castling_rights & BLACK_KING_SIDE, castling_rights & BLACK_QUEEN_SIDE
+                king_row = 0
+                rook_piece = 'r'
+
+            # Empty squares between king and rook, and the unmoved rook must not have been captured in its corner
+            queen_side_clear = queen_side and board[king_row][0] == rook_piece and \
+                all(element == ' ' for element in board[king_row][1:4])
+            king_side_clear = king_side and board[king_row][7] == rook_piece and \
+                all(element == ' ' for element in board[king_row][5:7])
+
+            # Not moving through/into check and not currently under check
+            if row == king_row and col == 4 and (queen_side_clear or king_side_clear) and \
+                not is_square_attacked(board, king_row, 4, not is_white, backend):
+                if queen_side_clear:
+                    queen_castle = not any(is_square_attacked(board, king_row, placement_col, not is_white, backend) for placement_col in [3, 2])
+                if king_side_clear:
+                    king_castle = not any(is_square_attacked(board, king_row, placement_col, not is_white, backend) for placement_col in [5, 6])
+
+            if queen_castle:
+                king_pos = (7, 2) if is_white else (0, 2) 
+                special_moves.append(king_pos)
+            if king_castle:
+                king_pos = (7, 6) if is_white else (0, 6) 
+                special_moves.append(king_pos)
+    elif piece == ' ':
+        return [], [], []
+    else:
+        return ValueError
+    
+    return moves, captures, special_moves
+
+## Board State Check Logic
+# Helper function to calculate if a board does not have a king
+def is_invalid_capture(board, is_color):
+    # Find the king's position
+    king = 'K' if is_color else 'k'
+    king_position = None
+    for row in range(8):
+        for col in range(8):
+            if board[row][col] == king:
+                king_position = (row, col)
+                break
+    if king_position is None:
+        return True # Illegal move that is not allowed, likely in debug mode
+    else:
+        return False
+
+# Helper function to find the king of a colour, only the ranks holding it are indexed
+def find_king(board, is_color):
+    king = 'K' if is_color else 'k'
+    for row, rank in enumerate(board):
+        if king in rank:
+            return row, rank.index(king)
+    return None
+
+# Helper function to check if a square is attacked by a colour
+# Looks outward from the square along rays, knight jumps and pawn diagonals and stops at the first blocker
+def is_square_attacked(board, row, col, by_white, backend=None):
+    if (backend or MOVE_BACKEND) == 'bitboard':
+        return bitboard_is_square_attacked(board, row, col, by_white)
+    if by_white:
+        pawn, knight, bishop, rook, queen, king = 'P', 'N', 'B', 'R', 'Q', 'K'
+        pawn_row = row + 1 # White pawns attack towards row 0 so they sit one row below the square
+    else:
+        pawn, knight, bishop, rook, queen, king = 'p', 'n', 'b', 'r', 'q', 'k'
+        pawn_row = row - 1
+
+    if 0 <= pawn_row < 8:
+        if col > 0 and board[pawn_row][col - 1] == pawn:
+            return True
+        if col < 7 and board[pawn_row][col + 1] == pawn:
+            return True
+
+    for r, c in KNIGHT_TABLE[row][col]:
+        if board[r][c] == knight:
+            return True
+
+    for r, c in KING_TABLE[row][col]:
+        if board[r][c] == king:
+            return True
+
+    for ray in ROOK_RAYS[row][col]:
+        for r, c in ray:
+            target = board[r][c]
+            if target != ' ':
+                if target == rook or target == queen:
+                    return True
+                break
+
+    for ray in BISHOP_RAYS[row][col]:
+        for r, c in ray:
+            target = board[r][c]
+            if target != ' ':
+                if target == bishop or target == queen:
+                    return True
+                break
+
+    return False
+
+# Helper function to search for checks
+def is_check(board, is_color, moves=None, backend=None):
+    if (backend or MOVE_BACKEND) == 'bitboard':
+        return bitboard_is_check(board, is_color)
+    king_position = find_king(board, is_color)
+    # No king to attack, likely in debug mode
+    if king_position is None:
+        return False
+    # Check if any opponent's pieces can attack the king
+    return is_square_attacked(board, king_position[0], king_position[1], not is_color, 'list')
+
+# Helper function to find the checks and pins against a king, computed once per position
+# Returns the king position, the checking squares, the squares that block or capture a single checker
+# and a mapping of each pinned piece to the squares it may still move to along its pin
+def calculate_pins_and_checks(board, is_color):
+    pins = {}
+    checkers = []
+    evasions = set()
+    king_position = find_king(board, is_color)
+    if king_position is None:
+        return king_position, checkers, evasions, pins
+    row, col = king_position
+    if is_color:
+        pawn, knight, bishop, rook, queen, king = 'p', 'n', 'b', 'r', 'q', 'k'
+        pawn_row = row - 1 # Black pawns attack towards row 7 so they sit one row above the king
+    else:
+        pawn, knight, bishop, rook, queen, king = 'P', 'N', 'B', 'R', 'Q', 'K'
+        pawn_row = row + 1
+
+    # Walk outward from the king, the first allied piece on a ray is pinned if an enemy slider sits behind it
+    for rays, slider in [(ROOK_RAYS[row][col], rook), (BISHOP_RAYS[row][col], bishop)]:
+        for ray in rays:
+            blocker = None
+            for index, square in enumerate(ray):
+                target = board[square[0]][square[1]]
+                if target == ' ':
+                    continue
+                if target.isupper() == is_color:
+                    if blocker is None:
+                        blocker = square
+                        continue
+                    break
+                if target == slider or target == queen:
+                    if blocker is None:
+                        checkers.append(square)
+                        evasions.update(ray[:index + 1])
+                    else:
+                        pins[blocker] = set(ray[:index + 1])
+                break
+
+    for square in KNIGHT_TABLE[row][col]:
+        if board[square[0]][square[1]] == knight:
+            checkers.append(square)
+            evasions.add(square)
+
+    # Adjacent kings only happen on debug boards but are treated like any other attacker
+    for square in KING_TABLE[row][col]:
+        if board[square[0]][square[1]] == king:
+            checkers.append(square)
+            evasions.add(square)
+
+    if 0 <= pawn_row < 8:
+        for pawn_col in [col - 1, col + 1]:
+            if 0 <= pawn_col < 8 and board[pawn_row][pawn_col] == pawn:
+                checkers.append((pawn_row, pawn_col))
+                evasions.add((pawn_row, pawn_col))
+
+    return king_position, checkers, evasions, pins
+
+# Helper function to return only the legal moves for the selected piece
+# pin_info from calculate_pins_and_checks can be passed in to share it between all pieces of a position
+def calculate_legal_moves(board, row, col, game_history=None, castle_attributes=None, pin_info=None, backend=None,
+                          enpassant_square=None, castling_rights=None):
+    piece = board[row][col]
+    if piece == ' ':
+        return [], [], []
+    is_white = piece.isupper()
+    moves, captures, special_moves = calculate_moves(board, row, col, game_history, castle_attributes, backend=backend,
+                                                     enpassant_square=enpassant_square, castling_rights=castling_rights)
+    if pin_info is None:
+        pin_info = calculate_pins_and_checks(board, is_white)
+    king_position, checkers, evasions, pins = pin_info
+
+    # No king to protect, likely in debug mode
+    if king_position is None:
+        return moves, captures, special_moves
+
+    if piece.lower() == 'k':
+        # Lift the king so squares behind it along a checking ray are seen as attacked
+        board[row][col] = ' '
+        moves = [move for move in moves if not is_square_attacked(board, move[0], move[1], not is_white, backend)]
+        board[row][col] = piece
+        captures = [move for move in captures if move in moves]
+        # Castling is already validated in calculate_moves
+        return moves, captures, special_moves
+
+    # Only the king can escape a double check
+    if len(checkers) > 1:
+        return [], [], []
+
+    allowed = pins.get((row, col))
+    if checkers:
+        allowed = evasions if allowed is None else allowed & evasions
+    if allowed is not None:
+        moves = [move for move in moves if move in allowed]
+        captures = [move for move in captures if move in allowed]
+
+    # En passant removes two pawns from a rank at once so it is tried on the board and restored straight after
+    legal_specials = []
+    for move in special_moves:
+        target, captured = board[move[0]][move[1]], board[row][move[1]]
+        board[move[0]][move[1]], board[row][col], board[row][move[1]] = piece, ' ', ' '
+        if not is_square_attacked(board, king_position[0], king_position[1], not is_white, backend):
+            legal_specials.append(move)
+        board[move[0]][move[1]], board[row][col], board[row][move[1]] = target, piece, captured
+
+    return moves, captures, legal_specials
+
+# Helper function to list the pieces of a colour that attack a square, kings excluded
+def square_attackers(board, row, col, by_white):
+    if by_white:
+        pawn, knight, bishop, rook, queen = 'P', 'N', 'B', 'R', 'Q'
+        pawn_row = row + 1
+    else:
+        pawn, knight, bishop, rook, queen = 'p', 'n', 'b', 'r', 'q'
+        pawn_row = row - 1
+    attackers = []
+    if 0 <= pawn_row < 8:
+        for pawn_col in [col - 1, col + 1]:
+            if 0 <= pawn_col < 8 and board[pawn_row][pawn_col] == pawn:
+                attackers.append((pawn_row, pawn_col))
+    for r, c in KNIGHT_TABLE[row][col]:
+        if board[r][c] == knight:
+            attackers.append((r, c))
+    for rays, slider in [(ROOK_RAYS[row][col], rook), (BISHOP_RAYS[row][col], bishop)]:
+        for ray in rays:
+            for r, c in ray:
+                target = board[r][c]
+                if target != ' ':
+                    if target == slider or target == queen:
+                        attackers.append((r, c))
+                    break
+    return attackers
+
+# Helper function to find whether a side has any legal move, it returns on the first one found
+# The king is tried first as it can usually step somewhere, then under check the pieces that can capture the checker
+def has_legal_move(board, is_color, enpassant_square=None, pin_info=None):
+    if pin_info is None:
+        pin_info = calculate_pins_and_checks(board, is_color)
+    king_position, checkers, _, _ = pin_info
+    tried = set()
+    if king_position is not None:
+        # Castling is never needed here, the king can always step onto the square it would pass over
+        if calculate_legal_moves(board, king_position[0], king_position[1], pin_info=pin_info, backend='list')[0]:
+            return True
+        if len(checkers) > 1:
+            return False
+        tried.add(king_position)
+        if checkers:
+            for row, col in square_attackers(board, checkers[0][0], checkers[0][1], is_color):
+                tried.add((row, col))
+                legal_moves, _, legal_specials = calculate_legal_moves(board, row, col, pin_info=pin_info, backend='list',
+                                                                       enpassant_square=enpassant_square)
+                if legal_moves or legal_specials:
+                    return True
+
+    for row in range(8):
+        for col in range(8):
+            piece = board[row][col]
+            if piece != ' ' and piece.isupper() == is_color and (row, col) not in tried:
+                legal_moves, _, legal_specials = calculate_legal_moves(board, row, col, pin_info=pin_info, backend='list',
+                                                                       enpassant_square=enpassant_square)
+                if legal_moves or legal_specials:
+                    return True
+    return False
+
+# Helper function to search for end-game state
+# By default every legal move is counted for analysis, count_moves=False stops at the first legal move found
+# and the count returned is then only 0 or 1
+def is_checkmate_or_stalemate(board, is_color, moves=None, backend=None, enpassant_square=None, count_moves=True):
+    if enpassant_square is None:
+        enpassant_square = enpassant_square_from_history(moves)
+    if (backend or MOVE_BACKEND) == 'bitboard':
+        return bitboard_is_checkmate_or_stalemate(board, is_color, enpassant_square, count_moves)
+    possible_moves = 0
+    # Checks and pins are found once, every move generated below is already legal
+    pin_info = calculate_pins_and_checks(board, is_color)
+    # Consider this as a potential checkmate if under check
+    checkmate = len(pin_info[1]) != 0
+    if not count_moves:
+        if has_legal_move(board, is_color, enpassant_square, pin_info):
+            return False, 1
+        return checkmate, 0
+    
+    # Iterate through all the player's pieces
+    for row in range(8):
+        for col in range(8):
+            piece = board[row][col]
+            if piece.isupper() == is_color and piece != ' ':
+                # We never have to try castling moves because you can never castle under check
+                # En-passants can remove checks so they are counted with the other moves
+                legal_moves, _, legal_specials = calculate_legal_moves(board, row, col, pin_info=pin_info, backend='list',
+                                                                       enpassant_square=enpassant_square)
+                possible_moves += len(legal_moves) + len(legal_specials)
+
+    if possible_moves != 0:
+        checkmate = False
+
+    return checkmate, possible_moves
+
+# Pieces a pawn may promote to, strongest first
+PROMOTION_PIECES = ['Q', 'R', 'B', 'N']
+
+# Helper function to list every legal move of a side as (selected_piece, new_row, new_col, special, promotion) tuples
+# matching the Game.make_move arguments, pawn moves onto the last rank are expanded into one move per promotion piece
+def generate_legal_moves(board, is_color, enpassant_square=None, castling_rights=0, pin_info=None):
+    legal_moves = []
+    if pin_info is None:
+        pin_info = calculate_pins_and_checks(board, is_color)
+    last_row = 0 if is_color else 7
+    for row in range(8):
+        for col in range(8):
+            piece = board[row][col]
+            if piece == ' ' or piece.isupper() != is_color:
+                continue
+            moves, _, specials = calculate_legal_moves(board, row, col, pin_info=pin_info, backend='list',
+                                                       enpassant_square=enpassant_square, castling_rights=castling_rights)
+            if piece.lower() == 'p' and abs(row - last_row) == 1:
+                for new_row, new_col in moves:
+                    for promotion in PROMOTION_PIECES:
+                        legal_moves.append(((row, col), new_row, new_col, False, promotion if is_color else promotion.lower()))
+            else:
+                for new_row, new_col in moves:
+                    legal_moves.append(((row, col), new_row, new_col, False, None))
+            for new_row, new_col in specials:
+                legal_moves.append(((row, col), new_row, new_col, True, None))
+    return legal_moves
+
+# Helper function to write a move in coordinate notation, e.g. e2e4 or e7e8q
+def move_string(selected_piece, new_row, new_col, promotion=None):
+    string = 'abcdefgh'[selected_piece[1]] + str(8 - selected_piece[0]) + 'abcdefgh'[new_col] + str(8 - new_row)
+    return string + promotion.lower() if promotion else string
@@ -1,24 +1,29 @@
-import socket
-import pickle
-import struct
-from _thread import *
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
 from game import *
+from codec import FRAME_HEADER, decode, encode_frame
+from protocol import MOVE, UNDO, RESIGN, DRAW, SUBSCRIBE, well_formed
+
+## Game server
+# One asyncio event loop serves every connection instead of a thread per socket. Each pair of players shares a
+# GameSession holding their two games, only ever touched from the loop so no locking is needed. Messages are
+# length-prefixed frames in the binary format of codec.py. The first one sent to a client says whether it is the
+# starting player. Clients speaking the delta protocol of protocol.py then send (sequence, commands) requests and
+# are answered from the session's command log, legacy clients send their pickled Game and get the list of games
+# of the session back. Delta clients that subscribed are also sent a reply as soon as the session changes, they
+# do not poll
 
 server = ""
 port = 5555
-
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-try:
-    s.bind((server, port))
-except socket.error as err:
-    str(err)
-
-s.listen(2)
-print("Waiting for Connection, Server Started...")
-
-games = {}
-id_count = 0
+# A larger frame is a broken or hostile client, its connection is closed instead of buffering the frame
+MAX_FRAME_SIZE = 1 << 20
+# Bytes a connection may buffer before the server stops reading from it
+READ_LIMIT = 1 << 16
+MAX_CONNECTIONS = 10000
 
 new_board = [
     ['r', 'n', 'b', 'q', 'k', 'b', 'n', 'r'],
@@ -31,87 +36,292 @@ new_board = [
     ['R', 'N', 'B', 'Q', 'K', 'B', 'N', 'R']
 ]
 
-def send_data(conn, data):
-    """
-    Send data over the connection by first sending its length as a 4-byte integer,
-    followed by the actual data.
-    """
-    data_pickle = pickle.dumps(data)
-    data_length = len(data_pickle)
-    conn.send(struct.pack("!I", data_length))  # Send message length
-    conn.send(data_pickle)  # Send the actual data
-
-def receive_data(conn):
+async def read_frame(reader, allow_pickle=True):
     """
-    Receive data from the connection by first reading the message length,
-    then reading the actual data.
+    Read one length-prefixed frame and decode it, None once the connection is closed.
     """
-    data_length_bytes = conn.recv(4)  # Read 4 bytes for message length
-    if not data_length_bytes:
+    try:
+        data_length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))[0]
+        if data_length > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame of {data_length} bytes is too large")
+        return decode(await reader.readexactly(data_length), allow_pickle)
+    except asyncio.IncompleteReadError:
         return None
-    data_length = struct.unpack("!I", data_length_bytes)[0]  # Unpack message length
-    data = b""
-    while len(data) < data_length:
-        packet = conn.recv(data_length - len(data))
-        if not packet:
-            return None
-        data += packet
-    return pickle.loads(data)
-
-def threaded_client(conn, starting_player, game_id):
-    global id_count
-    send_data(conn, starting_player)
-
-    reply = ""
-    while True:
-        try:
-            data = receive_data(conn)
 
-            if game_id in games:
-                paired_games = games[game_id]
+# The two games of a pair of players, the starting player's first. The encoded reply is kept until either game
+# changes, clients poll every frame so most requests are answered without pickling anything
+class GameSession:
+
+    def __init__(self, game_id):
+        self.game_id = game_id
+        self.games = [Game([row[:] for row in new_board], True)]
+        self.open = True
+        self._reply = None
+        # (is_white, command) of every command sent in the delta protocol
+        self.log = []
+        # [writer, length of the log already sent] of the subscribed players by starting_player
+        self.subscribers = {}
+        # Moves standing in the log, white is to move when even, and whether a resignation or draw ended the game
+        self.plies = 0
+        self.ended = False
+
+    def join(self):
+        self.games.append(Game([row[:] for row in new_board], False))
+        self._reply = None
+        # A subscribed player waiting for an opponent is told it arrived
+        self.publish()
+
+    def update(self, starting_player, data):
+        index = 0 if starting_player else 1
+        current = self.games[index]
+        # I could just set sync to false upon end position reached, after turns, or move undone
+        if data.current_turn != current.current_turn or data._sync != current._sync or data.end_position != current.end_position:
+            self.games[index] = data
+            self._reply = None
+
+    # Logs a delta protocol client's commands and answers with everything logged since its sequence number.
+    # Commands are checked before any is logged, as they are relayed to the opponent: they must be well formed
+    # and moves must come from the side to move of a game still going. Raises ValueError otherwise
+    def exchange(self, starting_player, sequence, commands):
+        if type(sequence) is not int or not 0 <= sequence <= len(self.log):
+            raise ValueError(f"Sequence number {sequence!r} outside the log")
+        plies, ended = self.plies, self.ended
+        for command in commands:
+            if not well_formed(command):
+                raise ValueError(f"Malformed command {command!r}")
+            if command[0] == MOVE:
+                if ended or (plies % 2 == 0) != starting_player:
+                    raise ValueError("Move out of turn")
+                plies += 1
+            elif command[0] == UNDO:
+                if plies == 0:
+                    raise ValueError("No move to undo")
+                plies -= 1
+            elif command[0] in (RESIGN, DRAW):
+                ended = True
+        self.plies, self.ended = plies, ended
+        for command in commands:
+            if command[0] != SUBSCRIBE:
+                self.log.append((starting_player, command))
+        return len(self.games) == 2, self.log[sequence:]
+
+    def subscribe(self, starting_player, writer, sequence):
+        self.subscribers[starting_player] = [writer, sequence]
+
+    # Pushes what is new in the log to the subscribers, and a reply to the requesting one even with nothing new.
+    # Their writers are not drained here, each connection's own handler does that after its next request
+    def publish(self, requester=None):
+        paired = len(self.games) == 2
+        for starting_player, subscriber in self.subscribers.items():
+            writer, sent = subscriber
+            if starting_player == requester or sent < len(self.log) or (paired and requester is None):
+                writer.write(encode_frame((paired, self.log[sent:])))
+                subscriber[1] = len(self.log)
+
+    def reply(self):
+        if self._reply is None:
+            self._reply = encode_frame(self.games)
+        return self._reply
+
+class GameServer:
+
+    # Without allow_pickle only binary messages are read, pickle runs code from the peer and the legacy protocol
+    # should only be served to trusted clients
+    def __init__(self, max_connections=MAX_CONNECTIONS, verbose=True, allow_pickle=True):
+        self.max_connections = max_connections
+        self.verbose = verbose
+        self.allow_pickle = allow_pickle
+        self.sessions = {}
+        # Session of a player still waiting for an opponent
+        self.waiting = None
+        self.next_id = 0
+        self.connections = 0
+        self.server = None
+
+    async def start(self, host=server, port=port, backlog=1024):
+        self.server = await asyncio.start_server(self.handle_client, host or None, port, limit=READ_LIMIT,
+                                                 backlog=backlog)
+        return self.server
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        self.server.close()
+
+    def log(self, *args):
+        if self.verbose:
+            print(*args)
 
-                if not data:
-                    print("Disconnected")
+    # Pairs a new connection with the waiting player, or opens a new session for it to wait in
+    def join(self):
+        if self.waiting is None:
+            session = GameSession(self.next_id)
+            self.next_id += 1
+            self.sessions[session.game_id] = session
+            self.waiting = session
+            self.log("Creating a new game...")
+            return session, True
+        session, self.waiting = self.waiting, None
+        session.join()
+        return session, False
+
+    # Closes the session of a leaving player, its opponent's connection ends at its next request or at once when
+    # subscribed, as it may not send any for a while
+    def leave(self, session):
+        if session.open:
+            session.open = False
+            del self.sessions[session.game_id]
+            self.log("Closing Game", session.game_id)
+            for writer, _ in session.subscribers.values():
+                writer.close()
+        if self.waiting is session:
+            self.waiting = None
+
+    async def handle_client(self, reader, writer):
+        if self.connections >= self.max_connections:
+            writer.close()
+            return
+        self.connections += 1
+        self.log("Connected to: ", writer.get_extra_info('peername'))
+        session, starting_player = self.join()
+        try:
+            writer.write(encode_frame(starting_player))
+            await writer.drain()
+            while session.open:
+                data = await read_frame(reader, self.allow_pickle)
+                if data is None:
+                    self.log("Disconnected")
                     break
-                else:
-                    if starting_player:
-                        if data.current_turn != paired_games[0].current_turn or data._sync != paired_games[0]._sync or data.end_position != paired_games[0].end_position:
-                            paired_games[0] = data
+                if not session.open:
+                    break
+                if isinstance(data, tuple):
+                    sequence, commands = data
+                    if not isinstance(commands, tuple):
+                        raise ValueError("Commands are not a tuple")
+                    if (SUBSCRIBE,) in commands:
+                        session.subscribe(starting_player, writer, sequence)
+                    reply = session.exchange(starting_player, sequence, commands)
+                    if starting_player in session.subscribers:
+                        session.publish(starting_player)
                     else:
-                        # I could just set sync to false upon end position reached, after turns, or move undone
-                        if data.current_turn != paired_games[1].current_turn or data._sync != paired_games[1]._sync or data.end_position != paired_games[1].end_position:
-                            paired_games[1] = data
-                    reply = paired_games
-                    print("Received: ", data)
-                    print("Sending: ", reply)
-
-                send_data(conn, reply)
-            else:
-                break
+                        writer.write(encode_frame(reply))
+                else:
+                    session.update(starting_player, data)
+                    writer.write(session.reply())
+                await writer.drain()
         except Exception as err:
-            print("Error receiving, handling, or sending data...", err)
-            break
-    print("Lost connection")
+            self.log("Error receiving, handling, or sending data...", err)
+        self.log("Lost connection")
+        self.leave(session)
+        self.connections -= 1
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+async def serve(host=server, port=port, max_connections=MAX_CONNECTIONS, verbose=True, allow_pickle=True):
+    game_server = GameServer(max_connections, verbose, allow_pickle)
+    await game_server.start(host, port)
+    print("Waiting for Connection, Server Started...")
+    async with game_server.server:
+        await game_server.server.serve_forever()
+
+## Load test
+# Clients connect in pairs like players and send their game every round, the server runs in its own process so
+# its memory can be read from /proc
+
+# Resident memory of a process in megabytes, None where /proc is not available
+def resident_memory(pid):
     try:
-        del games[game_id]
-        print("Closing Game", game_id)
-    except:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
         pass
-    id_count -= 1
-    conn.close()
-
-while True:
-    conn, addr = s.accept()
-    print("Connected to: ", addr)
-
-    id_count += 1
-    starting_player = True
-    game_id = (id_count - 1) // 2
-    if id_count % 2 == 1:
-        games[game_id] = [Game(new_board.copy(), starting_player)]
-        print("Creating a new game...")
+    return None
+
+# Delta clients poll with an empty command list, the others send their whole game
+async def connect_client(host, port, delta=False):
+    reader, writer = await asyncio.open_connection(host, port)
+    starting_player = await read_frame(reader)
+    if delta:
+        return reader, writer, encode_frame((0, ()))
+    return reader, writer, encode_frame(Game([row[:] for row in new_board], starting_player))
+
+async def play_client(reader, writer, frame, rounds, latencies):
+    for _ in range(rounds):
+        sent = time.perf_counter()
+        writer.write(frame)
+        await writer.drain()
+        if await read_frame(reader) is None:
+            break
+        latencies.append(time.perf_counter() - sent)
+
+async def load_test(clients, rounds, host='127.0.0.1', port=5556, delta=False):
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--port', str(port), '--quiet'])
+    connections = []
+    try:
+        for _ in range(100):
+            try:
+                _, writer = await asyncio.open_connection(host, port)
+                writer.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        idle_memory = resident_memory(process.pid)
+        start = time.perf_counter()
+        # Connections are opened in batches so the listen backlog does not overflow
+        for batch in range(0, clients, 500):
+            connections += await asyncio.gather(*(connect_client(host, port, delta)
+                                                  for _ in range(min(500, clients - batch))))
+        connect_time = time.perf_counter() - start
+        connected_memory = resident_memory(process.pid)
+
+        latencies = []
+        start = time.perf_counter()
+        await asyncio.gather(*(play_client(reader, writer, frame, rounds, latencies)
+                               for reader, writer, frame in connections))
+        elapsed = time.perf_counter() - start
+        loaded_memory = resident_memory(process.pid)
+    finally:
+        for _, writer, _ in connections:
+            writer.close()
+        process.terminate()
+        process.wait()
+    latencies.sort()
+    return {'clients': clients, 'connect_time': connect_time, 'requests': len(latencies),
+            'requests_per_second': len(latencies) / elapsed if elapsed > 0 else 0.0,
+            'median_latency': latencies[len(latencies) // 2] if latencies else 0.0,
+            'p99_latency': latencies[len(latencies) * 99 // 100] if latencies else 0.0,
+            'idle_memory': idle_memory, 'connected_memory': connected_memory, 'loaded_memory': loaded_memory}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve games to pairs of players')
+    parser.add_argument('--host', default=server)
+    parser.add_argument('--port', type=int, default=port)
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS)
+    parser.add_argument('--quiet', action='store_true', help='do not log connections')
+    parser.add_argument('--no-pickle', action='store_true', help='only accept binary messages, not legacy pickled games')
+    parser.add_argument('--load-test', type=int, metavar='CLIENTS', help='run a server and load it with this many clients')
+    parser.add_argument('--rounds', type=int, default=10, help='requests per client in the load test')
+    parser.add_argument('--delta', action='store_true', help='load test clients speak the delta protocol')
+    args = parser.parse_args()
+
+    if args.load_test:
+        stats = asyncio.run(load_test(args.load_test, args.rounds, port=args.port if args.port != port else 5556,
+                                    delta=args.delta))
+        print(f"{stats['clients']} clients connected in {stats['connect_time']:.2f}s, "
+              f"{stats['requests']} requests at {stats['requests_per_second']:.0f}/s, "
+              f"latency median {stats['median_latency'] * 1000:.1f} ms p99 {stats['p99_latency'] * 1000:.1f} ms")
+        if stats['idle_memory'] is not None:
+            print(f"server memory {stats['idle_memory']:.1f} MB idle, {stats['connected_memory']:.1f} MB connected, "
+                  f"{stats['loaded_memory']:.1f} MB after the requests")
     else:
-        starting_player = False
-        games[game_id].append(Game(new_board.copy(), starting_player))
-    start_new_thread(threaded_client, (conn, starting_player, game_id))
-    starting_player = not starting_player
+        try:
+            asyncio.run(serve(args.host, args.port, args.max_connections, not args.quiet, not args.no_pickle))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,160 @@
+import multiprocessing
+import struct
+from multiprocessing import shared_memory
+
+## Shared transposition table
+# A transposition table living in a multiprocessing.shared_memory block so every search process reads and writes
+# the same entries, other processes attach to the block by name. Entries are 16 bytes, four to a 64 byte bucket,
+# and are written without locks: the stored key is the hash XORed with the data word, so an entry torn by two
+# processes writing at once no longer matches its hash and reads as a miss instead of as wrong data
+
+ENTRY = struct.Struct('<QQ')
+ENTRY_SIZE = ENTRY.size
+BUCKET_ENTRIES = 4
+BUCKET_SIZE = ENTRY_SIZE * BUCKET_ENTRIES
+PROMOTIONS = [None, 'Q', 'R', 'B', 'N']
+
+# Helper function to pack a (selected_piece, new_row, new_col, special, promotion) move into 16 bits:
+# start square, end square, special flag and promotion index. 0 is no move as a move never ends where it starts
+def pack_move(move):
+    if move is None:
+        return 0
+    selected_piece, new_row, new_col, special, promotion = move
+    promotion_index = 0 if promotion is None else PROMOTIONS.index(promotion.upper())
+    return (selected_piece[0] * 8 + selected_piece[1]) << 10 | (new_row * 8 + new_col) << 4 | special << 3 | promotion_index
+
+# Helper function to unpack a move, the colour of a promotion follows from the row it lands on
+def unpack_move(packed):
+    if packed == 0:
+        return None
+    start, end = packed >> 10, packed >> 4 & 63
+    promotion = PROMOTIONS[packed & 7]
+    if promotion is not None and end >> 3 == 7:
+        promotion = promotion.lower()
+    return (start >> 3, start & 7), end >> 3, end & 7, bool(packed >> 3 & 1), promotion
+
+# Helper functions to pack the entry data into one 64-bit word: score, move, depth and bound flag
+def pack_data(depth, score, flag, move):
+    return (score & 0xFFFFFFFF) | pack_move(move) << 32 | min(max(depth, 0), 255) << 48 | flag << 56
+
+def unpack_data(data):
+    score = data & 0xFFFFFFFF
+    if score & 0x80000000:
+        score -= 1 << 32
+    return data >> 48 & 0xFF, score, data >> 56 & 0xFF, unpack_move(data >> 32 & 0xFFFF)
+
+# Same probe, store and clear interface as engine.TranspositionTable so Engine can use either one
+class SharedTranspositionTable:
+
+    def __init__(self, size_mb=16, name=None, create=True):
+        if create:
+            # Rounded down to a power of two number of buckets so the bucket is a bit mask of the hash
+            buckets = max(1, size_mb * 1024 * 1024 // BUCKET_SIZE)
+            buckets = 1 << (buckets.bit_length() - 1)
+            self.memory = shared_memory.SharedMemory(name=name, create=True, size=buckets * BUCKET_SIZE)
+            _created_names.add(self.memory.name)
+            self.memory.buf[:buckets * BUCKET_SIZE] = bytes(buckets * BUCKET_SIZE)
+        else:
+            self.memory = attach_shared_memory(name)
+            # The block may be rounded up to the page size, only whole power of two buckets are used
+            buckets = 1 << ((self.memory.size // BUCKET_SIZE).bit_length() - 1)
+        self.owner = create
+        self.buckets = buckets
+        self.mask = buckets - 1
+        self.buffer = self.memory.buf
+        # Counters are per process, each process reports its own lookups
+        self.probes = 0
+        self.hits = 0
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    @property
+    def size_mb(self):
+        return self.buckets * BUCKET_SIZE / (1024 * 1024)
+
+    # Attaches to a table created by another process
+    @classmethod
+    def attach(cls, name):
+        return cls(name=name, create=False)
+
+    def probe(self, key):
+        self.probes += 1
+        offset = (key & self.mask) * BUCKET_SIZE
+        for index in range(BUCKET_ENTRIES):
+            stored_key, data = ENTRY.unpack_from(self.buffer, offset + index * ENTRY_SIZE)
+            if data and stored_key ^ data == key:
+                self.hits += 1
+                depth, score, flag, move = unpack_data(data)
+                return key, depth, score, flag, move
+        return None
+
+    # The same position is overwritten by an equal or deeper result, otherwise an empty or the shallowest entry
+    # of the bucket makes room
+    def store(self, key, depth, score, flag, move):
+        offset = (key & self.mask) * BUCKET_SIZE
+        replace, replace_depth = None, 256
+        for index in range(BUCKET_ENTRIES):
+            entry_offset = offset + index * ENTRY_SIZE
+            stored_key, data = ENTRY.unpack_from(self.buffer, entry_offset)
+            if data == 0:
+                if replace_depth >= 0:
+                    replace, replace_depth = entry_offset, -1
+                continue
+            stored_depth = data >> 48 & 0xFF
+            if stored_key ^ data == key:
+                if depth < stored_depth:
+                    return
+                replace = entry_offset
+                break
+            if stored_depth < replace_depth:
+                replace, replace_depth = entry_offset, stored_depth
+        data = pack_data(depth, score, flag, move)
+        ENTRY.pack_into(self.buffer, replace, key ^ data, data)
+
+    def clear(self):
+        self.buffer[:self.buckets * BUCKET_SIZE] = bytes(self.buckets * BUCKET_SIZE)
+        self.probes = 0
+        self.hits = 0
+
+    # Share of used entries, estimated from the first buckets like the UCI hashfull figure
+    def fill_rate(self, sample_buckets=1024):
+        sample = min(sample_buckets, self.buckets)
+        used = 0
+        for index in range(sample * BUCKET_ENTRIES):
+            if ENTRY.unpack_from(self.buffer, index * ENTRY_SIZE)[1]:
+                used += 1
+        return used / (sample * BUCKET_ENTRIES)
+
+    def hit_rate(self):
+        return self.hits / self.probes if self.probes else 0.0
+
+    def stats(self):
+        return {'size_mb': self.size_mb, 'fill_rate': self.fill_rate(), 'probes': self.probes, 'hits': self.hits,
+                'hit_rate': self.hit_rate()}
+
+    # Detaches this process, the creating process also frees the block
+    def close(self):
+        self.buffer = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+            _created_names.discard(self.memory.name)
+
+# Names of the blocks created by this process
+_created_names = set()
+
+# Helper function to attach to a shared memory block without this process's resource tracker unlinking it on exit,
+# only the creating process owns the block
+def attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python before 3.13 always tracks the block. The creating process and its pool workers share one tracker
+        # that already tracks the block, but an unrelated process such as an analysis service has its own
+        memory = shared_memory.SharedMemory(name=name)
+        if multiprocessing.parent_process() is None and memory.name not in _created_names:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
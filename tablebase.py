@@ -0,0 +1,482 @@
+import argparse
+import math
+import mmap
+import os
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from rules import KING_TABLE, KNIGHT_TABLE, ROOK_RAYS, BISHOP_RAYS, generate_legal_moves, is_square_attacked, \
+    make_board_move, unmake_board_move, move_string, parse_fen
+
+## Endgame tablebases
+# Retrograde analysis of endings of a king and pieces against a lone king, stored as one byte per position in a
+# memory-mapped file. Every position of an ending has a place in the file given by the position index:
+# the strong king is moved into a tenth of the board by the board's symmetries (a quarter with pawns, which only
+# mirror left to right) and the two kings are numbered together among their legal placements, 462 without pawns
+# and 1806 with them. The other pieces are ranked among the squares left free, like pieces as one unordered set,
+# and the side to move adds a bit. The only unused indices left are pawns sharing a square with a king, second
+# images of positions with both kings on the long diagonal, and positions with the side not to move in check.
+# A stored byte is 0 for a draw or an unused index, WIN + n when the side to move mates in n plies and
+# LOSS + n when it is mated in n plies. Castling and en passant are impossible against a lone king
+
+TABLEBASE_MAGIC = b'JDCTB002'
+HEADER = struct.Struct('<8s16sQ')
+WIN, LOSS = 0, 128
+PIECE_ORDER = 'QRBNP'
+# Endings without enough material to mate are draws without a file
+DRAWN_SIGNATURES = {'KK', 'KBK', 'KNK'}
+# Marks an unused index in the move counters during generation
+INVALID = 255
+
+## Position index
+# Squares are numbered row * 8 + col, row 0 being the eighth rank like the board
+
+# Helper function to build the square mapping of one symmetry of the board
+def build_symmetry(flip_cols, flip_rows, transpose):
+    mapping = []
+    for square in range(64):
+        row, col = square >> 3, square & 7
+        if flip_cols:
+            col = 7 - col
+        if flip_rows:
+            row = 7 - row
+        if transpose:
+            row, col = 7 - col, 7 - row
+        mapping.append(row * 8 + col)
+    return mapping
+
+SYMMETRIES = [build_symmetry(flip_cols, flip_rows, transpose)
+              for transpose in (False, True) for flip_rows in (False, True) for flip_cols in (False, True)]
+# The a1-d1-d4 triangle for endings without pawns and the a-d files with pawns
+TRIANGLE = [square for square in range(64) if square >> 3 >= 4 and (7 - (square >> 3)) <= (square & 7) <= 3]
+HALF_BOARD = [square for square in range(64) if square & 7 <= 3]
+# The symmetries taking each king square into the reduced set, two for squares on the a1-h8 diagonal
+KING_SYMMETRIES = [[mapping for mapping in SYMMETRIES if mapping[square] in TRIANGLE] for square in range(64)]
+PAWN_KING_SYMMETRIES = [[SYMMETRIES[0] if square & 7 <= 3 else SYMMETRIES[1]] for square in range(64)]
+# Pawns are ranked among the second to seventh ranks, which are squares 8 to 55
+PAWN_FIRST, PAWN_END = 8, 56
+# Binomial coefficients for the ranks of like pieces, COMBINATIONS[n][k] is n choose k
+COMBINATIONS = [[math.comb(n, k) for k in range(9)] for n in range(65)]
+
+# Helper function to list the king placements of the index, grouped by strong king square. A pair is kept when
+# no symmetry of the strong king's square gives a smaller weak king square, and the kings are never adjacent
+def king_pairs(king_squares, king_symmetries):
+    pairs = []
+    for strong in king_squares:
+        for weak in range(64):
+            if max(abs((strong >> 3) - (weak >> 3)), abs((strong & 7) - (weak & 7))) <= 1:
+                continue
+            if all(mapping[weak] >= weak for mapping in king_symmetries[strong]):
+                pairs.append((strong, weak))
+    return pairs
+
+# Helper function to read the material of a board as a signature such as KBNK, strong side first.
+# Returns the signature and whether the strong side is black, or None when both sides have pieces
+def material_signature(board):
+    white, black = [], []
+    for rank in board:
+        for piece in rank:
+            if piece != ' ' and piece not in ('K', 'k'):
+                (white if piece.isupper() else black).append(piece.upper())
+    if white and black:
+        return None
+    flipped = bool(black)
+    pieces = sorted(black if flipped else white, key=PIECE_ORDER.index)
+    return 'K' + ''.join(pieces) + 'K', flipped
+
+class Ending:
+
+    def __init__(self, signature):
+        self.signature = signature
+        self.pieces = list(signature[1:-1])
+        self.has_pawns = 'P' in self.pieces
+        self.king_squares = HALF_BOARD if self.has_pawns else TRIANGLE
+        self.king_symmetries = PAWN_KING_SYMMETRIES if self.has_pawns else KING_SYMMETRIES
+        self.pairs = king_pairs(self.king_squares, self.king_symmetries)
+        self.pair_index = {pair: index for index, pair in enumerate(self.pairs)}
+        # Pieces of one kind are ranked together as a set of squares, each kind among the squares left free by
+        # the kings and the kinds before it. Pawns only stand on the second to seventh ranks. The index reads the
+        # squares in key order, kings first then each kind, and a group is (start, end, first square, size) in it
+        self.key_order = [0, len(self.pieces) + 1]
+        self.groups = []
+        for piece in PIECE_ORDER:
+            indices = [index + 1 for index, other in enumerate(self.pieces) if other == piece]
+            if indices:
+                start = len(self.key_order)
+                free = PAWN_END - PAWN_FIRST if piece == 'P' else 64 - start
+                first = PAWN_FIRST if piece == 'P' else 0
+                self.groups.append((start, start + len(indices), first, COMBINATIONS[free][len(indices)]))
+                self.key_order.extend(indices)
+        self.like_groups = [(start, end) for start, end, _, _ in self.groups if end - start > 1]
+        self.piece_span = math.prod(size for _, _, _, size in self.groups)
+        self.size = len(self.pairs) * self.piece_span * 2
+        # Index range of each strong king square, which is how generation splits the work
+        self.king_starts = [0]
+        for strong in self.king_squares:
+            count = sum(1 for pair in self.pairs if pair[0] == strong)
+            self.king_starts.append(self.king_starts[-1] + count * self.piece_span * 2)
+
+    # Index of a position given as (strong king, pieces..., weak king) squares and whether the strong side moves
+    def index(self, squares, strong_to_move):
+        best = None
+        for mapping in self.king_symmetries[squares[0]]:
+            key = [mapping[squares[piece_index]] for piece_index in self.key_order]
+            for start, end in self.like_groups:
+                key[start:end] = sorted(key[start:end])
+            if best is None or key < best:
+                best = key
+        index = self.pair_index[best[0], best[1]]
+        for start, end, first, size in self.groups:
+            rank, count = 0, 0
+            for square in best[start:end]:
+                # Rank of the square among the free ones, then its term in the combinatorial number system
+                free_rank = square - first
+                for other in best[:start]:
+                    if other < square and other >= first:
+                        free_rank -= 1
+                count += 1
+                rank += COMBINATIONS[free_rank][count]
+            index = index * size + rank
+        return index * 2 + (0 if strong_to_move else 1)
+
+    # Position of an index as (squares, strong side to move), or None for an index no position maps to
+    def decode(self, index):
+        strong_to_move = index & 1 == 0
+        index >>= 1
+        key = [0] * len(self.key_order)
+        for start, end, first, size in reversed(self.groups):
+            rank = index % size
+            index //= size
+            for count in range(end - start, 0, -1):
+                free_rank = rank if count == 1 else count - 1
+                while COMBINATIONS[free_rank + 1][count] <= rank:
+                    free_rank += 1
+                rank -= COMBINATIONS[free_rank][count]
+                key[start + count - 1] = first + free_rank
+        key[0], key[1] = self.pairs[index]
+        # Free square ranks become squares by stepping over the squares taken before each group
+        for start, end, first, _ in self.groups:
+            taken = sorted(key[:start])
+            for position in range(start, end):
+                square = key[position]
+                for other in taken:
+                    if first <= other <= square:
+                        square += 1
+                if square >= (PAWN_END if first else 64):
+                    return None
+                key[position] = square
+        squares = [0] * len(key)
+        for piece_index, square in zip(self.key_order, key):
+            squares[piece_index] = square
+        return squares, strong_to_move
+
+    # Board of a position with the strong side as white
+    def board(self, squares):
+        board = [[' '] * 8 for _ in range(8)]
+        for piece, square in zip(['K'] + self.pieces + ['k'], squares):
+            board[square >> 3][square & 7] = piece
+        return board
+
+    # Helper function to read a position off a board whose strong side is white
+    def squares(self, board):
+        found = {piece: [] for piece in 'KkQRBNP'}
+        for row in range(8):
+            for col in range(8):
+                if board[row][col] != ' ':
+                    found[board[row][col]].append(row * 8 + col)
+        squares = [found['K'][0]]
+        for piece in self.pieces:
+            squares.append(found[piece].pop(0))
+        squares.append(found['k'][0])
+        return squares
+
+## Probing
+
+class Tablebases:
+
+    # Files are looked up in directory by signature, e.g. tablebases/KQK.jdtb, and mapped on first use
+    def __init__(self, directory='tablebases'):
+        self.directory = directory
+        self.tables = {}
+
+    def path(self, signature):
+        return os.path.join(self.directory, signature + '.jdtb')
+
+    def table(self, signature):
+        if signature not in self.tables:
+            path = self.path(signature)
+            table = None
+            if os.path.exists(path):
+                with open(path, 'rb') as file:
+                    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, stored_signature, size = HEADER.unpack_from(data, 0)
+                if magic != TABLEBASE_MAGIC or stored_signature.rstrip(b'\0').decode() != signature:
+                    raise ValueError(f"{path} is not a tablebase for {signature}")
+                table = (Ending(signature), data)
+            self.tables[signature] = table
+        return self.tables[signature]
+
+    def close(self):
+        for table in self.tables.values():
+            if table is not None:
+                table[1].close()
+        self.tables = {}
+
+    # Result for the side to move as (wdl, plies to mate): wdl is 1 for a win, 0 for a draw and -1 for a loss.
+    # None when the material has no table
+    def probe(self, board, is_white_turn):
+        material = material_signature(board)
+        if material is None:
+            return None
+        signature, flipped = material
+        if signature in DRAWN_SIGNATURES:
+            return 0, 0
+        table = self.table(signature)
+        if table is None:
+            return None
+        ending, data = table
+        if flipped:
+            # Seen from black's side, rows swap and colours swap
+            board = [[piece.swapcase() for piece in rank] for rank in reversed(board)]
+        value = data[HEADER.size + ending.index(ending.squares(board), is_white_turn != flipped)]
+        if value == 0:
+            return 0, 0
+        if value >= LOSS:
+            return -1, value - LOSS
+        return 1, value - WIN
+
+    def probe_game(self, game):
+        return self.probe(game.board, game.current_turn)
+
+    # The move keeping the best result: the fastest win, a draw or the longest loss. Returns the move in
+    # the Game.make_move form with the position's (wdl, plies to mate), or None when a position reached has no table
+    def best_move(self, board, is_white_turn):
+        best, best_key, best_result = None, None, None
+        for move in generate_legal_moves(board, is_white_turn):
+            selected_piece, new_row, new_col, special, promotion = move
+            undo = make_board_move(board, selected_piece, new_row, new_col, '', promotion)
+            result = self.probe(board, not is_white_turn)
+            unmake_board_move(board, undo)
+            if result is None:
+                return None
+            wdl, plies = result
+            # The opponent's loss in n plies is a win in n + 1
+            key = (wdl, plies + 1 if wdl < 0 else -(plies + 1) if wdl > 0 else 0)
+            if best_key is None or key < best_key:
+                best, best_key, best_result = move, key, (-wdl, plies + 1 if wdl else 0)
+        return None if best is None else (best, best_result)
+
+## Generation
+# The position counters are filled by a forward pass over every index: a position's counter holds its distinct
+# successors within the ending, captures and promotions leave it and are probed in the smaller tables.
+# Results then spread backwards ply by ply: the predecessors of a position lost in n plies win in n + 1, and
+# a position whose every successor wins for the opponent is lost once its counter reaches zero. Both passes are
+# split over a process pool, positions never resolved are draws
+
+# Ending and smaller tables of the current worker process, set by the pool initializer
+_worker_ending = None
+_worker_tablebases = None
+
+def _start_worker(signature, directory):
+    global _worker_ending, _worker_tablebases
+    _worker_ending = Ending(signature)
+    _worker_tablebases = Tablebases(directory)
+
+# Forward pass over the positions of one strong king square. Returns the counters, the positions already
+# resolved as (index, value) and a map of the positions that may not lose to the least plies of a loss,
+# None when a capture or promotion keeps a draw or a win
+def _initial_pass(king_index):
+    ending, tablebases = _worker_ending, _worker_tablebases
+    start, end = ending.king_starts[king_index], ending.king_starts[king_index + 1]
+    counters = bytearray([INVALID]) * (end - start)
+    resolved, loss_floors = [], {}
+    for offset in range(end - start):
+        index = start + offset
+        position = ending.decode(index)
+        if position is None:
+            continue
+        squares, strong_to_move = position
+        if len(set(squares)) != len(squares) or ending.index(squares, strong_to_move) != index:
+            continue
+        board = ending.board(squares)
+        # The side not to move may not be in check
+        king = squares[-1] if strong_to_move else squares[0]
+        if is_square_attacked(board, king >> 3, king & 7, strong_to_move):
+            continue
+
+        successors, win_floor, loss_floor, keeps_draw = set(), None, 0, False
+        moves = generate_legal_moves(board, strong_to_move)
+        for move in moves:
+            selected_piece, new_row, new_col, special, promotion = move
+            from_square, to_square = selected_piece[0] * 8 + selected_piece[1], new_row * 8 + new_col
+            if promotion is None and to_square not in squares:
+                moved = list(squares)
+                moved[squares.index(from_square)] = to_square
+                successors.add(ending.index(moved, not strong_to_move))
+                continue
+            # Captures and promotions are looked up in the smaller table they lead to
+            undo = make_board_move(board, selected_piece, new_row, new_col, '', promotion)
+            wdl, plies = tablebases.probe(board, not strong_to_move)
+            unmake_board_move(board, undo)
+            if wdl < 0:
+                win_floor = plies + 1 if win_floor is None else min(win_floor, plies + 1)
+            elif wdl > 0:
+                loss_floor = max(loss_floor, plies + 1)
+            else:
+                keeps_draw = True
+
+        counters[offset] = len(successors)
+        if not moves:
+            if is_square_attacked(board, squares[0 if strong_to_move else -1] >> 3,
+                                  squares[0 if strong_to_move else -1] & 7, not strong_to_move):
+                resolved.append((index, LOSS))
+        elif win_floor is not None:
+            # Resolved at this distance unless a quicker win is found within the ending
+            resolved.append((index, WIN + win_floor))
+            loss_floors[index] = None
+        elif keeps_draw:
+            loss_floors[index] = None
+        elif loss_floor:
+            if successors:
+                loss_floors[index] = loss_floor
+            else:
+                resolved.append((index, LOSS + loss_floor))
+    return counters, resolved, loss_floors
+
+# Predecessors within the ending of each position, found by taking back every non-capturing move of the side
+# that moved last. Pawns step back, never onto the first rank, and never take back a promotion. Kings never
+# step back next to each other, which the index has no place for
+def _predecessors(indices):
+    ending = _worker_ending
+    results = []
+    for index in indices:
+        squares, strong_to_move = ending.decode(index)
+        occupied = set(squares)
+        movers = range(len(squares) - 1) if not strong_to_move else [len(squares) - 1]
+        predecessors = set()
+        for piece_index in movers:
+            square = squares[piece_index]
+            row, col = square >> 3, square & 7
+            piece = 'K' if piece_index in (0, len(squares) - 1) else ending.pieces[piece_index - 1]
+            targets = []
+            if piece == 'K':
+                # A king never steps back next to the other king
+                other = squares[-1 if piece_index == 0 else 0]
+                targets = [r * 8 + c for r, c in KING_TABLE[row][col]
+                           if max(abs(r - (other >> 3)), abs(c - (other & 7))) > 1]
+            elif piece == 'N':
+                targets = [r * 8 + c for r, c in KNIGHT_TABLE[row][col]]
+            elif piece == 'P':
+                if row < 6 and square + 8 not in occupied:
+                    targets.append(square + 8)
+                    if row == 4 and square + 16 not in occupied:
+                        targets.append(square + 16)
+            else:
+                rays = (ROOK_RAYS[row][col] if piece in 'RQ' else []) + (BISHOP_RAYS[row][col] if piece in 'BQ' else [])
+                for ray in rays:
+                    for r, c in ray:
+                        if r * 8 + c in occupied:
+                            break
+                        targets.append(r * 8 + c)
+            for target in targets:
+                if target in occupied:
+                    continue
+                moved = list(squares)
+                moved[piece_index] = target
+                predecessors.add(ending.index(moved, not strong_to_move))
+        results.append((index, list(predecessors)))
+    return results
+
+# Helper function to list the endings reached by a capture or promotion, which are generated first
+def dependencies(signature):
+    pieces = signature[1:-1]
+    reached = set()
+    for index, piece in enumerate(pieces):
+        rest = pieces[:index] + pieces[index + 1:]
+        reached.add('K' + ''.join(sorted(rest, key=PIECE_ORDER.index)) + 'K')
+        if piece == 'P':
+            for promotion in 'QRBN':
+                reached.add('K' + ''.join(sorted(rest + promotion, key=PIECE_ORDER.index)) + 'K')
+    return sorted(reached - DRAWN_SIGNATURES)
+
+# Generates the table of an ending and any missing smaller table it depends on, returning the path written
+def generate(signature, directory='tablebases', workers=None, verbose=False):
+    for dependency in dependencies(signature):
+        if not os.path.exists(Tablebases(directory).path(dependency)):
+            generate(dependency, directory, workers, verbose)
+    os.makedirs(directory, exist_ok=True)
+    ending = Ending(signature)
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+
+    counters = bytearray(ending.size)
+    values = bytearray(ending.size)
+    loss_floors = {}
+    buckets = {}
+    with ProcessPoolExecutor(workers, initializer=_start_worker, initargs=(signature, directory)) as pool:
+        for king_index, (chunk, resolved, floors) in enumerate(pool.map(_initial_pass, range(len(ending.king_squares)))):
+            counters[ending.king_starts[king_index]:ending.king_starts[king_index + 1]] = chunk
+            loss_floors.update(floors)
+            for index, value in resolved:
+                buckets.setdefault(value & 127, []).append((index, value))
+
+        plies = 0
+        while buckets:
+            newly_resolved = []
+            for index, value in buckets.pop(plies, []):
+                if values[index] == 0:
+                    values[index] = value
+                    newly_resolved.append(index)
+            chunk_size = max(256, len(newly_resolved) // (workers * 4) + 1)
+            chunks = [newly_resolved[i:i + chunk_size] for i in range(0, len(newly_resolved), chunk_size)]
+            for results in pool.map(_predecessors, chunks):
+                for index, predecessors in results:
+                    lost = values[index] >= LOSS
+                    for predecessor in predecessors:
+                        if counters[predecessor] == INVALID or values[predecessor] != 0:
+                            continue
+                        if lost:
+                            buckets.setdefault(plies + 1, []).append((predecessor, WIN + plies + 1))
+                            continue
+                        counters[predecessor] -= 1
+                        if counters[predecessor] == 0:
+                            floor = loss_floors.get(predecessor, 0)
+                            if floor is not None:
+                                distance = max(plies + 1, floor)
+                                buckets.setdefault(distance, []).append((predecessor, LOSS + distance))
+            plies += 1
+
+    path = Tablebases(directory).path(signature)
+    with open(path, 'wb') as file:
+        file.write(HEADER.pack(TABLEBASE_MAGIC, signature.encode(), ending.size))
+        file.write(values)
+    if verbose:
+        wins = sum(1 for value in values if 0 < value < LOSS)
+        losses = sum(1 for value in values if value >= LOSS)
+        longest = max((value & 127 for value in values if value), default=0)
+        print(f"{signature}: {ending.size} indices, {wins} wins, {losses} losses, longest mate {longest} plies, "
+              f"{time.perf_counter() - start:.1f}s")
+    return path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate or probe endgame tablebases')
+    parser.add_argument('endings', nargs='*', default=['KQK', 'KRK', 'KPK', 'KBNK'], help='endings to generate')
+    parser.add_argument('--directory', default='tablebases')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--probe', help='FEN to look up instead of generating')
+    args = parser.parse_args()
+
+    if args.probe:
+        board, is_white_turn, _, _ = parse_fen(args.probe)
+        tablebases = Tablebases(args.directory)
+        start = time.perf_counter()
+        result = tablebases.probe(board, is_white_turn)
+        elapsed = time.perf_counter() - start
+        best = tablebases.best_move(board, is_white_turn)
+        print(f"result {result}  probe {elapsed * 1e6:.0f} us")
+        if best is not None:
+            move = best[0]
+            print(f"bestmove {move_string(move[0], move[1], move[2], move[4])}")
+    else:
+        for signature in args.endings:
+            generate(signature, args.directory, args.workers, verbose=True)
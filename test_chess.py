@@ -1,5 +1,24 @@
 import pytest
-from main import calculate_moves
+import asyncio
+import threading
+import time
+from main import Game, ALL_CASTLING_RIGHTS, WHITE_KING_SIDE, BLACK_QUEEN_SIDE, calculate_moves, calculate_legal_moves, is_check, is_checkmate_or_stalemate, is_square_attacked, hash_position, has_legal_move, parse_fen, generate_legal_moves
+from bitboard import BENCHMARK_POSITIONS, board_from_placement
+from perft import PERFT_POSITIONS, game_from_fen, perft, divide
+from analysis import POSITION_CACHE, PositionCache, analyse_position
+from engine import Engine, MATE_BOUND, MATE_SCORE
+from parallel import ParallelEngine
+from shared_table import SharedTranspositionTable, ENTRY, pack_move, unpack_move
+import background_search
+from background_search import SearchHandle, Ponderer
+from book import OpeningBook, build_book, read_pgn, san_to_move, START_FEN
+from evaluation import evaluate, evaluation_matches, score_evaluation, unpack_evaluation
+from mate import MateSolver, MATE_PUZZLES, MATE, NO_MATE, UNKNOWN, read_epd
+from server import GameServer, GameSession, FRAME_HEADER, MAX_FRAME_SIZE, encode_frame, read_frame, new_board as server_board
+from protocol import GameSync, MOVE, UNDO, RESIGN, HEARTBEAT_INTERVAL
+from network import Network, AsyncNetwork
+from codec import COMMAND_CACHE_SIZE, PICKLE_MARKER, decode, decode_command, encode
+from tablebase import Ending, Tablebases, generate, HEADER as TABLEBASE_HEADER
 
 # Example chess board setup
 @pytest.fixture
@@ -187,5 +206,729 @@ def test_piece_blocking(chess_board):
 
     # Add more cases if needed
 
+# Sub-test 3: Move Backends
+# The bitboard backend must produce the same moves and end-game answers as the list backend
+def test_bitboard_backend(chess_board):
+    boards = [chess_board] + [board_from_placement(placement) for placement in BENCHMARK_POSITIONS.values()]
+    for board in boards:
+        for row in range(8):
+            for col in range(8):
+                if board[row][col] != ' ':
+                    list_moves = calculate_moves(board, row, col, None, backend='list')
+                    bitboard_moves = calculate_moves(board, row, col, None, backend='bitboard')
+                    assert sorted(list_moves[0]) == sorted(bitboard_moves[0])  # Same moves
+                    assert sorted(list_moves[1]) == sorted(bitboard_moves[1])  # Same captures
+        for is_white in [True, False]:
+            assert is_check(board, is_white, [], 'list') == is_check(board, is_white, [], 'bitboard')
+            assert is_checkmate_or_stalemate(board, is_white, [], 'list') == is_checkmate_or_stalemate(board, is_white, [], 'bitboard')
+            assert is_checkmate_or_stalemate(board, is_white, [], 'list', count_moves=False) == \
+                is_checkmate_or_stalemate(board, is_white, [], 'bitboard', count_moves=False)
+
+    # Example 1: En passant is read from the last move the same way on both backends
+    chess_board[3][4] = 'P'  # White pawn on e5
+    chess_board[1][3] = ' '
+    chess_board[3][3] = 'p'  # Black pawn that just moved d7-d5
+    history = [['p13', 'p33', ' ', '']]
+    assert calculate_moves(chess_board, 3, 4, history, backend='bitboard')[2] == [(2, 3)]
+    assert calculate_moves(chess_board, 3, 4, history, backend='list')[2] == [(2, 3)]
+
+# Sub-test 4: Attacked Squares and Castling
+def test_castling(chess_board):
+    castle_attributes = {
+        'white_king_moved' : False,
+        'left_white_rook_moved' : False,
+        'right_white_rook_moved' : False,
+        'black_king_moved' : False,
+        'left_black_rook_moved' : False,
+        'right_black_rook_moved' : False
+    }
+    # Example 1: Both castles are available once the back rank is cleared.
+    chess_board[7][1:4] = [' ', ' ', ' ']
+    chess_board[7][5:7] = [' ', ' ']
+    assert set(calculate_moves(chess_board, 7, 4, [], castle_attributes)[2]) == set([(7, 2), (7, 6)])
+
+    # Example 2: A piece on the b-file blocks the queen side rook.
+    chess_board[7][1] = 'N'
+    assert calculate_moves(chess_board, 7, 4, [], castle_attributes)[2] == [(7, 6)]
+    chess_board[7][1] = ' '
+
+    # Example 3: The king cannot pass through an attacked square.
+    chess_board[6][5] = ' '  # Open the f-file
+    chess_board[2][5] = 'r'  # Black rook attacks f1
+    assert is_square_attacked(chess_board, 7, 5, False)
+    assert not is_square_attacked(chess_board, 7, 3, False)
+    assert calculate_moves(chess_board, 7, 4, [], castle_attributes)[2] == [(7, 2)]
+    assert calculate_moves(chess_board, 7, 4, [], castle_attributes, backend='bitboard')[2] == [(7, 2)]
+
+    # Example 4: No castling once the rook has been captured in its corner.
+    chess_board[7][0] = 'b'
+    assert calculate_moves(chess_board, 7, 4, [], castle_attributes)[2] == []
+
+    # Example 5: A check from the castled rook is marked in the notation.
+    game = game_from_fen('5k2/8/8/8/8/8/8/4K2R w K - 0 1')
+    game.update_state(7, 6, (7, 4), special=True)
+    assert game.alg_moves == ['0-0+'] and game.board[7][5:7] == ['R', 'K']
+
+# Sub-test 5: Legal Moves
+def test_legal_moves(chess_board):
+    # Example 1: A pinned piece can only move along its pin.
+    chess_board[6][4] = ' '  # Open the e-file
+    chess_board[5][4] = 'B'  # White bishop on e3
+    chess_board[2][4] = 'r'  # Black rook pins it to the king
+    assert calculate_legal_moves(chess_board, 5, 4, [])[0] == []
+    chess_board[5][4] = 'R'  # A rook can slide along the pin and capture the pinner
+    assert set(calculate_legal_moves(chess_board, 5, 4, [])[0]) == set([(4, 4), (3, 4), (2, 4), (6, 4)])
+
+    # Example 2: Under check only blocks, captures of the checker or king moves remain.
+    chess_board[5][4] = ' '
+    assert set(calculate_legal_moves(chess_board, 7, 6, [])[0]) == set([(6, 4)])  # Knight blocks on e2
+    assert calculate_legal_moves(chess_board, 6, 0, [])[0] == []  # Pawn cannot help
+    assert set(calculate_legal_moves(chess_board, 7, 4, [])[0]) == set()  # King is boxed in
+    assert is_checkmate_or_stalemate(chess_board, True, []) == (False, 3)  # Ne2, Be2 and Qe2
+
+    # Example 3: En passant that exposes the king along the rank is illegal.
+    chess_board[2][4] = ' '
+    chess_board[6][4] = 'P'
+    chess_board[3][0] = 'K'  # White king on a5
+    chess_board[7][4] = ' '
+    chess_board[3][4] = 'P'  # White pawn on e5
+    chess_board[1][3] = ' '
+    chess_board[3][3] = 'p'  # Black pawn that just moved d7-d5
+    chess_board[3][7] = 'r'  # Black rook on h5
+    assert calculate_legal_moves(chess_board, 3, 4, [['p13', 'p33', ' ', '']])[2] == []
+
+# Sub-test 6: Make and Unmake
+# Every move played in place must be fully restored by its undo record
+def test_make_unmake(chess_board):
+    chess_board[7][5:7] = [' ', ' ']  # Clear the king side for castling
+    chess_board[3][4] = 'P'  # White pawn on e5
+    chess_board[6][4] = ' '
+    chess_board[1][6] = 'P'  # White pawn ready to promote on g7 by capturing
+    game = Game(chess_board, True)
+    original_board = [rank[:] for rank in chess_board]
+    original_castle_attributes = game.castle_attributes.copy()
+
+    undo_records = []
+    undo_records.append(game.make_move((7, 4), 7, 6, special=True))  # Castle king side
+    assert game.board[7][5] == 'R' and game.board[7][6] == 'K' and game.castle_attributes['white_king_moved']
+    undo_records.append(game.make_move((1, 3), 3, 3))  # Black pawn d7-d5
+    undo_records.append(game.make_move((3, 4), 2, 3, special=True))  # En passant
+    assert game.board[3][3] == ' ' and game.board[2][3] == 'P'
+    undo_records.append(game.make_move((0, 4), 1, 3))  # Black king steps aside
+    undo_records.append(game.make_move((1, 6), 0, 7, promotion='Q'))  # Promote by capturing the h8 rook
+    assert game.board[0][7] == 'Q' and game.moves[-1][1] == 'Q07'
+
+    for undo in reversed(undo_records):
+        game.unmake_move(undo)
+    assert game.board == original_board
+    assert game.castle_attributes == original_castle_attributes
+    assert game.moves == [] and game.current_turn
+
+# Sub-test 7: Position State
+# The en passant square and castling rights follow the moves and are restored on undo
+def test_position_state(chess_board):
+    game = Game(chess_board, True)
+    game.update_state(4, 4, (6, 4))  # e4
+    assert game.enpassant_square == (5, 4)
+    game.update_state(3, 0, (1, 0))  # a5
+    assert game.enpassant_square == (2, 0)
+    game.update_state(5, 7, (6, 7))  # h3
+    assert game.enpassant_square is None
+    game.update_state(2, 0, (0, 0))  # Ra6 loses black's queen side castling
+    game.update_state(6, 7, (7, 7))  # Rh2 loses white's king side castling
+    assert game.castling_rights == ALL_CASTLING_RIGHTS ^ WHITE_KING_SIDE ^ BLACK_QUEEN_SIDE
+    # Castling is read from the rights without the move history
+    assert calculate_moves(game.board, 7, 4, castling_rights=game.castling_rights)[2] == []
+
+    for _ in range(4):
+        game.undo_move()
+    assert game.enpassant_square == (5, 4)
+    assert game.castling_rights == ALL_CASTLING_RIGHTS
+
+def test_zobrist_hash(chess_board):
+    game = Game(chess_board, True)
+    start_hash = game.zobrist_hash
+    # Knights out and back twice repeats the starting position three times
+    shuffle = [((7, 6), (5, 5)), ((0, 6), (2, 5)), ((5, 5), (7, 6)), ((2, 5), (0, 6))]
+    for selected_piece, (new_row, new_col) in shuffle * 2:
+        game.update_state(new_row, new_col, selected_piece)
+        assert game.zobrist_hash == hash_position(game.board, game.current_turn, game.castling_rights, game.enpassant_square)
+    assert game.zobrist_hash == start_hash
+    assert game.board_states[start_hash] == 3 and game.threefold_check()
+
+    # An en passant square only counts when a pawn can capture on it
+    game.update_state(4, 4, (6, 4))  # e4
+    assert game.zobrist_hash == hash_position(game.board, False, game.castling_rights, None)
+
+    for _ in range(9):
+        game.undo_move()
+    assert game.zobrist_hash == start_hash and game.board_states == {start_hash: 1}
+
+def test_incremental_evaluation():
+    # Every move to depth 2 of positions with castling, en passant and promotions keeps the evaluation exact
+    for name in ('Kiwipete', 'Position 4'):
+        game = game_from_fen(PERFT_POSITIONS[name][0])
+        start_evaluation = game.evaluation
+        for move in generate_legal_moves(game.board, game.current_turn, game.enpassant_square, game.castling_rights):
+            undo = game.make_move(*move)
+            assert evaluation_matches(game)
+            for reply in generate_legal_moves(game.board, game.current_turn, game.enpassant_square, game.castling_rights):
+                reply_undo = game.make_move(*reply)
+                assert evaluation_matches(game)
+                game.unmake_move(reply_undo)
+            game.unmake_move(undo)
+        assert game.evaluation == start_evaluation
+        assert score_evaluation(game.evaluation) == evaluate(game.board)
+
+    # Promotion through the game window and its undo
+    game = game_from_fen('4k3/1P6/8/8/8/8/8/4K3 w - - 0 1')
+    start_evaluation = game.evaluation
+    game.update_state(0, 1, (1, 1))
+    game.promote_to_piece(0, 1, 'Q')
+    assert evaluation_matches(game) and unpack_evaluation(game.evaluation)[2] == 4
+    game.undo_move()
+    assert game.evaluation == start_evaluation
+
+def test_repetition_tracking(chess_board):
+    game = Game(chess_board, True)
+    shuffle = [((7, 6), (5, 5)), ((0, 6), (2, 5)), ((5, 5), (7, 6)), ((2, 5), (0, 6))]
+    for selected_piece, (new_row, new_col) in shuffle:
+        game.update_state(new_row, new_col, selected_piece)
+    assert game.max_repetitions == 2 and not game.threefold_check()
+
+    # A pawn move is irreversible so only positions after it are repetition candidates
+    game.update_state(4, 4, (6, 4))  # e4
+    assert game.board_states == {game.zobrist_hash: 1} and game.max_repetitions == 1
+    black_first = [shuffle[1], shuffle[0], shuffle[3], shuffle[2]]
+    for selected_piece, (new_row, new_col) in black_first * 2:
+        game.update_state(new_row, new_col, selected_piece)
+    assert game.max_repetitions == 3 and game.threefold_check()
+
+    game.undo_move()
+    assert game.max_repetitions == 2 and not game.threefold_check()
+    for _ in range(8):
+        game.undo_move()
+    # Undoing the pawn move restores the earlier candidates
+    assert game.max_repetitions == 2 and len(game.board_states) == 4
+
+def test_perft():
+    # Shallow depths of every standard position keep the suite fast, perft.py runs the deeper ones
+    for name, (fen, expected_counts) in PERFT_POSITIONS.items():
+        depth = 3 if expected_counts[2] < 10000 else 2
+        game = game_from_fen(fen)
+        assert perft(game, depth) == expected_counts[depth - 1], name
+        # The tree walk leaves the position untouched
+        assert game.zobrist_hash == game_from_fen(fen).zobrist_hash and game.moves == []
+
+    counts = divide(game_from_fen(PERFT_POSITIONS['Start'][0]), 2)
+    assert len(counts) == 20 and counts['e2e4'] == 20
+
+def test_position_cache(chess_board):
+    game = Game(chess_board, True)
+    cache = PositionCache(max_size=2)
+    analysis = cache.analyse(game)
+    assert analysis.legal_move_count == 20 and not analysis.in_check and analysis.end_state() == (False, 1)
+    assert analysis.piece_moves(game.board, 6, 4) == ([(5, 4), (4, 4)], [], [])
+    assert cache.analyse(game) is analysis and cache.stats()['hits'] == 1
+
+    # Fool's mate, the notation check analyses the mated position ahead of the end-of-game check
+    for (new_row, new_col), selected_piece in [((5, 5), (6, 5)), ((3, 4), (1, 4)), ((4, 6), (6, 6))]:
+        game.update_state(new_row, new_col, selected_piece)
+    assert analyse_position(game).is_legal((0, 3), 4, 7)
+    game.update_state(4, 7, (0, 3))
+    assert game.alg_moves[-1] == 'Qh4#'
+    hits = POSITION_CACHE.hits
+    assert analyse_position(game).end_state() == (True, 0)
+    assert POSITION_CACHE.hits == hits + 1
+
+    # The least recently used position is dropped past max_size
+    for _ in range(2):
+        game.undo_move()
+        cache.analyse(game)
+    assert cache.stats()['size'] == 2 and cache.stats()['misses'] == 3
+
+def test_has_legal_move(chess_board):
+    assert has_legal_move(chess_board, True) and has_legal_move(chess_board, False)
+
+    # The only legal move captures the checking queen with the rook, the king has no moves
+    board, is_white, _, _ = parse_fen('4k3/rp1b2p1/3pN1r1/pnp3p1/1PP5/N2p1Pp1/P4qR1/2R2K2 w - -')
+    assert has_legal_move(board, is_white)
+    assert is_checkmate_or_stalemate(board, is_white, count_moves=False) == (False, 1)
+    assert is_checkmate_or_stalemate(board, is_white) == (False, 1)
+
+    board[6][6] = ' '  # Without the rook it is checkmate
+    assert not has_legal_move(board, is_white)
+    assert is_checkmate_or_stalemate(board, is_white, count_moves=False) == (True, 0)
+
+def test_engine():
+    # Back rank mate in one
+    game = game_from_fen('6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1')
+    result = Engine(tt_size=1 << 12).search(game, max_depth=3)
+    assert result.move == ((7, 3), (0, 3), False) and result.score > MATE_BOUND and result.pv == ['d1d8']
+    # The searched game is left as it was and the move is played through update_state
+    assert game.moves == [] and game.board[7][3] == 'R'
+    selected_piece, (new_row, new_col), special = result.move
+    game.update_state(new_row, new_col, selected_piece, special)
+    assert game.alg_moves == ['Rd8#']
+
+    # A hanging queen is taken, the node budget stops deeper iterations
+    game = game_from_fen('4k3/8/8/3q4/8/2N5/8/4K3 w - - 0 1')
+    result = Engine(tt_size=1 << 12).search(game, max_nodes=2000)
+    assert result.move == ((5, 2), (3, 3), False) and result.nodes < 4000 and result.depth >= 2
+
+def test_parallel_engine():
+    with ParallelEngine(workers=2, tt_size=1 << 12) as engine:
+        result = engine.search(game_from_fen('6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1'), max_depth=3)
+        assert result.move == ((7, 3), (0, 3), False) and result.score > MATE_BOUND
+        # Same root score as the single process search at a fixed depth
+        fen = PERFT_POSITIONS['Kiwipete'][0]
+        assert engine.search(game_from_fen(fen), max_depth=2).score == Engine(1 << 12).search(game_from_fen(fen), max_depth=2).score
+
+def test_shared_transposition_table():
+    table = SharedTranspositionTable(size_mb=1)
+    try:
+        promotion = ((6, 1), 7, 0, False, 'n')
+        assert unpack_move(pack_move(promotion)) == promotion
+        table.store(77, 4, -99990, 1, promotion)
+        other = SharedTranspositionTable.attach(table.name)
+        assert other.probe(77) == (77, 4, -99990, 1, promotion)
+        # A shallower result does not replace a deeper one
+        other.store(77, 2, 0, 0, None)
+        assert table.probe(77)[1] == 4
+        other.close()
+
+        # An entry torn by a racing write no longer matches its hash and is a miss
+        stored_key, data = ENTRY.unpack_from(table.buffer, (77 & table.mask) * 64)
+        ENTRY.pack_into(table.buffer, (77 & table.mask) * 64, stored_key, data ^ 1)
+        assert table.probe(77) is None
+        assert table.hit_rate() == 0.5 and 0 < table.fill_rate() < 1
+    finally:
+        table.close()
+
+    with ParallelEngine(workers=2, shared_tt_mb=1) as engine:
+        result = engine.search(game_from_fen('6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1'), max_depth=3)
+        assert result.move == ((7, 3), (0, 3), False) and engine.shared_tt.fill_rate() > 0
+
+def test_background_search(monkeypatch):
+    async def run(threaded):
+        # Depths stream in while the event loop keeps turning frames
+        handle = SearchHandle(game_from_fen('6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1'), Engine(1 << 12), max_depth=3)
+        depths = [info.depth async for info in handle]
+        result = await handle
+        assert depths == list(range(1, result.depth + 1)) and result.move == ((7, 3), (0, 3), False)
+
+        frames = 0
+        handle = SearchHandle(game_from_fen(PERFT_POSITIONS['Kiwipete'][0]), Engine(1 << 12))
+        while handle.info is None or handle.info.depth < 2:
+            frames += 1
+            await asyncio.sleep(0.001)
+        # Stop now keeps the best move found so far, cancel throws it away
+        handle.stop()
+        result = await handle
+        assert frames > (10 if threaded else 0) and result.move is not None and result.depth >= 2 and handle.result() is result
+        handle = SearchHandle(game_from_fen(PERFT_POSITIONS['Kiwipete'][0]), Engine(1 << 12))
+        handle.cancel()
+        assert await handle is None and handle.info is None
+
+    asyncio.run(run(True))
+    # Without threads, as in the browser build, the search runs on the loop in slices
+    monkeypatch.setattr(background_search, 'THREADS_AVAILABLE', False)
+    asyncio.run(run(False))
+
+    async def stalls():
+        # Depth 4 of Kiwipete takes seconds, yet the loop never waits for long between frames
+        handle = SearchHandle(game_from_fen(PERFT_POSITIONS['Kiwipete'][0]), Engine(1 << 16), max_depth=4)
+        longest, last = 0.0, time.perf_counter()
+        while not handle.done():
+            await asyncio.sleep(0)
+            now = time.perf_counter()
+            longest, last = max(longest, now - last), now
+        result = await handle
+        assert result.depth == 4 and result.move is not None
+        return longest, time.perf_counter() - handle.started
+
+    longest, elapsed = asyncio.run(stalls())
+    assert elapsed > 1.0 and longest < 0.1
+
+def test_pondering():
+    async def ponder(game, ponderer):
+        # White to move in the game, so after white's move the engine ponders black's expected reply
+        game.update_state(4, 4, (6, 4))
+        while ponderer.handle is None or ponderer.predicting or ponderer.handle.info is None or ponderer.handle.info.depth < 2:
+            ponderer.update(game)
+            await asyncio.sleep(0.001)
+        return ponderer.expected_move
+
+    async def run():
+        # Ponder hit, the running search is handed over with the depths already searched
+        game, ponderer = game_from_fen(PERFT_POSITIONS['Start'][0]), Ponderer(Engine(1 << 14))
+        selected_piece, new_row, new_col, special, _ = await ponder(game, ponderer)
+        game.update_state(new_row, new_col, selected_piece, special)
+        ponderer.update(game)
+        pondered = ponderer.handle
+        handle = ponderer.search(game, max_time=0.1)
+        assert ponderer.hits == 1 and handle is pondered and handle.info.depth >= 2
+        result = await handle
+        assert result.move is not None and ponderer.handle is None
+
+        # Ponder miss, the pondered search is cancelled and a new one started
+        game = game_from_fen(PERFT_POSITIONS['Start'][0])
+        expected = await ponder(game, ponderer)
+        reply = ((1, 0), 2, 0, False, None) if expected[0] != (1, 0) else ((1, 7), 2, 7, False, None)
+        pondered = ponderer.handle
+        game.update_state(reply[1], reply[2], reply[0])
+        ponderer.update(game)
+        assert ponderer.misses == 1 and pondered.cancelled and ponderer.handle is None
+        result = await ponderer.search(game, max_depth=2)
+        assert result.move is not None and result.depth == 2
+
+    asyncio.run(run())
+
+def test_opening_book(tmp_path):
+    pgn = tmp_path / 'games.pgn'
+    pgn.write_text('''[Event "Ruy"]
+[Result "1-0"]
+
+1. e4 e5 2. Nf3 Nc6 3. Bb5 {comment} a6 (3... Nf6 4. O-O) 4. Ba4 Nf6 5. O-O Be7 1-0
+
+[Event "Sicilian"]
+[Result "1/2-1/2"]
+
+1. e4 c5 2. Nf3 d6 3. d4 cxd4 4. Nxd4 Nf6 5. Nc3 a6 1/2-1/2
+
+[Event "QGD"]
+[Result "0-1"]
+
+1.d4 d5 2.c4 e6 3.Nc3 Nf6 0-1
+''')
+    assert [len(moves) for _, moves in read_pgn(pgn.read_text())] == [10, 10, 6]
+    # Losing moves add no weight: 5 + 9 + 3 moves, e4 counted once
+    games, records = build_book([str(pgn)], str(tmp_path / 'book.bin'))
+    assert (games, records) == (3, 17)
+
+    with OpeningBook(str(tmp_path / 'book.bin')) as book:
+        game = game_from_fen(START_FEN)
+        assert book.moves(game) == [(((6, 4), 4, 4, False, None), 3)] and book.choose(game) == ((6, 4), 4, 4, False, None)
+        game.make_move((6, 4), 4, 4)
+        # Black lost with e5, so only the drawn c5 is in the book
+        assert book.moves(game) == [(((1, 2), 3, 2, False, None), 1)]
+        game.make_move((1, 7), 2, 7)
+        assert book.choose(game) is None
+
+        # The engine answers book positions without searching
+        result = Engine(1 << 12, book=book).search(game_from_fen(START_FEN))
+        assert result.move == ((6, 4), (4, 4), False) and result.depth == 0 and result.nodes == 0
+
+    # Promotion, castling and disambiguation
+    game = game_from_fen('r3k2r/1P6/8/8/8/8/8/R3K1NR w KQkq - 0 1')
+    legal_moves = generate_legal_moves(game.board, True, None, game.castling_rights)
+    assert san_to_move(game.board, legal_moves, 'bxa8=N+') == ((1, 1), 0, 0, False, 'N')
+    assert san_to_move(game.board, legal_moves, 'O-O-O') == ((7, 4), 7, 2, True, None)
+    assert san_to_move(game.board, legal_moves, 'Rb1') == ((7, 0), 7, 1, False, None)
+    assert san_to_move(game.board, legal_moves, 'Nf3') == ((7, 6), 5, 5, False, None)
+
+def test_tablebase(tmp_path):
+    generate('KQK', str(tmp_path), workers=2)
+    tablebases = Tablebases(str(tmp_path))
+    # Mate in one, already mated, stalemate and the same ending with colours swapped
+    assert tablebases.probe(parse_fen('k7/7Q/1K6/8/8/8/8/8 w - - 0 1')[0], True) == (1, 1)
+    assert tablebases.probe(parse_fen('k5Q1/8/1K6/8/8/8/8/8 b - - 0 1')[0], False) == (-1, 0)
+    assert tablebases.probe(parse_fen('k7/8/1Q6/8/8/8/8/K7 b - - 0 1')[0], False) == (0, 0)
+    assert tablebases.probe(parse_fen('8/8/8/8/8/8/7Q/1k4K1 w - - 0 1')[0], True) == \
+        tablebases.probe(parse_fen('8/8/8/8/8/8/7q/1K4k1 b - - 0 1')[0], False) == (1, 11)
+    # Bare kings need no table, other material has none
+    assert tablebases.probe(parse_fen('8/8/8/8/8/8/8/1k4K1 w - - 0 1')[0], True) == (0, 0)
+    assert tablebases.probe(parse_fen(PERFT_POSITIONS['Start'][0])[0], True) is None
+
+    # Every position needs at most ten moves to mate, i.e. 19 plies, or 20 when the losing side moves first
+    ending, data = tablebases.table('KQK')
+    assert max(value & 127 for value in data[TABLEBASE_HEADER.size:]) == 20
+
+    # The kings take their 462 legal placements, 1806 with pawns
+    assert ending.size == 462 * 62 * 2 and len(Ending('KPK').pairs) == 1806
+    assert Ending('KRRK').size == 462 * (62 * 61 // 2) * 2
+    # Every slot decodes to a position with that index, except the mirror images when both kings are on the
+    # long diagonal: 21 such king pairs, half of the 56 queen squares off the diagonal, either side to move
+    mirrored = [index for index in range(ending.size) if ending.index(*ending.decode(index)) != index]
+    assert len(mirrored) == 21 * 28 * 2
+
+    # The engine plays the quickest mate straight from the table
+    game = game_from_fen('8/8/8/8/8/8/7Q/1k4K1 w - - 0 1')
+    result = Engine(1 << 12, tablebases=tablebases).search(game)
+    assert result.depth == 0 and result.score == MATE_SCORE - 11
+    tablebases.close()
+
+def test_mate_solver():
+    solver = MateSolver()
+    for fen, mate_in in read_epd(MATE_PUZZLES):
+        game = game_from_fen(fen)
+        result = solver.solve(game, 5)
+        assert result.status == MATE and result.mate_in == mate_in and len(result.line) == 2 * mate_in - 1
+        # The line is legal and ends in checkmate, and the game was left untouched
+        assert game.board == game_from_fen(fen).board
+        for move in result.line:
+            assert move in generate_legal_moves(game.board, game.current_turn, game.enpassant_square, game.castling_rights)
+            game.make_move(*move)
+        assert is_checkmate_or_stalemate(game.board, game.current_turn) == (True, 0)
+
+    # Refuted below the shortest mate, unknown once the budget runs out
+    fen = next(fen for fen, mate_in in read_epd(MATE_PUZZLES) if mate_in == 3)
+    assert MateSolver().solve(game_from_fen(fen), 2).status == NO_MATE
+    result = MateSolver(max_nodes=100).solve(game_from_fen(fen), 3)
+    assert result.status == UNKNOWN and result.nodes < 200
+
+    # A solver reused with the other side attacking does not take the earlier proofs for its own
+    solver.solve(game_from_fen('6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1'), 1)
+    assert solver.solve(game_from_fen('7k/5ppp/8/8/8/8/5PPP/3R2K1 b - - 0 1'), 2).status == NO_MATE
+
+def test_game_server():
+    async def run():
+        game_server = GameServer(max_connections=3, verbose=False)
+        await game_server.start('127.0.0.1', 0)
+        connect = lambda: asyncio.open_connection('127.0.0.1', game_server.port)
+        white_reader, white_writer = await connect()
+        black_reader, black_writer = await connect()
+        assert await read_frame(white_reader) is True and await read_frame(black_reader) is False
+
+        # Each player's game is stored in its slot and both are sent back
+        game = Game([row[:] for row in server_board], True)
+        game.update_state(4, 4, (6, 4))  # e4
+        white_writer.write(encode_frame(game))
+        games = await read_frame(white_reader)
+        assert len(games) == 2 and games[0].board == game.board
+        black_writer.write(encode_frame(Game([row[:] for row in server_board], False)))
+        assert (await read_frame(black_reader))[0].board[4][4] == 'P'
+
+        # The third connection waits in a new session and the fourth is refused
+        third_reader, third_writer = await connect()
+        assert await read_frame(third_reader) is True
+        fourth_reader, _ = await connect()
+        assert await read_frame(fourth_reader) is None
+
+        # A player leaving closes the session, the opponent's next request ends its connection
+        white_writer.close()
+        while 0 in game_server.sessions:
+            await asyncio.sleep(0.01)
+        black_writer.write(encode_frame(game))
+        assert await read_frame(black_reader) is None
+        # So does an oversized frame
+        third_writer.write(FRAME_HEADER.pack(MAX_FRAME_SIZE + 1))
+        assert await read_frame(third_reader) is None
+        while game_server.connections:
+            await asyncio.sleep(0.01)
+        assert game_server.sessions == {} and game_server.waiting is None
+        game_server.close()
+
+    asyncio.run(run())
+
+def test_delta_protocol():
+    # Requests and replies go through the session as encoded frames, as they would over the socket
+    class SessionNetwork:
+        def __init__(self, session, is_white):
+            self.session, self.is_white, self.sent = session, is_white, []
+
+        def send(self, data):
+            self.sent.append(len(encode_frame(data)))
+            return decode(encode_frame(self.session.exchange(self.is_white, *data))[FRAME_HEADER.size:], False)
+
+    session = GameSession(0)
+    session.join()
+    white, black = Game([row[:] for row in server_board], True), Game([row[:] for row in server_board], False)
+    white_sync, black_sync = GameSync(), GameSync()
+    white_network, black_network = SessionNetwork(session, True), SessionNetwork(session, False)
+
+    white.update_state(4, 4, (6, 4))  # e4
+    assert not white_sync.exchange(white_network, white) and black_sync.exchange(black_network, black)
+    black.update_state(3, 3, (1, 3))  # d5
+    black_sync.exchange(black_network, black)
+    white_sync.exchange(white_network, white)
+    white.update_state(3, 3, (4, 4))  # exd5
+    white_sync.exchange(white_network, white)
+    black_sync.exchange(black_network, black)
+    assert black.board == white.board and black.alg_moves == white.alg_moves == ['e4', 'd5', 'exd5']
+    # Either player may undo
+    black.undo_move()
+    black_sync.exchange(black_network, black)
+    white_sync.exchange(white_network, white)
+    assert white.board == black.board and len(white.moves) == 2 and white.current_turn
+    # Polls with nothing new are a few dozen bytes each way
+    assert not black_sync.exchange(black_network, black)
+    assert black_network.sent[-1] < 30 and len(encode_frame(session.exchange(False, black_sync.sequence, ()))) < 30
+
+    black.forced_end, black.end_position = "BLACK RESIGNATION", True
+    black_sync.exchange(black_network, black)
+    white_sync.exchange(white_network, white)
+    assert white.end_position and white.forced_end == "BLACK RESIGNATION"
+
+    # A promotion is sent once its piece is chosen
+    session = GameSession(1)
+    session.join()
+    board = parse_fen('4k3/1P6/8/8/8/8/8/4K3 w - - 0 1')[0]
+    white, black = Game([row[:] for row in board], True, True, 0), Game([row[:] for row in board], False, True, 0)
+    white_sync, black_sync = GameSync(), GameSync()
+    white_network, black_network = SessionNetwork(session, True), SessionNetwork(session, False)
+    white.update_state(0, 1, (1, 1))
+    white_sync.exchange(white_network, white)
+    assert session.log == []
+    white.promote_to_piece(0, 1, 'Q')
+    white_sync.exchange(white_network, white)
+    assert session.log == [(True, (MOVE, 1, 1, 0, 1, False, 'Q'))]
+    black_sync.exchange(black_network, black)
+    assert black.board == white.board and black.alg_moves == white.alg_moves and not black.current_turn
+
+    # Commands the game does not allow are dropped: moves out of turn, from empty squares, illegal or with a
+    # promotion piece that does not exist, and malformed commands
+    game = Game([row[:] for row in server_board], False)
+    board = [row[:] for row in game.board]
+    assert not GameSync().apply(game, [(True, (MOVE, 4, 4, 3, 4, False, None)), (True, (MOVE, 6, 4, 3, 4, False, None)),
+                                       (False, (MOVE, 1, 4, 3, 4, False, None)), (True, (MOVE, 6, 4, 4, 4, False, 'K')),
+                                       (True, (MOVE, 6, 4)), (True, (UNDO,)), (True, (7,)), (True, 'x')])
+    assert game.board == board and game.moves == []
+
+    # The server checks commands before logging and relaying them
+    session = GameSession(2)
+    session.join()
+    for starting_player, sequence, commands in [(True, -1, ()), (True, 1, ()), (True, 0, ((MOVE, 6, 4, 8, 4, False, None),)),
+                                                (False, 0, ((MOVE, 1, 4, 3, 4, False, None),)), (True, 0, ((UNDO,),)),
+                                                (True, 0, ((MOVE, 6, 4, 4, 4, False, None), (MOVE, 4, 4, 3, 4, False, None))),
+                                                (True, 0, ((9,),)), (True, 0, ((MOVE, 6, 4, 4, 4, 0, 'K'),))]:
+        with pytest.raises(ValueError):
+            session.exchange(starting_player, sequence, commands)
+    assert session.log == [] and session.plies == 0
+    session.exchange(True, 0, ((MOVE, 6, 4, 4, 4, False, None),))
+    session.exchange(False, 1, ((RESIGN,),))
+    with pytest.raises(ValueError):
+        session.exchange(True, 2, ((MOVE, 7, 6, 5, 5, False, None),))
+    assert len(session.log) == 2
+
+def test_binary_codec():
+    position = parse_fen('rnbqkbnr/pppp1ppp/8/4p3/4P3/8/PPPP1PPP/RNBQKBNR w KQkq e6 0 2')
+    events = [(True, (MOVE, 6, 4, 4, 4, False, None)), (False, (MOVE, 6, 1, 7, 0, False, 'q')),
+              (True, (MOVE, 7, 4, 7, 6, True, None)), (False, (UNDO,)), (True, (RESIGN,))]
+    messages = [True, False, (0, ()), (41, ((MOVE, 1, 1, 0, 1, False, 'Q'), (UNDO,))), (False, []), (True, events),
+                position, (position[0], False, 0, None)]
+    for message in messages:
+        payload = encode(message)
+        assert payload[0] != PICKLE_MARKER and decode(payload, False) == message
+    # A board is a nibble per square
+    assert len(encode(position)) == 36 and len(encode((41, ((MOVE, 6, 4, 4, 4, False, None),)))) == 11
+
+    # Games are still pickled for legacy clients, and only read when allowed
+    payload = encode(Game([row[:] for row in server_board], True))
+    assert payload[0] == PICKLE_MARKER and decode(payload).board == server_board
+    with pytest.raises(ValueError):
+        decode(payload, False)
+    for broken in (b'', b'\x02\x01\x01', b'\x01\x09', b'\x01\x01', b'\x01\x02\x00', b'\x01\x03', b'\x01\x04\x00',
+                   encode((0, ()))[:-1], encode((True, events))[:-1], encode((True, events)) + b'\x00',
+                   encode(position)[:2] + b'\x77' * 32 + b'\x00\xff', b'\x01\x02\x00\x00\x00\x00\x00\x01\x00\x00\x00',
+                   b'\x01\x02\x00\x00\x00\x00\x00\x01\x00\x84\x07', b'\x01\x02\x00\x00\x00\x00\x00\x01\x00\x86\x01'):
+        with pytest.raises(ValueError):
+            decode(broken, False)
+    # Whatever moves a peer sends, the command caches stay bounded
+    for packed in range(1 << 16):
+        try:
+            decode(b'\x01\x02\x00\x00\x00\x00\x00\x01\x00' + packed.to_bytes(2, 'big'), False)
+        except ValueError:
+            pass
+    assert decode_command.cache_info().currsize <= COMMAND_CACHE_SIZE
+
+def test_push_protocol():
+    # The server runs on its own loop in a thread, the clients are the blocking ones of the game window
+    loop = asyncio.new_event_loop()
+    game_server = GameServer(verbose=False)
+    loop.run_until_complete(game_server.start('127.0.0.1', 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def until(condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+    try:
+        white_network = Network('127.0.0.1', game_server.port)
+        white, white_sync = Game([row[:] for row in server_board], white_network.get_player()), GameSync()
+        white_sync.subscribe(white_network)
+        until(lambda: not white_sync.update(white_network, white) and white_sync.received_at is not None)
+        assert not white_sync.paired
+        # The waiting player is told when its opponent joins
+        black_network = Network('127.0.0.1', game_server.port)
+        black, black_sync = Game([row[:] for row in server_board], black_network.get_player()), GameSync()
+        black_sync.subscribe(black_network)
+        until(lambda: white_sync.update(white_network, white) or white_sync.paired)
+        until(lambda: black_sync.update(black_network, black) or black_sync.paired)
+
+        white.update_state(4, 4, (6, 4))  # e4
+        white_sync.update(white_network, white)
+        until(lambda: black_sync.update(black_network, black))
+        assert black.board == white.board and not black.current_turn
+        # Idle clients neither send nor receive anything until their heartbeat is due
+        time.sleep(0.1)
+        sent_at = white_sync.sent_at
+        assert not white_sync.update(white_network, white) and white_sync.sent_at == sent_at
+        assert white_network.receive() == []
+        white_sync.sent_at -= HEARTBEAT_INTERVAL
+        received_at = white_sync.received_at
+        white_sync.update(white_network, white)
+        until(lambda: white_sync.update(white_network, white) or white_sync.received_at != received_at)
+
+        # A subscriber is disconnected as soon as its opponent leaves
+        white_network.client.close()
+        with pytest.raises(ConnectionError):
+            until(lambda: black_sync.update(black_network, black))
+        black_network.client.close()
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        game_server.close()
+        loop.close()
+
+def test_async_network():
+    # Server and clients share one loop, as the game window would under pygbag
+    async def run():
+        game_server = GameServer(verbose=False)
+        await game_server.start('127.0.0.1', 0)
+
+        async def until(condition):
+            for _ in range(500):
+                if condition():
+                    return
+                await asyncio.sleep(0.01)
+            assert condition()
+
+        white_network, black_network = AsyncNetwork('127.0.0.1', game_server.port), AsyncNetwork('127.0.0.1', game_server.port)
+        assert await white_network.connect() is True and await black_network.connect() is False
+        white, black = Game([row[:] for row in server_board], True), Game([row[:] for row in server_board], False)
+        white_sync, black_sync = GameSync(), GameSync()
+        white_sync.subscribe(white_network)
+        black_sync.subscribe(black_network)
+        # Updates only queue and pick up messages, the loop does the I/O between them
+        white.update_state(4, 4, (6, 4))  # e4
+        assert not white_sync.update(white_network, white) and white_network.outbox.qsize() == 2
+        await until(lambda: black_sync.update(black_network, black))
+        assert black.board == white.board and black_sync.paired
+
+        # The legacy protocol gets the latest reply without waiting, and unanswered requests are not piled up
+        white_network.close()
+        black_network.close()
+        legacy_network = AsyncNetwork('127.0.0.1', game_server.port)
+        assert await legacy_network.connect() is True
+        game = Game([row[:] for row in server_board], True)
+        assert legacy_network.send(game) is None and legacy_network.send(game) is None
+        assert legacy_network.outbox.qsize() == 1 and legacy_network.next_request is game
+        await until(lambda: legacy_network.latest is not None and not legacy_network.awaiting)
+        assert legacy_network.send(game)[0].board == server_board
+
+        # A lost connection is reported by receive
+        game_server.close()
+        legacy_network.writer.close()
+        await until(lambda: legacy_network.closed)
+        with pytest.raises(ConnectionError):
+            legacy_network.receive()
+        legacy_network.close()
+
+    asyncio.run(run())
+
 if __name__ == "__main__":
     pytest.main()
\ No newline at end of file
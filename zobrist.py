@@ -0,0 +1,60 @@
+import random
+
+## Zobrist hashing
+# Every piece on every square, the side to move, each castling rights value and each en passant file gets a random
+# 64-bit key. A position hash is the XOR of the keys that apply to it, so a move only toggles the keys it changes.
+# The generator is seeded so hashes are identical across processes and runs, which stored tables rely on.
+_generator = random.Random(20231105)
+
+PIECE_KEYS = {piece: [_generator.getrandbits(64) for _ in range(64)] for piece in 'PNBRQKpnbrqk'}
+# Toggled when black is to move
+SIDE_KEY = _generator.getrandbits(64)
+# Indexed by the packed castling rights
+CASTLING_KEYS = [_generator.getrandbits(64) for _ in range(16)]
+# Indexed by the file of the en passant square
+ENPASSANT_KEYS = [_generator.getrandbits(64) for _ in range(8)]
+
+# Helper function for the key of a piece on a square
+def piece_key(piece, row, col):
+    return PIECE_KEYS[piece][row * 8 + col]
+
+# Helper function for the en passant key of a position, only hashed when a pawn can actually capture
+# so positions that only differ by an unusable en passant square count as repetitions
+def enpassant_key(board, enpassant_square):
+    if enpassant_square is None:
+        return 0
+    row, col = enpassant_square
+    # The capturing pawn sits on the same row as the pawn that just moved twice
+    pawn_row, pawn = (3, 'P') if row == 2 else (4, 'p')
+    if (col > 0 and board[pawn_row][col - 1] == pawn) or (col < 7 and board[pawn_row][col + 1] == pawn):
+        return ENPASSANT_KEYS[col]
+    return 0
+
+# Helper function to hash a position from scratch, used once per game and to verify the incremental updates
+def hash_position(board, is_white_turn, castling_rights, enpassant_square):
+    zobrist_hash = 0
+    for row in range(8):
+        for col in range(8):
+            piece = board[row][col]
+            if piece != ' ':
+                zobrist_hash ^= PIECE_KEYS[piece][row * 8 + col]
+    if not is_white_turn:
+        zobrist_hash ^= SIDE_KEY
+    return zobrist_hash ^ CASTLING_KEYS[castling_rights] ^ enpassant_key(board, enpassant_square)
+
+# Helper function for the piece keys toggled by a move already played with make_board_move
+def hash_board_move(board, undo):
+    selected_piece, new_row, new_col, piece, captured, special_string = undo
+    start_row, start_col = selected_piece
+    end = new_row * 8 + new_col
+    # The placed piece differs from the moved piece on promotions
+    delta = PIECE_KEYS[piece][start_row * 8 + start_col] ^ PIECE_KEYS[board[new_row][new_col]][end]
+    if special_string == 'enpassant':
+        delta ^= PIECE_KEYS[captured][start_row * 8 + new_col]
+    elif captured != ' ':
+        delta ^= PIECE_KEYS[captured][end]
+    if special_string == 'castle':
+        rook = 'R' if piece == 'K' else 'r'
+        rook_start, rook_end = (0 if new_col == 2 else 7), (3 if new_col == 2 else 5)
+        delta ^= PIECE_KEYS[rook][new_row * 8 + rook_start] ^ PIECE_KEYS[rook][new_row * 8 + rook_end]
+    return delta